@@ -1,9 +1,13 @@
 import os
-import uuid
+import hashlib
 import shutil
-from flask import Flask, render_template, request, redirect, url_for, session, flash
-from PIL import Image
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_file
 import sys
+import time
+from jobs import JobQueue, QueueFull
+from images import resize_image_bytes
+from model.utils.files import write_atomic
+import telemetry
 
 def resource_path(relative_path):
     """获取资源的绝对路径，适用于开发环境和PyInstaller打包后的环境"""
@@ -34,6 +38,14 @@ os.makedirs(RESULT_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['RESULT_FOLDER'] = RESULT_FOLDER
 app.config['MODEL_WEIGHTS'] = MODEL_WEIGHTS
+app.config['TILED_INFERENCE'] = True  # 大图按原始分辨率分块识别，而不是缩放到2048像素
+app.config['DETECT_WORKERS'] = 2  # 后台检测线程数，所有线程共享同一个已加载的模型
+app.config['MAX_PENDING_JOBS'] = 32  # 最多等待中的检测任务数
+app.config['DETECT_MAX_BATCH'] = 4  # 并发请求合并推理的最大批次大小，1表示不合并
+app.config['DETECT_MAX_WAIT_MS'] = 10  # 合并推理时等待其他请求的最长时间（毫秒），越大吞吐越高但延迟越长
+app.config['LAZY_RENDER'] = True  # 识别时只计数，标注图片在第一次查看结果时再生成
+app.config['SHAPE_BUCKETS'] = None  # 输入尺寸分桶（宽x高），例如 '640x640,640x480,1024x768'，启动时逐个预热，为None时按图片比例缩放
+app.config['ACCESS_LOG'] = None  # JSON访问日志文件路径（每个请求一行），例如 os.path.join(base_dir, 'access.log')，为None时不记录
 app.secret_key = 'ypf1101'  # 设置一个安全的密钥
 
 
@@ -48,62 +60,6 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def resize_image_if_needed(image_path, max_size=2048):
-    """
-    检查图像尺寸，如果超过最大尺寸，则调整到最大尺寸
-    
-    Args:
-        image_path: 图像文件路径
-        max_size: 最大尺寸（宽和高）
-    
-    Returns:
-        bool: 是否调整了图像尺寸
-    """
-    try:
-        img = Image.open(image_path)
-        original_mode = img.mode
-        width, height = img.size
-        resized = False
-        format_converted = False
-        
-        # 检查图像尺寸是否超过最大尺寸
-        if width > max_size or height > max_size:
-            # 计算缩放比例
-            ratio = min(max_size / width, max_size / height)
-            new_width = int(width * ratio)
-            new_height = int(height * ratio)
-            
-            # 调整图像尺寸
-            img = img.resize((new_width, new_height), Image.LANCZOS)
-            resized = True
-        
-        # 处理图片格式问题
-        file_ext = os.path.splitext(image_path)[1].lower()
-        
-        # 如果是PNG格式且有透明通道
-        if img.mode == 'RGBA':
-            # 要保存为JPG或需要调整大小，需要转换为RGB
-            if file_ext == '.jpg' or file_ext == '.jpeg' or resized:
-                # 创建一个白色背景
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                # 将原图与白色背景合成
-                background.paste(img, mask=img.split()[3])  # 使用alpha通道作为蒙版
-                img = background
-                format_converted = True
-        # 其他格式转换为RGB（例如P模式等）
-        elif img.mode != 'RGB' and (file_ext == '.jpg' or file_ext == '.jpeg' or resized):
-            img = img.convert('RGB')
-            format_converted = True
-        
-        # 如果图片被调整大小或格式被转换，保存图片
-        if resized or format_converted:
-            img.save(image_path)
-            return True
-        return False
-    except Exception as e:
-        print(f"调整图像尺寸时出错: {e}")
-        return False
-
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
@@ -119,16 +75,23 @@ def index():
             return redirect(request.url)
         
         if file and allowed_file(file.filename):
-            # 生成唯一文件名
-            unique_id = uuid.uuid4().hex
-            filename = unique_id + '_' + file.filename
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(file_path)
-            
-            # 检查图像尺寸并在需要时调整
-            resized = resize_image_if_needed(file_path, max_size=2048)
-            if resized:
-                flash('图像尺寸过大，已自动调整为适合处理的尺寸', 'info')
+            # 按图片内容生成文件名（SHA256前32位），重复上传同一张图片时复用已保存的文件和识别结果
+            with telemetry.timer('upload'):
+                data = file.read()
+                unique_id = hashlib.sha256(data).hexdigest()[:32]
+                filename = unique_id + '_' + file.filename
+                file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+                exists = os.path.exists(file_path)
+            if not exists:
+                # 在内存中检查图像尺寸并在需要时调整（分块识别时保留原始分辨率）
+                with telemetry.timer('resize'):
+                    max_size = None if app.config['TILED_INFERENCE'] else 2048
+                    data, resized = resize_image_bytes(data, os.path.splitext(filename)[1], max_size=max_size)
+                # 同一张图片的文件名在用户之间共享，原子替换保证并发上传和识别只会读到完整的最终文件
+                with telemetry.timer('write'):
+                    write_atomic(file_path, data)
+                if resized:
+                    flash('图像尺寸过大，已自动调整为适合处理的尺寸', 'info')
             
             # 将文件名存入session
             session['uploaded_file'] = filename
@@ -141,33 +104,123 @@ def index():
     
     return render_template('index.html')
 
+# 后台检测任务队列，/process 只负责提交任务，检测在后台线程中完成
+job_queue = JobQueue(workers=app.config['DETECT_WORKERS'], max_pending=app.config['MAX_PENDING_JOBS'])
+
+# 请求计时、/metrics监控接口和可选的JSON访问日志
+telemetry.init_app(app, job_queue, access_log=app.config['ACCESS_LOG'])
+
+def wants_json():
+    """请求方是否需要JSON响应（页面中的fetch请求或API调用）"""
+    return request.accept_mimetypes.best == 'application/json' or \
+           request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+
+def run_detection(filename, submitted):
+    """后台线程中执行的检测任务，submitted为提交时间（用于统计排队耗时）"""
+    # 导入detect模块中的detect_image函数
+    from model.detect import detect_image
+    telemetry.observe('queue', time.time() - submitted)
+
+    # 调用detect_image函数处理图像，获取植株计数（检测在内存中完成，直接写出结果图片）
+    stats = {}  # 各阶段耗时、图片尺寸、数量和错误类型，记录到监控指标
+    count, error_message = detect_image(
+        app.config['UPLOAD_FOLDER'],
+        app.config['RESULT_FOLDER'],
+        filename,
+        app.config['MODEL_WEIGHTS'],
+        max_batch=app.config['DETECT_MAX_BATCH'],
+        max_wait_ms=app.config['DETECT_MAX_WAIT_MS'],
+        annotate=not app.config['LAZY_RENDER'],
+        buckets=app.config['SHAPE_BUCKETS'],
+        stats=stats
+    )
+    telemetry.observe_detection(stats)
+    if error_message:
+        raise RuntimeError(error_message)
+    return {'count': count, 'processed_file': 'processed_' + filename}
+
 @app.route('/process', methods=['POST'])
 def process():
     if 'uploaded_file' not in session:
+        if wants_json():
+            return jsonify({'error': '请先上传图片'}), 400
         flash('请先上传图片', 'error')
         return redirect(url_for('index'))
     
-    # 获取原始文件路径
-    src_path = os.path.join(app.config['UPLOAD_FOLDER'], session['uploaded_file'])
+    # 提交检测任务后立即返回任务ID，不再阻塞请求
+    try:
+        job = job_queue.submit(run_detection, session['uploaded_file'], time.time())
+    except QueueFull:
+        if wants_json():
+            return jsonify({'error': '服务器繁忙，请稍后重试'}), 503
+        flash('服务器繁忙，请稍后重试', 'error')
+        return redirect(url_for('index'))
+    session['job_id'] = job.id
     
-    # print(src_path) # static/files/b758a20a6d3740dda01556fa7030129d_Seed_0010.jpg
+    if wants_json():
+        return jsonify({
+            'id': job.id,
+            'status': job.status,
+            'status_url': url_for('job_status', job_id=job.id),
+            'result_url': url_for('job_result', job_id=job.id)
+        }), 202
+    return redirect(url_for('job_result', job_id=job.id))
 
-    # 导入detect模块中的detect_image函数
-    from model.detect import detect_image
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """查询任务状态（JSON）"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': '任务不存在或已过期'}), 404
     
-    # 调用detect_image函数处理图像，获取植株计数
-    count = detect_image(
-        app.config['UPLOAD_FOLDER'],
-        app.config['RESULT_FOLDER'], 
-        session['uploaded_file'],
-        app.config['MODEL_WEIGHTS']
-    )
+    data = job.to_dict()
+    data['position'] = job_queue.position(job)
+    if job.status == 'done':
+        data.update(job.result)
+        data['image_url'] = url_for('job_image', job_id=job.id)
+    return jsonify(data)
+
+@app.route('/jobs/<job_id>/image')
+def job_image(job_id):
+    """任务的标注图片，只计数的任务在第一次请求时绘制"""
+    job = job_queue.get(job_id)
+    if job is None or job.status != 'done':
+        return jsonify({'error': '任务不存在或未完成'}), 404
     
-    # 生成处理后文件名
-    result_filename = 'processed_' + session['uploaded_file']
+    path, error_message = ensure_result_image(job.result['processed_file'])
+    if error_message:
+        return jsonify({'error': error_message}), 500
+    return send_file(path)
+
+def ensure_result_image(processed_file):
+    """返回标注图片路径，尚未绘制时（只计数的识别）现在绘制"""
+    from model.detect import render_image
+    if os.path.exists(os.path.join(app.config['RESULT_FOLDER'], processed_file)):
+        return os.path.join(app.config['RESULT_FOLDER'], processed_file), None
+    with telemetry.timer('render'):
+        return render_image(app.config['UPLOAD_FOLDER'], app.config['RESULT_FOLDER'], processed_file[len('processed_'):])
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    """任务结果：完成后跳转到结果页面，未完成时显示等待页面并轮询任务状态"""
+    job = job_queue.get(job_id)
+    if job is None:
+        flash('任务不存在或已过期', 'error')
+        return redirect(url_for('index'))
+    
+    if not job.done:
+        return render_template('processing.html', job_id=job.id,
+                               status_url=url_for('job_status', job_id=job.id),
+                               result_url=url_for('job_result', job_id=job.id)), 202
+    
+    if job.status == 'failed':
+        flash(job.error, 'error')
+        return redirect(url_for('index'))
+    
+    count = job.result['count']
     
     # 保存结果文件名到session
-    session['processed_file'] = result_filename
+    session['processed_file'] = job.result['processed_file']
     
     # 保存植株计数结果到session
     session['plant_count'] = count
@@ -183,6 +236,11 @@ def result():
         flash('请先上传并处理图片', 'error')
         return redirect(url_for('index'))
     
+    # 只计数的识别没有立即生成标注图片，第一次查看结果时再绘制
+    _, error_message = ensure_result_image(session['processed_file'])
+    if error_message:
+        flash(error_message, 'error')
+    
     image_url = url_for('static', filename=f'images/{session["processed_file"]}')
     # 从session中获取植株计数结果
     plant_count = session.get('plant_count', 0)
@@ -190,4 +248,9 @@ def result():
     return render_template('result.html', image_url=image_url, cnt=plant_count)
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    debug = True
+    # 启动时预加载并预热模型，后续请求复用同一个模型（debug模式下只在重载子进程中加载）
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        from model.detect import preload
+        preload(app.config['MODEL_WEIGHTS'], buckets=app.config['SHAPE_BUCKETS'])
+    app.run(debug=debug, threaded=True)
\ No newline at end of file
@@ -0,0 +1,68 @@
+"""
+上传图片预处理：尺寸调整和格式转换
+
+不依赖Flask，导入时不创建应用、线程或目录，app.py和model/benchmarks.py共用
+"""
+import io
+
+from PIL import Image
+
+
+def resize_image_bytes(data, file_ext, max_size=2048):
+    """
+    在内存中检查图像尺寸，如果超过最大尺寸，则调整到最大尺寸，不读写任何文件
+    
+    Args:
+        data: 图像文件内容（bytes）
+        file_ext: 保存格式对应的扩展名，例如'.jpg'
+        max_size: 最大尺寸（宽和高），为None时不缩放，只做格式转换
+    
+    Returns:
+        tuple: (调整后的图像内容, 是否调整了图像)，未调整或出错时返回原内容
+    """
+    try:
+        img = Image.open(io.BytesIO(data))
+        original_mode = img.mode
+        width, height = img.size
+        resized = False
+        format_converted = False
+        
+        # 检查图像尺寸是否超过最大尺寸
+        if max_size and (width > max_size or height > max_size):
+            # 计算缩放比例
+            ratio = min(max_size / width, max_size / height)
+            new_width = int(width * ratio)
+            new_height = int(height * ratio)
+            
+            # 调整图像尺寸
+            img = img.resize((new_width, new_height), Image.LANCZOS)
+            resized = True
+        
+        # 处理图片格式问题
+        file_ext = file_ext.lower()
+        
+        # 如果是PNG格式且有透明通道
+        if img.mode == 'RGBA':
+            # 要保存为JPG或需要调整大小，需要转换为RGB
+            if file_ext == '.jpg' or file_ext == '.jpeg' or resized:
+                # 创建一个白色背景
+                background = Image.new('RGB', img.size, (255, 255, 255))
+                # 将原图与白色背景合成
+                background.paste(img, mask=img.split()[3])  # 使用alpha通道作为蒙版
+                img = background
+                format_converted = True
+        # 其他格式转换为RGB（例如P模式等）
+        elif img.mode != 'RGB' and (file_ext == '.jpg' or file_ext == '.jpeg' or resized):
+            img = img.convert('RGB')
+            format_converted = True
+        
+        # 如果图片被调整大小或格式被转换，按扩展名对应的格式重新编码
+        if resized or format_converted:
+            buffer = io.BytesIO()
+            img.save(buffer, format=Image.registered_extensions().get(file_ext, img.format))
+            return buffer.getvalue(), True
+        return data, False
+    except Exception as e:
+        print(f"调整图像尺寸时出错: {e}")
+        return data, False
+
@@ -0,0 +1,106 @@
+"""
+后台检测任务队列：提交任务后立即返回任务ID，由固定数量的后台线程执行检测，
+所有线程共享同一个已加载的模型（见 model/utils/registry.py）
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QueueFull(Exception):
+    """等待中的任务数已达上限"""
+
+
+class Job:
+    """单个检测任务的状态"""
+    def __init__(self, job_id):
+        self.id = job_id
+        self.status = 'queued'  # queued, running, done, failed
+        self.result = None  # 任务函数的返回值
+        self.error = None  # 任务函数抛出的异常信息
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    @property
+    def done(self):
+        return self.status in ('done', 'failed')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'error': self.error,
+            'queued_seconds': round((self.started or time.time()) - self.created, 3),
+            'run_seconds': round((self.finished or time.time()) - self.started, 3) if self.started else None}
+
+
+class JobQueue:
+    """有界的后台任务队列
+
+    Args:
+        workers: 后台工作线程数
+        max_pending: 最多等待中的任务数，超过时submit()抛出QueueFull
+        max_jobs: 最多保留的任务记录数，超过时丢弃最早完成的任务
+    """
+    def __init__(self, workers=2, max_pending=32, max_jobs=1000):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='detect')
+        self.max_pending = max_pending
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()  # id -> Job
+        self.pending = 0
+        self.running = 0
+        self.lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        """提交任务，立即返回Job"""
+        with self.lock:
+            if self.pending >= self.max_pending:
+                raise QueueFull(f'等待中的任务已达上限 {self.max_pending}')
+            job = Job(uuid.uuid4().hex)
+            self.jobs[job.id] = job
+            self.pending += 1
+            self._trim()
+        self.executor.submit(self._run, job, func, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        """按ID获取任务，不存在时返回None"""
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def position(self, job):
+        """任务在等待队列中的位置（从1开始），未在等待时返回0"""
+        with self.lock:
+            if job.status != 'queued':
+                return 0
+            queued = [j for j in self.jobs.values() if j.status == 'queued']
+            return queued.index(job) + 1 if job in queued else 0
+
+    def _run(self, job, func, args, kwargs):
+        with self.lock:
+            self.pending -= 1
+            self.running += 1
+        job.status, job.started = 'running', time.time()
+        try:
+            job.result = func(*args, **kwargs)
+            job.status = 'done'
+        except Exception as e:
+            job.error = str(e)
+            job.status = 'failed'
+        finally:
+            with self.lock:
+                self.running -= 1
+        job.finished = time.time()
+
+    def _trim(self):
+        # 丢弃最早完成的任务记录，等待中和运行中的任务始终保留
+        if len(self.jobs) <= self.max_jobs:
+            return
+        for job_id in [k for k, j in self.jobs.items() if j.done][:len(self.jobs) - self.max_jobs]:
+            del self.jobs[job_id]
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,311 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+End-to-end latency benchmark of the serving pipeline with per-stage p50/p95 times, peak RSS and regression baselines
+
+Runs a fixed image corpus through the same stages as the web app for every combination of image size, plant density,
+backend and thread count:
+    load        model load, export and warmup (once per backend, thread count, image size and density)
+    read        read the uploaded file
+    resize      images.resize_image_bytes() on the upload bytes as app.py does (skipped if PIL is missing)
+    decode      cv2.imdecode()
+    preprocess, inference, nms, render, encode      DetectionSession.detect() timings, tiled above --max-size
+    write       annotated image write_atomic() and the CSV/JSON DetectionWriter
+    total       sum of all per-image stages
+
+Each backend and thread count runs in its own process, so peak RSS and thread pools are measured in isolation.
+Plant densities are the subfolders of --source (i.e. corpus/sparse, corpus/dense), or 'all' without subfolders.
+Image sizes are the long side in pixels, images are only ever downscaled, 'native' keeps the original resolution.
+
+Backends:
+    pt           PyTorch
+    torchscript  TorchScript export
+    onnx         ONNX Runtime on the cached export (YOLOv5_BACKEND=onnx)
+    openvino     OpenVINO export, runs on OpenVINO's own thread pool
+
+Usage:
+    $ python benchmarks.py --weights yolov5_best.pt --source ../bench/corpus --output bench.json
+    $ python benchmarks.py --weights yolov5_best.pt --source ../bench/corpus --backends pt onnx --threads 1 4 \
+                           --sizes 1024 2048 native --baseline bench_baseline.json  # exit 1 on regressions
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import psutil
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[0]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
+
+from utils.dataloaders import IMG_FORMATS
+from utils.general import LOGGER, colorstr, cv2, print_args
+
+PREFIX = colorstr('Benchmarks:')
+BACKENDS = 'pt', 'torchscript', 'onnx', 'openvino'
+STAGES = 'load', 'read', 'resize', 'decode', 'preprocess', 'inference', 'nms', 'render', 'encode', 'write', 'total'
+
+
+def peak_rss_mb():
+    # Peak resident set size of this process in MB
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / 2 ** 20 if platform.system() == 'Darwin' else rss / 2 ** 10  # bytes on macOS, KB on Linux
+    except ImportError:  # Windows
+        return psutil.Process().memory_info().peak_wset / 2 ** 20
+
+
+def corpus(source, sizes, save_dir):
+    # Resized copies of the corpus as {size: {density: [files]}}, images are never upscaled
+    source = Path(source)
+    groups = {d.name: d for d in sorted(source.iterdir()) if d.is_dir() and not d.name.startswith('.')}
+    groups = groups or {'all': source}  # no density subfolders
+    out = {}
+    for s in sizes:
+        out[str(s)] = {}
+        for density, d in groups.items():
+            files = sorted(f for f in d.iterdir() if f.suffix[1:].lower() in IMG_FORMATS)
+            dst = Path(save_dir) / str(s) / density
+            dst.mkdir(parents=True, exist_ok=True)
+            for f in files:
+                im = cv2.imread(str(f))
+                r = 1 if s == 'native' else min(int(s) / max(im.shape[:2]), 1)
+                if r < 1:
+                    im = cv2.resize(im, (round(im.shape[1] * r), round(im.shape[0] * r)), interpolation=cv2.INTER_AREA)
+                cv2.imwrite(str(dst / f.name), im)
+            out[str(s)][density] = [str(dst / f.name) for f in files]
+    return out
+
+
+def export_backend(weights, backend, imgsz):
+    # Weights file for backend, exporting TorchScript and OpenVINO models with export.py
+    if backend in ('pt', 'onnx'):
+        return str(weights)  # ONNX Runtime exports and caches through utils/onnx_backend.py
+    from export import run as export_run
+    return export_run(weights=weights, imgsz=imgsz, include=(backend, ))[-1]
+
+
+def bench(weights, backend, threads, files, imgsz, max_size, tile_size, warmup, runs, save_dir):
+    """
+    Worker: per-stage times of every image in files, runs in a fresh process per backend and thread count
+
+    Returns:
+        dict: {'<size>/<density>': {stage: [ms, ...]}, ...} and 'peak_rss_mb'
+    """
+    import torch
+
+    from detect import DetectionSession
+    from utils.files import write_atomic
+    from utils.general import Profile
+    from utils.registry import evict, load_model
+    from utils.writers import DetectionWriter
+
+    if threads:
+        torch.set_num_threads(threads)
+    try:
+        sys.path.insert(0, str(FILE.parents[1]))  # images.py, side-effect free unlike app.py
+        from images import resize_image_bytes
+    except Exception as e:
+        LOGGER.warning(f'{PREFIX} WARNING ⚠️ resize stage skipped, images.py import failed: {e}')
+        resize_image_bytes = None
+
+    session = DetectionSession(weights, imgsz=imgsz, device='cpu', max_size=max_size, tile_size=tile_size, cache=False)
+    results = {}
+    for size, densities in files.items():
+        for density, images in densities.items():
+            times = {k: [] for k in STAGES}
+            t = Profile()
+            with t:
+                evict(weights, device='cpu')
+                names = load_model(weights, device='cpu', imgsz=imgsz).names  # load, export if needed, warmup
+            times['load'].append(t.t * 1E3)
+            d = Path(save_dir) / f'{backend}_{threads}' / size / density
+            d.mkdir(parents=True, exist_ok=True)
+            with DetectionWriter(d, names, formats=('csv', 'json')) as writer:
+                for f in images:
+                    for i in range(warmup + runs):
+                        dt = {k: Profile() for k in ('read', 'resize', 'decode', 'write')}
+                        if not resize_image_bytes:
+                            del dt['resize']
+                        upload = Path(f)
+                        with dt['read']:
+                            data = upload.read_bytes()
+                        if 'resize' in dt:
+                            with dt['resize']:
+                                data = resize_image_bytes(data, upload.suffix, max_size=None if max_size else 2048)[0]
+                        with dt['decode']:
+                            im0 = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)  # BGR
+                        result = session.detect(im0, annotate=True, ext=upload.suffix)
+                        with dt['write']:
+                            write_atomic(d / f'processed_{upload.name}', result.image)
+                            writer.write(upload.name, result.boxes, result.shape)
+                            writer.flush()
+                        if i >= warmup:
+                            ms = {**{k: v.t * 1E3 for k, v in dt.items()}, **result.timings}
+                            for k, v in ms.items():
+                                times[k].append(v)
+                            times['total'].append(sum(ms.values()))
+            results[f'{size}/{density}'] = {k: v for k, v in times.items() if v}
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+def summarize(times):
+    # {stage: [ms, ...]} to {stage: {'p50': ms, 'p95': ms}}
+    return {k: {'p50': float(np.percentile(v, 50)), 'p95': float(np.percentile(v, 95))} for k, v in times.items()}
+
+
+def compare(results, baseline, tolerance=0.1, min_ms=1.0):
+    """
+    Regressions of results against baseline, a list of messages
+
+    A stage time regresses when it is slower than the baseline by more than tolerance (fraction) and by more than
+    min_ms milliseconds, peak RSS regresses when it grows by more than tolerance.
+    """
+    base = {(r['backend'], r['threads'], r['size'], r['density']): r for r in baseline['results']}
+    regressions = []
+    for r in results['results']:
+        k = r['backend'], r['threads'], r['size'], r['density']
+        b = base.get(k)
+        if b is None:
+            continue  # new configuration, nothing to compare with
+        name = '{} threads={} size={} density={}'.format(*k)
+        for stage, p in r['stages'].items():
+            for q in 'p50', 'p95':
+                old, new = b['stages'].get(stage, {}).get(q), p[q]
+                if old is not None and new > old * (1 + tolerance) and new - old > min_ms:
+                    regressions.append(f'{name} {stage} {q} {old:.1f}ms -> {new:.1f}ms ({new / old - 1:+.0%})')
+        old, new = b['peak_rss_mb'], r['peak_rss_mb']
+        if new > old * (1 + tolerance):
+            regressions.append(f'{name} peak RSS {old:.0f}MB -> {new:.0f}MB ({new / old - 1:+.0%})')
+    return regressions
+
+
+def run(
+        weights=ROOT / 'yolov5s.pt',  # weights path
+        source=ROOT / 'data/images',  # image corpus, subfolders are plant densities
+        sizes=(1024, 2048, 'native'),  # image long side in pixels, 'native' for the original resolution
+        backends=('pt', 'onnx'),  # pt, torchscript, onnx and/or openvino
+        threads=(0, ),  # intra-op threads, 0 for the library default
+        imgsz=(640, 640),  # inference size (height, width)
+        max_size=2048,  # images larger than this are tiled, 0 to never tile
+        tile_size=640,  # tile size in original pixels
+        warmup=1,  # untimed runs per image
+        runs=3,  # timed runs per image
+        output='benchmarks.json',  # results JSON
+        baseline='',  # baseline JSON to compare against, exit 1 on regressions
+        tolerance=0.1,  # allowed slowdown fraction
+        min_ms=1.0,  # slowdowns below this many milliseconds are noise
+):
+    imgsz = list(imgsz) * (3 - len(imgsz))  # expand
+    results = {
+        'meta': {
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpu': platform.processor(),
+            'cores': psutil.cpu_count(logical=False),
+            'weights': str(weights),
+            'imgsz': imgsz},
+        'results': []}
+    with tempfile.TemporaryDirectory() as tmp:
+        files = corpus(source, sizes, Path(tmp) / 'corpus')
+        for backend in backends:
+            w = export_backend(weights, backend, imgsz)
+            for n in threads:
+                LOGGER.info(f'{PREFIX} {backend} with {n or "default"} threads...')
+                env = dict(os.environ, YOLOv5_BACKEND='onnx' if backend == 'onnx' else 'pt')
+                if n:
+                    env.update(OMP_NUM_THREADS=str(n), MKL_NUM_THREADS=str(n), YOLOv5_ORT_THREADS=str(n))
+                config = Path(tmp) / 'config.json'
+                config.write_text(
+                    json.dumps({
+                        'weights': w,
+                        'backend': backend,
+                        'threads': n,
+                        'files': files,
+                        'imgsz': imgsz,
+                        'max_size': max_size,
+                        'tile_size': tile_size,
+                        'warmup': warmup,
+                        'runs': runs,
+                        'save_dir': str(Path(tmp) / 'runs')}))
+                subprocess.run([sys.executable, str(FILE), '--worker', str(config)], env=env, check=True)
+                times = json.loads(config.with_suffix('.out.json').read_text())
+                rss = times.pop('peak_rss_mb')
+                for k, v in times.items():
+                    size, density = k.split('/')
+                    results['results'].append({
+                        'backend': backend,
+                        'threads': n,
+                        'size': size,
+                        'density': density,
+                        'images': len(files[size][density]),
+                        'stages': summarize(v),
+                        'peak_rss_mb': rss})
+
+    Path(output).write_text(json.dumps(results, indent=2))
+    LOGGER.info(f"\n{PREFIX} {'backend':<12}{'threads':>8}{'size':>8}{'density':>10}"
+                f"{'total p50':>11}{'p95':>9}{'infer p50':>11}{'RSS MB':>9}")
+    for r in results['results']:
+        s = r['stages']
+        LOGGER.info(f"{PREFIX} {r['backend']:<12}{r['threads']:>8}{r['size']:>8}{r['density']:>10}"
+                    f"{s['total']['p50']:>11.1f}{s['total']['p95']:>9.1f}{s['inference']['p50']:>11.1f}"
+                    f"{r['peak_rss_mb']:>9.0f}")
+    LOGGER.info(f"{PREFIX} results saved to {colorstr('bold', output)}")
+
+    if baseline:
+        regressions = compare(results, json.loads(Path(baseline).read_text()), tolerance, min_ms)
+        for x in regressions:
+            LOGGER.warning(f'{PREFIX} REGRESSION ❌ {x}')
+        LOGGER.info(f'{PREFIX} {len(regressions)} regressions against {baseline}')
+        results['regressions'] = regressions
+    return results
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', type=str, default=ROOT / 'yolov5s.pt', help='weights path')
+    parser.add_argument('--source', type=str, default=ROOT / 'data/images', help='image corpus, subfolders = densities')
+    parser.add_argument('--sizes', nargs='+', default=[1024, 2048, 'native'], help='image long side or native')
+    parser.add_argument('--backends', nargs='+', default=['pt', 'onnx'], choices=BACKENDS, help='backends')
+    parser.add_argument('--threads', nargs='+', type=int, default=[0], help='intra-op threads, 0 for default')
+    parser.add_argument('--imgsz', '--img', '--img-size', nargs='+', type=int, default=[640], help='inference size h,w')
+    parser.add_argument('--max-size', type=int, default=2048, help='tile images larger than this, 0 to never tile')
+    parser.add_argument('--tile-size', type=int, default=640, help='tile size in original pixels')
+    parser.add_argument('--warmup', type=int, default=1, help='untimed runs per image')
+    parser.add_argument('--runs', type=int, default=3, help='timed runs per image')
+    parser.add_argument('--output', type=str, default='benchmarks.json', help='results JSON')
+    parser.add_argument('--baseline', type=str, default='', help='baseline JSON, exit 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed slowdown fraction')
+    parser.add_argument('--min-ms', type=float, default=1.0, help='ignore slowdowns below this many milliseconds')
+    parser.add_argument('--worker', type=str, default='', help=argparse.SUPPRESS)  # internal: config JSON
+    opt = parser.parse_args()
+    if not opt.worker:
+        print_args(vars(opt))
+    return opt
+
+
+def main(opt):
+    if opt.worker:  # one backend and thread count in a fresh process
+        config = Path(opt.worker)
+        config.with_suffix('.out.json').write_text(json.dumps(bench(**json.loads(config.read_text()))))
+        return
+    results = run(**{k: v for k, v in vars(opt).items() if k != 'worker'})
+    if results.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    main(opt)
@@ -29,13 +29,14 @@ Usage - formats:
 """
 
 import argparse
-import csv
+import io
+import itertools
 import os
 import platform
 import sys
 from pathlib import Path
-import shutil
 
+import numpy as np
 import torch
 
 FILE = Path(__file__).resolve()
@@ -50,13 +51,36 @@ except ValueError:
     # 如果在不同驱动器上，则使用绝对路径
     ROOT = Path(os.path.abspath(ROOT))
 
-from ultralytics.utils.plotting import Annotator, colors, save_one_box
+from ultralytics.utils.plotting import save_one_box
 
-from models.common import DetectMultiBackend
-from utils.dataloaders import IMG_FORMATS, VID_FORMATS, LoadImages, LoadScreenshots, LoadStreams
+from utils.buckets import parse_buckets
+from utils.cache import RESULT_CACHE
+from utils.files import write_atomic
+from utils.dataloaders import IMG_FORMATS, VID_FORMATS, LoadImages, LoadRasterWindows, LoadScreenshots, LoadStreams
 from utils.general import (LOGGER, Profile, check_file, check_img_size, check_imshow, check_requirements, colorstr, cv2,
-                           increment_path, non_max_suppression, print_args, scale_boxes, strip_optimizer, xyxy2xywh)
-from utils.torch_utils import select_device, smart_inference_mode
+                           increment_path, non_max_suppression, print_args, scale_boxes, strip_optimizer)
+from utils.preprocess import Preprocessor
+from utils.registry import evict, load_model, load_scheduler, preload, warmup
+from utils.render import render_detections
+from utils.tiling import merge_tiles, own_boxes, tile_windows
+from utils.torch_utils import smart_inference_mode
+from utils.writers import DetectionWriter
+
+
+def dynamic_line_params(shape, line_thickness=3):
+    # 根据图片尺寸动态调整线条粗细和字体大小, shape=(h, w, ...)
+    img_area = shape[0] * shape[1]  # 图片面积
+    # 基础线条粗细为3，根据图片面积按比例调整
+    if img_area > 4096*4096:  # 大于2M像素（例如1600x1250）
+        dynamic_line_thickness = max(10, int(line_thickness * 5))
+        dynamic_font_size = max(24, int(16 * 2))  # 增大字体
+    elif img_area > 2048*2048:  # 大于2M像素（例如1600x1250）
+        dynamic_line_thickness = max(10, int(line_thickness * 5))
+        dynamic_font_size = max(24, int(16 * 1.5))  # 增大字体
+    else:
+        dynamic_line_thickness = line_thickness
+        dynamic_font_size = 16  # 默认字体大小
+    return dynamic_line_thickness, dynamic_font_size
 
 
 @smart_inference_mode()
@@ -65,6 +89,7 @@ def run(
         source=ROOT / 'data/images',  # file/dir/URL/glob/screen/0(webcam)
         data=ROOT / 'data/coco128.yaml',  # dataset.yaml path
         imgsz=(640, 640),  # inference size (height, width)
+        buckets=None,  # input shapes WxH, i.e. '640x640,640x480,1024x768', images are padded into the nearest one
         conf_thres=0.25,  # confidence threshold
         iou_thres=0.45,  # NMS IOU threshold
         max_det=1000,  # maximum detections per image
@@ -72,11 +97,15 @@ def run(
         view_img=False,  # show results
         save_txt=False,  # save results to *.txt
         save_csv=False,  # save results in CSV format
+        save_json=False,  # save results to predictions.jsonl
+        save_npy=False,  # save (n, 6) results to *.npy
+        save_parquet=False,  # save results to predictions.parquet
         save_conf=False,  # save confidences in --save-txt labels
         save_crop=False,  # save cropped prediction boxes
         nosave=False,  # do not save images/videos
         classes=None,  # filter by class: --class 0, or --class 0 2 3
         agnostic_nms=False,  # class-agnostic NMS
+        dense=False,  # grid NMS without the max_det cap for dense fields: True/'iou' or 'center' (centre distance)
         augment=False,  # augmented inference
         visualize=False,  # visualize features
         update=False,  # update all models
@@ -86,8 +115,10 @@ def run(
         line_thickness=3,  # bounding box thickness (pixels)
         hide_labels=False,  # hide labels
         hide_conf=False,  # hide confidences
+        render='boxes',  # annotation style: boxes, centroids or heat
         half=False,  # use FP16 half-precision inference
         dnn=False,  # use OpenCV DNN for ONNX inference
+        compiled=False,  # run traced TorchScript graphs in channels_last (PyTorch weights)
         vid_stride=1,  # video frame-rate stride
 ):
     source = str(source)
@@ -103,11 +134,16 @@ def run(
     save_dir = increment_path(Path(project) / name, exist_ok=exist_ok)  # increment run
     (save_dir / 'labels' if save_txt else save_dir).mkdir(parents=True, exist_ok=True)  # make dir
 
-    # Load model
-    device = select_device(device)
-    model = DetectMultiBackend(weights, device=device, dnn=dnn, data=data, fp16=half)
-    stride, names, pt = model.stride, model.names, model.pt
+    # Load model (cached in the process-wide registry after the first call)
+    model = load_model(weights, device=device, half=half, dnn=dnn, data=data, imgsz=imgsz, compiled=compiled)
+    stride, names, pt = model.stride, model.names, model.pt and not compiled  # compiled graphs want fixed shapes
     imgsz = check_img_size(imgsz, s=stride)  # check image size
+    buckets = parse_buckets(buckets, s=stride)
+
+    # Results writer, one block per image and one write per flush instead of one file open per box
+    formats = [k for k, v in zip(('csv', 'txt', 'json', 'npy', 'parquet'),
+                                 (save_csv, save_txt, save_json, save_npy, save_parquet)) if v]
+    writer = DetectionWriter(save_dir, names, formats=formats, save_conf=save_conf)
 
     # Dataloader
     bs = 1  # batch_size
@@ -118,17 +154,24 @@ def run(
     elif screenshot:
         dataset = LoadScreenshots(source, img_size=imgsz, stride=stride, auto=pt)
     else:
-        dataset = LoadImages(source, img_size=imgsz, stride=stride, auto=pt, vid_stride=vid_stride)
+        pre = Preprocessor(imgsz, stride, auto=pt, buckets=buckets, device=model.device, half=model.fp16,
+                           uint8=model.uint8_input, bgr=model.bgr_input)
+        dataset = LoadImages(source, img_size=imgsz, stride=stride, auto=pt, transforms=pre, vid_stride=vid_stride)
     vid_path, vid_writer = [None] * bs, [None] * bs
 
     # Run inference
     model.warmup(imgsz=(1 if pt or model.triton else bs, 3, *imgsz))  # warmup
+    warmup(model, buckets)  # every shape bucket once
     seen, windows, dt = 0, [], (Profile(), Profile(), Profile())
     for path, im, im0s, vid_cap, s in dataset:
         with dt[0]:
-            im = torch.from_numpy(im).to(model.device)
-            im = im.half() if model.fp16 else im.float()  # uint8 to fp16/32
-            im /= 255  # 0 - 255 to 0.0 - 1.0
+            if not isinstance(im, torch.Tensor):  # streams and screenshots, LoadImages runs the Preprocessor
+                im = torch.from_numpy(im).to(model.device)
+                if model.uint8_input:  # normalization folded into the first Conv
+                    im = im.flip(-3) if model.bgr_input else im  # RGB to BGR
+                else:
+                    im = im.half() if model.fp16 else im.float()  # uint8 to fp16/32
+                    im /= 255  # 0 - 255 to 0.0 - 1.0
             if len(im.shape) == 3:
                 im = im[None]  # expand for batch dim
 
@@ -139,23 +182,11 @@ def run(
 
         # NMS
         with dt[2]:
-            pred = non_max_suppression(pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det)
+            pred = non_max_suppression(pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det, dense=dense)
 
         # Second-stage classifier (optional)
         # pred = utils.general.apply_classifier(pred, classifier_model, im, im0s)
 
-        # Define the path for the CSV file
-        csv_path = save_dir / 'predictions.csv'
-
-        # Create or append to the CSV file
-        def write_to_csv(image_name, prediction, confidence):
-            data = {'Image Name': image_name, 'Prediction': prediction, 'Confidence': confidence}
-            with open(csv_path, mode='a', newline='') as f:
-                writer = csv.DictWriter(f, fieldnames=data.keys())
-                if not csv_path.is_file():
-                    writer.writeheader()
-                writer.writerow(data)
-
         # Process predictions
         for i, det in enumerate(pred):  # per image
             seen += 1
@@ -167,26 +198,13 @@ def run(
 
             p = Path(p)  # to Path
             save_path = str(save_dir / p.name)  # im.jpg
-            txt_path = str(save_dir / 'labels' / p.stem) + ('' if dataset.mode == 'image' else f'_{frame}')  # im.txt
+            txt_stem = p.stem + ('' if dataset.mode == 'image' else f'_{frame}')  # im.txt
             s += '%gx%g ' % im.shape[2:]  # print string
-            gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
             imc = im0.copy() if save_crop else im0  # for save_crop
-            
+
             # 根据图片尺寸动态调整线条粗细和字体大小
-            img_area = im0.shape[0] * im0.shape[1]  # 图片面积
-            # 基础线条粗细为3，根据图片面积按比例调整
-            if img_area > 4096*4096:  # 大于2M像素（例如1600x1250）
-                dynamic_line_thickness = max(10, int(line_thickness * 5))
-                dynamic_font_size = max(24, int(16 * 2))  # 增大字体
-            elif img_area > 2048*2048:  # 大于2M像素（例如1600x1250）
-                dynamic_line_thickness = max(10, int(line_thickness * 5))
-                dynamic_font_size = max(24, int(16 * 1.5))  # 增大字体
-            else:
-                dynamic_line_thickness = line_thickness
-                dynamic_font_size = 16  # 默认字体大小
-            
-            # 创建带有动态参数的Annotator
-            annotator = Annotator(im0, line_width=dynamic_line_thickness, font_size=dynamic_font_size, example=str(names))
+            dynamic_line_thickness, dynamic_font_size = dynamic_line_params(im0.shape, line_thickness)
+
             if len(det):
                 # Rescale boxes from img_size to im0 size
                 det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], im0.shape).round()
@@ -196,31 +214,19 @@ def run(
                     n = (det[:, 5] == c).sum()  # detections per class
                     s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
 
-                # Write results
-                for *xyxy, conf, cls in reversed(det):
-                    c = int(cls)  # integer class
-                    label = names[c] if hide_conf else f'{names[c]}'
-                    confidence = float(conf)
-                    confidence_str = f'{confidence:.2f}'
-
-                    if save_csv:
-                        write_to_csv(p.name, label, confidence_str)
-
-                    if save_txt:  # Write to file
-                        xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
-                        line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
-                        with open(f'{txt_path}.txt', 'a') as f:
-                            f.write(('%g ' * len(line)).rstrip() % line + '\n')
-
-                    if save_img or save_crop or view_img:  # Add bbox to image
+                # Draw results, all boxes in one pass
+                if save_img or save_crop or view_img:
+                    render_detections(im0, det, names, render, dynamic_line_thickness, dynamic_font_size,
+                                      labels=not hide_labels and 'auto', hide_conf=hide_conf)
+                if save_crop:
+                    for *xyxy, conf, cls in reversed(det):
                         c = int(cls)  # integer class
-                        label = None if hide_labels else (names[c] if hide_conf else f'{names[c]} {conf:.2f}')
-                        annotator.box_label(xyxy, label, color=colors(c, True))
-                    if save_crop:
                         save_one_box(xyxy, imc, file=save_dir / 'crops' / names[c] / f'{p.stem}.jpg', BGR=True)
 
+            # Write results
+            writer.write(p.name, det, im0.shape, txt_stem)
+
             # Stream results
-            im0 = annotator.result()
             if view_img:
                 if platform.system() == 'Linux' and p not in windows:
                     windows.append(p)
@@ -252,6 +258,7 @@ def run(
         LOGGER.info(f"{s}{'' if len(det) else '(no detections), '}{dt[1].dt * 1E3:.1f}ms")
 
     # Print results
+    writer.close()
     t = tuple(x.t / seen * 1E3 for x in dt)  # speeds per image
     LOGGER.info(f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS per image at shape {(1, 3, *imgsz)}' % t)
     if save_txt or save_img:
@@ -268,6 +275,7 @@ def parse_opt():
     parser.add_argument('--source', type=str, default=ROOT / 'data/images', help='file/dir/URL/glob/screen/0(webcam)')
     parser.add_argument('--data', type=str, default=ROOT / 'data/coco128.yaml', help='(optional) dataset.yaml path')
     parser.add_argument('--imgsz', '--img', '--img-size', nargs='+', type=int, default=[640], help='inference size h,w')
+    parser.add_argument('--buckets', nargs='+', help='canonical input shapes WxH, i.e. --buckets 640x640 1024x768')
     parser.add_argument('--conf-thres', type=float, default=0.7, help='confidence threshold')
     parser.add_argument('--iou-thres', type=float, default=0.5, help='NMS IoU threshold')
     parser.add_argument('--max-det', type=int, default=1000, help='maximum detections per image')
@@ -275,11 +283,20 @@ def parse_opt():
     parser.add_argument('--view-img', action='store_true', help='show results')
     parser.add_argument('--save-txt', action='store_true', help='save results to *.txt')
     parser.add_argument('--save-csv', default=True, action='store_true', help='save results in CSV format')
+    parser.add_argument('--save-json', action='store_true', help='save results to predictions.jsonl')
+    parser.add_argument('--save-npy', action='store_true', help='save (n, 6) results to *.npy')
+    parser.add_argument('--save-parquet', action='store_true', help='save results to predictions.parquet')
     parser.add_argument('--save-conf', action='store_true', help='save confidences in --save-txt labels')
     parser.add_argument('--save-crop', action='store_true', help='save cropped prediction boxes')
     parser.add_argument('--nosave', action='store_true', help='do not save images/videos')
     parser.add_argument('--classes', nargs='+', type=int, help='filter by class: --classes 0, or --classes 0 2 3')
     parser.add_argument('--agnostic-nms', action='store_true', help='class-agnostic NMS')
+    parser.add_argument('--dense',
+                        nargs='?',
+                        const='iou',
+                        default=False,
+                        choices=('iou', 'center'),
+                        help='grid NMS without the --max-det cap for dense fields, suppress by IoU or centre distance')
     parser.add_argument('--augment', action='store_true', help='augmented inference')
     parser.add_argument('--visualize', action='store_true', help='visualize features')
     parser.add_argument('--update', action='store_true', help='update all models')
@@ -289,9 +306,13 @@ def parse_opt():
     parser.add_argument('--line-thickness', default=3, type=int, help='bounding box thickness (pixels)')
     parser.add_argument('--hide-labels', default=False, action='store_true', help='hide labels')
     parser.add_argument('--hide-conf', default=False, action='store_true', help='hide confidences')
+    parser.add_argument('--render', default='boxes', choices=('boxes', 'centroids', 'heat'), help='annotation style')
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
     parser.add_argument('--dnn', action='store_true', help='use OpenCV DNN for ONNX inference')
+    parser.add_argument('--compiled', action='store_true', help='run traced TorchScript graphs in channels_last')
     parser.add_argument('--vid-stride', type=int, default=1, help='video frame-rate stride')
+    parser.add_argument('--stream', action='store_true', help='count a raster larger than RAM window by window')
+    parser.add_argument('--max-memory', type=float, default=2.0, help='--stream memory budget (GB)')
     opt = parser.parse_args()
     opt.imgsz *= 2 if len(opt.imgsz) == 1 else 1  # expand
     print_args(vars(opt))
@@ -300,10 +321,337 @@ def parse_opt():
 
 def main(opt):
     check_requirements(ROOT / 'requirements.txt', exclude=('tensorboard', 'thop'))
-    run(**vars(opt))
+    opt = vars(opt)
+    stream, max_memory = opt.pop('stream'), opt.pop('max_memory')
+    if stream:  # out-of-core orthomosaic counting
+        keys = ('weights', 'imgsz', 'conf_thres', 'iou_thres', 'max_det', 'device', 'classes', 'agnostic_nms', 'dense',
+                'half', 'dnn')
+        stream_count(opt['source'], max_memory=int(max_memory * (1 << 30)), **{k: opt[k] for k in keys})
+    else:
+        run(**opt)
+
+
+class DetectionResult:
+    # In-memory detections for one image, boxes are (n, 6) [xyxy, conf, cls] in original image pixels
+    def __init__(self, boxes, names, shape, timings, image=None):
+        self.boxes = boxes  # np.ndarray (n, 6)
+        self.names = names  # class names
+        self.shape = shape  # original image shape (h, w)
+        self.timings = timings  # dict of stage -> milliseconds
+        self.image = image  # encoded annotated image (bytes) or None
+
+    @property
+    def count(self):
+        return len(self.boxes)
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        t = ', '.join(f'{k} {v:.1f}ms' for k, v in self.timings.items())
+        return f'DetectionResult({self.count} detections, {self.shape[1]}x{self.shape[0]}, {t})'
+
+
+@smart_inference_mode()
+def detect(
+        source,  # BGR np.ndarray (HWC), encoded image bytes or image file path
+        weights=ROOT / 'yolov5s.pt',  # model path
+        imgsz=(640, 640),  # inference size (height, width)
+        buckets=None,  # input shapes WxH, i.e. '640x640,640x480,1024x768', images are padded into the nearest one
+        conf_thres=0.7,  # confidence threshold
+        iou_thres=0.5,  # NMS IOU threshold
+        max_det=1000,  # maximum detections per image
+        device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+        classes=None,  # filter by class: --class 0, or --class 0 2 3
+        agnostic_nms=False,  # class-agnostic NMS
+        dense=False,  # grid NMS without the max_det cap for dense fields: True/'iou' or 'center' (centre distance)
+        half=False,  # use FP16 half-precision inference
+        dnn=False,  # use OpenCV DNN for ONNX inference
+        compiled=False,  # run traced TorchScript graphs in channels_last (PyTorch weights)
+        tile=0,  # sliced inference tile size in original pixels, 0 to letterbox the whole image instead
+        max_size=0,  # only slice images whose longest side exceeds this, 0 to always slice when tile > 0
+        tile_overlap=0.2,  # fractional overlap between neighbouring tiles
+        tile_batch=8,  # tiles per forward pass
+        max_batch=1,  # >1 to share batched forward passes with concurrent callers (micro-batching)
+        max_wait_ms=10,  # micro-batching: how long to wait for other callers before running a batch
+        annotate=True,  # render and encode the annotated image into result.image
+        ext='.jpg',  # encoding of result.image
+        line_thickness=3,  # bounding box thickness (pixels)
+        hide_labels=False,  # hide labels
+        hide_conf=False,  # hide confidences
+        render='boxes',  # annotation style: boxes, centroids or heat
+        cache=False,  # reuse results for identical image content, weights and parameters (see utils/cache.py)
+):
+    """
+    Run detection on a single image. Bytes and paths are decoded only on a cache miss, so hits cost one hash of the
+    encoded bytes (or a memoized file hash) instead of a decode and a hash of the pixels.
+
+    Returns:
+        DetectionResult: boxes (n, 6), count, per-stage timings and the optional encoded annotated image
+    """
+    if cache:
+        args = dict(locals(), cache=False)
+        t = Profile()
+        with t:
+            skip = 'source', 'weights', 'device', 'cache', 'max_batch', 'max_wait_ms', 'compiled'  # same results
+            key = RESULT_CACHE.key(source, weights, **{k: v for k, v in args.items() if k not in skip})
+            result, hit = RESULT_CACHE.get_or_compute(key, lambda: detect(**args))
+        if hit:
+            return DetectionResult(result.boxes, result.names, result.shape, {'cache': t.t * 1E3}, result.image)
+        return result
+
+    dt = {k: Profile() for k in ('decode', 'preprocess', 'inference', 'nms', 'render', 'encode')}
+    with dt['decode']:
+        if isinstance(source, (str, Path)):
+            im0 = cv2.imread(str(source))  # BGR
+            if im0 is None:
+                raise FileNotFoundError(f'Image Not Found {source}')
+        elif isinstance(source, (bytes, bytearray, memoryview)):
+            im0 = cv2.imdecode(np.frombuffer(source, np.uint8), cv2.IMREAD_COLOR)  # BGR
+        else:
+            im0 = source
+        assert isinstance(im0, np.ndarray) and im0.ndim == 3, 'source must be a BGR HWC image, image bytes or a path'
+        if max_size and max(im0.shape[:2]) <= max_size:
+            tile = 0  # small enough to letterbox whole
+
+    model = load_model(weights, device=device, half=half, dnn=dnn, imgsz=imgsz, compiled=compiled)
+    stride, names, pt = model.stride, model.names, model.pt and not compiled  # compiled graphs want fixed shapes
+    imgsz = check_img_size(imgsz, s=stride)  # check image size
+    buckets = parse_buckets(buckets, s=stride)
+    warmup(model, buckets)  # no-op once every bucket has run
+    scheduler = load_scheduler(weights, device=device, half=half, dnn=dnn, imgsz=imgsz, max_batch=max_batch,
+                               max_wait_ms=max_wait_ms, compiled=compiled) if max_batch > 1 else None
+    nms_args = conf_thres, iou_thres, classes, agnostic_nms, max_det, dense
+    pre = Preprocessor(imgsz, stride, auto=pt and not scheduler, buckets=buckets, device=model.device,
+                       half=model.fp16, uint8=model.uint8_input, bgr=model.bgr_input)  # fixed shape when batched
+
+    if tile:  # sliced inference at native resolution
+        windows, cores = tile_windows(im0.shape, tile, tile_overlap)
+        dets = []
+        for b in range(0, len(windows), tile_batch):
+            with dt['preprocess']:
+                crops = [im0[y1:y2, x1:x2] for x1, y1, x2, y2 in windows[b:b + tile_batch]]  # views
+                im, ratio_pad = pre.letterbox(crops, imgsz)  # same shape
+
+            if scheduler:  # forward pass and NMS batched together with other callers' images
+                with dt['inference']:
+                    pred = [f.result() for f in [scheduler.submit(x, *nms_args) for x in im]]
+            else:
+                with dt['inference']:
+                    pred = model(im)  # one forward pass per batch of tiles
+                with dt['nms']:
+                    pred = non_max_suppression(pred, *nms_args[:4], max_det=max_det, dense=dense)
+
+            with dt['nms']:
+                for det, crop, rp in zip(pred, crops, ratio_pad):
+                    det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], crop.shape, rp)
+                    dets.append(det)
+
+        with dt['nms']:
+            det = merge_tiles(dets, windows, cores, iou_thres, agnostic_nms, dense=dense)  # global coordinates
+            det[:, :4] = det[:, :4].round()
+            boxes = det.cpu().numpy()
+    else:
+        with dt['preprocess']:
+            im, ratio_pad = pre.letterbox([im0])  # padded into the nearest shape bucket if any
+
+        if scheduler:  # forward pass and NMS batched together with other callers' images
+            with dt['inference']:
+                det = scheduler(im[0], *nms_args)
+        else:
+            with dt['inference']:
+                pred = model(im)
+            with dt['nms']:
+                det = non_max_suppression(pred, *nms_args[:4], max_det=max_det, dense=dense)[0]
+
+        with dt['nms']:
+            det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], im0.shape, ratio_pad[0]).round()
+            boxes = det.cpu().numpy()
+
+    image = None
+    if annotate:
+        with dt['render']:
+            lw, fs = dynamic_line_params(im0.shape, line_thickness)
+            annotated = render_detections(im0.copy(), boxes, names, render, lw, fs,
+                                          labels=not hide_labels and 'auto', hide_conf=hide_conf)
+        with dt['encode']:
+            image = cv2.imencode(ext, annotated)[1].tobytes()
+
+    timings = {k: v.t * 1E3 for k, v in dt.items() if v.t}
+    return DetectionResult(boxes, names, im0.shape[:2], timings, image)
+
+
+@smart_inference_mode()
+def stream_count(
+        source,  # raster larger than RAM, i.e. orthomosaic.tif (tiled TIFF/BigTIFF, JPEG, PNG)
+        weights=ROOT / 'yolov5s.pt',  # model path
+        save_path=None,  # detections CSV, default <source>_detections.csv
+        imgsz=(640, 640),  # inference size (height, width)
+        conf_thres=0.7,  # confidence threshold
+        iou_thres=0.5,  # NMS IOU threshold
+        max_det=1000,  # maximum detections per tile
+        device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+        classes=None,  # filter by class: --class 0, or --class 0 2 3
+        agnostic_nms=False,  # class-agnostic NMS
+        dense=False,  # grid NMS without the max_det cap for dense fields: True/'iou' or 'center' (centre distance)
+        half=False,  # use FP16 half-precision inference
+        dnn=False,  # use OpenCV DNN for ONNX inference
+        tile=640,  # tile size in original pixels
+        tile_overlap=0.2,  # fractional overlap between neighbouring tiles
+        max_memory=2 << 30,  # memory budget (bytes) for the GDAL cache, decoded windows and input tensors
+):
+    """
+    Count plants in a raster that does not fit in memory. Windows are decoded one at a time and fed to the detector in
+    batches sized to max_memory, detections are appended to a CSV file after every batch.
 
+    Returns:
+        tuple: (count, save_path)
+    """
+    model = load_model(weights, device=device, half=half, dnn=dnn, imgsz=imgsz)
+    stride = model.stride
+    imgsz = check_img_size(imgsz, s=stride)  # check image size
 
-def detect_image(upload_folder, result_folder, filename, model_weights):
+    # Memory budget: 1/4 GDAL block cache, the rest for batches of uint8 windows plus uint8 staging and input buffers
+    cache = max_memory // 4
+    per_tile = tile * tile * 3 + 3 * imgsz[0] * imgsz[1] * (1 + (1 if model.uint8_input else 2 if model.fp16 else 4))
+    batch = int(max(1, min(64, (max_memory - cache) // per_tile)))
+    dataset = LoadRasterWindows(source, tile, tile_overlap, cache_mb=max(cache >> 20, 16))
+    a, b, c, d, e, f = (dataset.transform[i] for i in range(6))  # affine pixel to map transform
+    save_path = Path(save_path or Path(source).with_name(f'{Path(source).stem}_detections.csv'))
+    LOGGER.info(f'{source}: {dataset.shape[1]}x{dataset.shape[0]} pixels, {len(dataset)} windows, batch {batch}')
+    pre = Preprocessor(imgsz, stride, device=model.device, half=model.fp16, uint8=model.uint8_input,
+                       bgr=model.bgr_input)
+
+    count, seen, dt = 0, 0, (Profile(), Profile(), Profile())
+    it = iter(dataset)
+    with open(save_path, 'w', newline='') as fw:
+        fw.write('x1,y1,x2,y2,confidence,class,x_map,y_map\n')
+        while True:
+            with dt[0]:
+                chunk = list(itertools.islice(it, batch))  # decode at most one batch of windows
+                if not chunk:
+                    break
+                im, ratio_pad = pre.letterbox([x[2] for x in chunk], imgsz)
+
+            with dt[1]:
+                pred = model(im)
+
+            with dt[2]:
+                pred = non_max_suppression(pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det,
+                                           dense=dense)
+                dets = []
+                for det, (window, core, im0), rp in zip(pred, chunk, ratio_pad):
+                    det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], im0.shape, rp)
+                    dets.append(own_boxes(det, window, core))  # global coordinates, seams de-duplicated by ownership
+                det = torch.cat(dets, 0).cpu().numpy()
+            seen += len(chunk)
+
+            if len(det):  # one write per batch
+                cx, cy = (det[:, 0] + det[:, 2]) / 2, (det[:, 1] + det[:, 3]) / 2
+                xy = np.stack((a * cx + b * cy + c, d * cx + e * cy + f), 1)  # box centres in map coordinates
+                np.savetxt(fw, np.concatenate((det, xy), 1), fmt=['%.1f'] * 4 + ['%.4f', '%d', '%.6f', '%.6f'],
+                           delimiter=',')
+                fw.flush()
+                count += len(det)
+            del chunk, im, pred  # release the batch before decoding the next one
+    dataset.close()
+
+    t = tuple(x.t / max(seen, 1) * 1E3 for x in dt)  # speeds per window
+    LOGGER.info(f'Speed: %.1fms decode+pre-process, %.1fms inference, %.1fms NMS per window at shape '
+                f'{(batch, 3, *imgsz)}' % t)
+    LOGGER.info(f"{count} detections in {seen} windows saved to {colorstr('bold', save_path)}")
+    return count, save_path
+
+
+class DetectionSession:
+    """
+    Reentrant detection settings for serving, safe to share between threads and processes.
+
+    A session holds explicit parameters only, never sys.argv, output directories or the model itself (models come from
+    the process-wide registry), so every call keeps its state local, sessions pickle for multiprocessing and concurrent
+    calls never share scratch files. The shared PyTorch, TorchScript and ONNX Runtime models keep no per-call state
+    (Detect() grids are per-call locals). TensorRT engines share one execution context, use max_batch > 1 with them so
+    that only the scheduler thread runs the engine.
+
+    Usage:
+        session = DetectionSession('yolov5_best.pt', conf_thres=0.7)
+        result = session.detect(im0)  # DetectionResult
+        result = session.detect_file('field.jpg', 'processed_field.jpg')  # also writes the annotated image
+    """
+
+    def __init__(
+            self,
+            weights=ROOT / 'yolov5s.pt',  # model path
+            imgsz=(640, 640),  # inference size (height, width)
+            buckets=None,  # input shapes WxH, i.e. '640x640,640x480,1024x768', images are padded into the nearest one
+            conf_thres=0.7,  # confidence threshold
+            iou_thres=0.5,  # NMS IOU threshold
+            max_det=1000,  # maximum detections per image
+            device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+            classes=None,  # filter by class: --class 0, or --class 0 2 3
+            agnostic_nms=False,  # class-agnostic NMS
+            dense=False,  # grid NMS without the max_det cap for dense fields: True/'iou' or 'center' (centre distance)
+            half=False,  # use FP16 half-precision inference
+            dnn=False,  # use OpenCV DNN for ONNX inference
+            compiled=False,  # run traced TorchScript graphs in channels_last (PyTorch weights)
+            max_size=2048,  # images larger than this are sliced into tiles at native resolution, 0 to never tile
+            tile_size=640,  # tile size in original pixels
+            tile_overlap=0.2,  # fractional overlap between neighbouring tiles
+            tile_batch=8,  # tiles per forward pass
+            max_batch=1,  # >1 to share batched forward passes with concurrent callers (micro-batching)
+            max_wait_ms=10,  # micro-batching: how long to wait for other callers before running a batch
+            cache=True,  # reuse results for identical image content, weights and parameters
+            line_thickness=3,  # bounding box thickness (pixels)
+            hide_labels=False,  # hide labels
+            hide_conf=False,  # hide confidences
+            render='boxes',  # annotation style: boxes, centroids or heat
+    ):
+        self.__dict__.update({k: v for k, v in locals().items() if k != 'self'})  # assign all settings to self
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({", ".join(f"{k}={v!r}" for k, v in self.__dict__.items())})'
+
+    def detect(self, source, annotate=True, ext='.jpg'):
+        """Detect on a BGR np.ndarray, encoded image bytes or an image path, returns a DetectionResult"""
+        return detect(source,
+                      self.weights,
+                      imgsz=self.imgsz,
+                      buckets=self.buckets,
+                      conf_thres=self.conf_thres,
+                      iou_thres=self.iou_thres,
+                      max_det=self.max_det,
+                      device=self.device,
+                      classes=self.classes,
+                      agnostic_nms=self.agnostic_nms,
+                      dense=self.dense,
+                      half=self.half,
+                      dnn=self.dnn,
+                      compiled=self.compiled,
+                      tile=self.tile_size if self.max_size else 0,
+                      max_size=self.max_size,
+                      tile_overlap=self.tile_overlap,
+                      tile_batch=self.tile_batch,
+                      max_batch=self.max_batch,
+                      max_wait_ms=self.max_wait_ms,
+                      annotate=annotate,
+                      ext=ext,
+                      line_thickness=self.line_thickness,
+                      hide_labels=self.hide_labels,
+                      hide_conf=self.hide_conf,
+                      render=self.render,
+                      cache=self.cache)
+
+    def detect_file(self, path, save_path=None):
+        """Detect on an image file, optionally writing the annotated image to save_path, returns a DetectionResult"""
+        ext = Path(save_path or path).suffix or '.jpg'
+        result = self.detect(Path(path), annotate=save_path is not None, ext=ext)  # cached on the file hash
+        if save_path is not None:
+            write_atomic(save_path, result.image)
+        return result
+
+
+def detect_image(upload_folder, result_folder, filename, model_weights, max_size=2048, tile_size=640, tile_overlap=0.2,
+                 max_batch=1, max_wait_ms=10, cache=True, annotate=True, dense=False, buckets=None, stats=None):
     """
     Process an uploaded image with YOLOv5 model and save the detection results.
     
@@ -311,6 +659,17 @@ def detect_image(upload_folder, result_folder, filename, model_weights):
         upload_folder: Folder where the uploaded image is stored
         result_folder: Folder where to save the processed image
         filename: Name of the image file
+        max_size: 宽或高超过该尺寸的图片按原始分辨率分块识别，而不是整体缩放
+        tile_size: 分块识别的块大小（像素）
+        tile_overlap: 相邻分块的重叠比例
+        max_batch: 大于1时与其他并发请求合并为一个批次推理（微批处理）
+        max_wait_ms: 微批处理时等待其他请求的最长时间（毫秒）
+        cache: 相同图片内容、权重和参数时直接返回缓存的结果，不再重复推理
+        annotate: 为False时只计数，不绘制和保存标注图片，只保存检测框，查看结果时再由render_image()生成
+        buckets: 输入尺寸分桶（宽x高），例如 '640x640,640x480,1024x768'，不分块的图片填充到最接近的尺寸，避免每种尺寸都重新初始化
+        dense: 密植场景使用网格NMS，不受max_det（每张图片最多1000个）限制，可为True/'iou'或'center'（按中心距离去重）
+        stats: 传入dict时写入本次识别的统计信息（供监控使用）：timings各阶段耗时（毫秒）、shape图片尺寸、
+               count数量、cache是否命中缓存；出错时写入error错误类型（not_found、oom、runtime、exception）
     
     Returns:
         tuple: (count, error_message) - count为检测到的对象数量，error_message为错误信息（成功时为None）
@@ -322,58 +681,102 @@ def detect_image(upload_folder, result_folder, filename, model_weights):
         result_filename = 'processed_' + filename
         dest_path = os.path.join(result_folder, result_filename)
 
-        opt = parse_opt()
-        opt.source = src_path
-        opt.project = result_folder  # Set output directory
-        opt.name = ''           # No subfolder
-        opt.weights = model_weights
-        
-        # Run detection
-        save_dir = run(**vars(opt))
-        
-        # Get prediction counts from results
-        count = 0
-
-        # Use the predictions.csv file to get counts
-        csv_path = Path(save_dir) / 'predictions.csv'
-        if csv_path.exists():
-            with open(csv_path, mode='r') as f:
-                # 计算行数
-                count = sum(1 for _ in f)
-            # Only remove the file if it exists
-            os.remove(csv_path)
-        
-        # Rename the output file to match the expected destination path
-        output_file = Path(save_dir) / filename
-        if output_file.exists():
-            dest_path = os.path.join(result_folder, result_filename)
-            shutil.move(output_file, dest_path)
-        
-        # Check if directory exists before trying to remove it
-        if os.path.exists(save_dir) and os.path.isdir(save_dir):
-            try:
-                os.removedirs(save_dir)
-            except OSError:
-                # Directory not empty, which is fine
-                pass
-                
-        return count, None
-        
+        # 所有参数都显式传入，不读取sys.argv，也不共享CSV或临时目录，可在多个线程/进程中同时调用
+        session = DetectionSession(model_weights,
+                                   max_size=max_size,
+                                   tile_size=tile_size,
+                                   tile_overlap=tile_overlap,
+                                   max_batch=max_batch,
+                                   max_wait_ms=max_wait_ms,
+                                   cache=cache,
+                                   dense=dense,
+                                   buckets=buckets)
+        if annotate:
+            result = session.detect_file(src_path, dest_path)
+        else:  # 只计数：NMS后直接返回，检测框保存到processed_<filename>.npz供render_image()按需绘制
+            result = session.detect_file(src_path)
+            names = np.array([result.names[k] for k in sorted(result.names)])
+            if not saved_detections_equal(dest_path + '.npz', result.boxes, names):  # 检测框不变时保留已绘制的图片
+                buffer = io.BytesIO()
+                np.savez(buffer, boxes=result.boxes, names=names)
+                write_atomic(dest_path + '.npz', buffer.getvalue())  # 先写入新的检测框，再删除按旧检测框绘制的图片
+                Path(dest_path).unlink(missing_ok=True)
+
+        if stats is not None:
+            stats.update(timings=result.timings, shape=result.shape, count=result.count,
+                         cache='cache' in result.timings)
+        return result.count, None
+
+    except FileNotFoundError:
+        if stats is not None:
+            stats['error'] = 'not_found'
+        return 0, f"无法读取图片: {filename}"
     except RuntimeError as e:
         # 处理CUDA out of memory错误
         error_msg = str(e)
         if "out of memory" in error_msg.lower() or "cuda" in error_msg.lower():
+            if stats is not None:
+                stats['error'] = 'oom'
             # 清理GPU内存
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
             return 0, "CUDA内存不足，请尝试使用更小的图片或重启程序"
         else:
+            if stats is not None:
+                stats['error'] = 'runtime'
             return 0, f"运行时错误: {error_msg}"
     except Exception as e:
         # 处理其他异常
+        if stats is not None:
+            stats['error'] = 'exception'
         return 0, f"处理图片时发生错误: {str(e)}"
 
 
+def saved_detections_equal(path, boxes, names):
+    """path处保存的检测框（.npz）是否与boxes、names相同，文件不存在或无法读取时返回False"""
+    try:
+        with np.load(path) as d:
+            return np.array_equal(d['boxes'], boxes) and np.array_equal(d['names'], names)
+    except (OSError, KeyError, ValueError):
+        return False
+
+
+def render_image(upload_folder, result_folder, filename, line_thickness=3, render='boxes'):
+    """
+    按需生成标注图片：只计数的识别（detect_image(annotate=False)）不绘制图片，第一次查看结果时再绘制并保存
+
+    Args:
+        upload_folder: Folder where the uploaded image is stored
+        result_folder: Folder where to save the processed image
+        filename: Name of the image file
+        line_thickness: 基础线条粗细，按图片尺寸动态调整
+        render: 标注方式，boxes、centroids或heat
+
+    Returns:
+        tuple: (result_path, error_message) - result_path为标注图片路径，error_message为错误信息（成功时为None）
+    """
+    result_path = os.path.join(result_folder, 'processed_' + filename)
+    if os.path.exists(result_path):  # 已经绘制过
+        return result_path, None
+    try:
+        for _ in range(3):  # 绘制期间detect_image()写入了新的检测框时按新检测框重新绘制
+            with np.load(result_path + '.npz') as d:
+                boxes, names = d['boxes'], d['names']
+            im0 = cv2.imread(os.path.join(upload_folder, filename))  # BGR
+            if im0 is None:
+                return None, f"无法读取图片: {filename}"
+            lw, fs = dynamic_line_params(im0.shape, line_thickness)
+            im0 = render_detections(im0, boxes, names, render, lw, fs)
+            write_atomic(result_path, cv2.imencode(Path(filename).suffix or '.jpg', im0)[1].tobytes())
+            if saved_detections_equal(result_path + '.npz', boxes, names):
+                break
+        return result_path, None
+    except FileNotFoundError:
+        return None, "识别结果不存在，请重新识别"
+    except Exception as e:
+        return None, f"生成结果图片时发生错误: {str(e)}"
+
+
 if __name__ == '__main__':
     opt = parse_opt()
     main(opt)
@@ -69,10 +69,11 @@ if platform.system() != 'Windows':
 
 from models.experimental import attempt_load
 from models.yolo import ClassificationModel, Detect, DetectionModel, SegmentationModel
+from utils.buckets import export_buckets, parse_buckets
 from utils.dataloaders import LoadImages
 from utils.general import (LOGGER, Profile, check_dataset, check_img_size, check_requirements, check_version,
                            check_yaml, colorstr, file_size, get_default_args, print_args, url2file, yaml_save)
-from utils.torch_utils import select_device, smart_inference_mode
+from utils.torch_utils import check_fold_input, select_device, smart_inference_mode
 
 MACOS = platform.system() == 'Darwin'  # macOS environment
 
@@ -140,6 +141,8 @@ def export_torchscript(model, im, file, optimize, prefix=colorstr('TorchScript:'
 
     ts = torch.jit.trace(model, im, strict=False)
     d = {'shape': im.shape, 'stride': int(max(model.stride)), 'names': model.names}
+    if getattr(model, 'uint8_input', False):  # uint8 0-255 input, see BaseModel.fold_input()
+        d.update(uint8_input=True, bgr_input=model.bgr_input)
     extra_files = {'config.txt': json.dumps(d)}  # torch._C.ExtraFilesMap()
     if optimize:  # https://pytorch.org/tutorials/recipes/mobile_interpreter.html
         optimize_for_mobile(ts)._save_for_lite_interpreter(str(f), _extra_files=extra_files)
@@ -183,6 +186,8 @@ def export_onnx(model, im, file, opset, dynamic, simplify, prefix=colorstr('ONNX
 
     # Metadata
     d = {'stride': int(max(model.stride)), 'names': model.names}
+    if getattr(model, 'uint8_input', False):  # uint8 0-255 input, see BaseModel.fold_input()
+        d.update(uint8_input=True, bgr_input=model.bgr_input)
     for k, v in d.items():
         meta = model_onnx.metadata_props.add()
         meta.key, meta.value = k, str(v)
@@ -700,10 +705,13 @@ def run(
         data=ROOT / 'data/coco128.yaml',  # 'dataset.yaml path'
         weights=ROOT / 'yolov5s.pt',  # weights path
         imgsz=(640, 640),  # image (height, width)
+        buckets=None,  # ONNX: one static-shape export per input shape WxH, i.e. '640x640,640x480,1024x768'
         batch_size=1,  # batch size
         device='cpu',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
         include=('torchscript', 'onnx'),  # include formats
         half=False,  # FP16 half-precision export
+        uint8=False,  # TorchScript/ONNX: uint8 0-255 input, normalization folded into the first Conv
+        bgr=False,  # TorchScript/ONNX: uint8 BGR input, channel swap folded into the first Conv
         inplace=False,  # set YOLOv5 Detect() inplace=True
         keras=False,  # use Keras
         optimize=False,  # TorchScript: optimize for mobile
@@ -733,6 +741,15 @@ def run(
     if half:
         assert device.type != 'cpu' or coreml, '--half only compatible with GPU export, i.e. use --device 0'
         assert not dynamic, '--half not compatible with --dynamic, i.e. use either --half or --dynamic but not both'
+    uint8 |= bgr
+    if uint8:
+        assert not any(flags[2:]), '--uint8 and --bgr only compatible with --include torchscript onnx'
+    if buckets:  # cached next to the weights like the registry's ONNX Runtime export, see utils/buckets.py
+        assert include == ['onnx'], '--buckets only compatible with --include onnx'
+        f = export_buckets(file, parse_buckets(buckets), simplify=simplify, opset=opset, uint8=uint8, bgr=bgr)
+        for b, x in f.items():
+            LOGGER.info(f"{colorstr('Buckets:')} {b[1]}x{b[0]} {'export failed' if x is None else x}")
+        return [str(x) for x in f.values() if x]
     model = attempt_load(weights, device=device, inplace=True, fuse=True)  # load FP32 model
 
     # Checks
@@ -753,10 +770,14 @@ def run(
             m.dynamic = dynamic
             m.export = True
 
+    if uint8:  # fold 0-255 to 0.0-1.0 (and BGR to RGB) into the first Conv, checked on a random image first
+        check_fold_input(model, torch.randint(0, 256, im.shape, dtype=torch.uint8, device=device), bgr)
+        im, model = im.to(torch.uint8), model.fold_input(bgr)
+
     for _ in range(2):
         y = model(im)  # dry runs
     if half and not coreml:
-        im, model = im.half(), model.half()  # to FP16
+        im, model = im if uint8 else im.half(), model.half()  # to FP16
     shape = tuple((y[0] if isinstance(y, tuple) else y).shape)  # model output shape
     metadata = {'stride': int(max(model.stride)), 'names': model.names}  # model metadata
     LOGGER.info(f"\n{colorstr('PyTorch:')} starting from {file} with output shape {shape} ({file_size(file):.1f} MB)")
@@ -825,9 +846,12 @@ def parse_opt(known=False):
     parser.add_argument('--data', type=str, default=ROOT / 'data/coco128.yaml', help='dataset.yaml path')
     parser.add_argument('--weights', nargs='+', type=str, default=ROOT / 'yolov5s.pt', help='model.pt path(s)')
     parser.add_argument('--imgsz', '--img', '--img-size', nargs='+', type=int, default=[640, 640], help='image (h, w)')
+    parser.add_argument('--buckets', type=str, default=None, help='ONNX: static export per shape WxH,WxH,...')
     parser.add_argument('--batch-size', type=int, default=1, help='batch size')
     parser.add_argument('--device', default='cpu', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
     parser.add_argument('--half', action='store_true', help='FP16 half-precision export')
+    parser.add_argument('--uint8', action='store_true', help='TorchScript/ONNX: uint8 0-255 input')
+    parser.add_argument('--bgr', action='store_true', help='TorchScript/ONNX: uint8 BGR input, folded channel swap')
     parser.add_argument('--inplace', action='store_true', help='set YOLOv5 Detect() inplace=True')
     parser.add_argument('--keras', action='store_true', help='TF: use Keras')
     parser.add_argument('--optimize', action='store_true', help='TorchScript: optimize for mobile')
@@ -42,7 +42,7 @@ from utils.dataloaders import exif_transpose, letterbox
 from utils.general import (LOGGER, ROOT, Profile, check_requirements, check_suffix, check_version, colorstr,
                            increment_path, is_jupyter, make_divisible, non_max_suppression, scale_boxes, xywh2xyxy,
                            xyxy2xywh, yaml_load)
-from utils.torch_utils import copy_attr, smart_inference_mode
+from utils.torch_utils import copy_attr, fuse_conv_and_bn, slice_bn, smart_inference_mode
 
 
 def autopad(k, p=None, d=1):  # kernel, padding, dilation
@@ -150,6 +150,19 @@ class BottleneckCSP(nn.Module):
         y2 = self.cv2(x)
         return self.cv4(self.act(self.bn(torch.cat((y1, y2), 1))))
 
+    def forward_fuse(self, x):
+        return self.cv4(self.act(torch.cat((self.cv3(self.m(self.cv1(x))), self.cv2(x)), 1)))
+
+    def fuse(self):
+        # Fold the BN applied to cat(cv3, cv2) into cv3 and cv2, channel slice by channel slice
+        if hasattr(self, 'bn'):
+            c_ = self.cv3.out_channels
+            self.cv3 = fuse_conv_and_bn(self.cv3, slice_bn(self.bn, 0, c_))
+            self.cv2 = fuse_conv_and_bn(self.cv2, slice_bn(self.bn, c_, 2 * c_))
+            delattr(self, 'bn')
+            self.forward = self.forward_fuse
+        return self
+
 
 class CrossConv(nn.Module):
     # Cross Convolution Downsample
@@ -222,7 +235,8 @@ class C2fDCB(nn.Module):
         self.m = nn.ModuleList(DCBlock(self.c, self.c, shortcut, g, k=3) for _ in range(n))
         
     def forward(self, x):
-        y = list(self.cv1(x).chunk(2, 1))
+        y1, y2 = self.cv1(x).chunk(2, 1)  # unpacked rather than list(), torch.fx cannot iterate a traced tensor
+        y = [y1, y2]
         for m in self.m:
             y.append(m(y[-1]))
         return self.cv2(torch.cat(y, 1))
@@ -272,6 +286,24 @@ class SCDown(nn.Module):
         # 特征融合
         return self.act(y1 + y2)
 
+    def forward_fuse(self, x):
+        # 重参数化后的推理路径: bn1并入conv_dw, bn2的缩放并入conv_pw, bn2的偏置并入spatial_conv的偏置
+        y1 = self.conv_pw(self.act(self.conv_dw(x)))
+        return self.act(y1 + self.spatial_conv(x.mean((2, 3), keepdim=True)))
+
+    def fuse(self):
+        # 推理时重参数化: 折叠bn1/bn2, 主路径只剩两次卷积
+        if hasattr(self, 'bn1'):
+            self.conv_dw = fuse_conv_and_bn(self.conv_dw, self.bn1)
+            conv_pw = fuse_conv_and_bn(self.conv_pw, self.bn2)
+            self.spatial_conv.bias.data += conv_pw.bias  # 逐通道常数偏置移到1x1分支, 只需加在池化后的特征上
+            conv_pw.bias = None
+            self.conv_pw = conv_pw
+            for k in 'bn1', 'bn2', 'avg_pool':
+                delattr(self, k)
+            self.forward = self.forward_fuse
+        return self
+
 
 class SPP(nn.Module):
     # Spatial Pyramid Pooling (SPP) layer https://arxiv.org/abs/1406.4729
@@ -388,7 +420,14 @@ class Concat(nn.Module):
 
 class DetectMultiBackend(nn.Module):
     # YOLOv5 MultiBackend class for python inference on various backends
-    def __init__(self, weights='yolov5s.pt', device=torch.device('cpu'), dnn=False, data=None, fp16=False, fuse=True):
+    def __init__(self,
+                 weights='yolov5s.pt',
+                 device=torch.device('cpu'),
+                 dnn=False,
+                 data=None,
+                 fp16=False,
+                 fuse=True,
+                 session=None):  # prebuilt ONNX Runtime session, i.e. utils/onnx_backend.py ORTSession
         # Usage:
         #   PyTorch:              weights = *.pt
         #   TorchScript:                    *.torchscript
@@ -410,6 +449,7 @@ class DetectMultiBackend(nn.Module):
         fp16 &= pt or jit or onnx or engine or triton  # FP16
         nhwc = coreml or saved_model or pb or tflite or edgetpu  # BHWC formats (vs torch BCWH)
         stride = 32  # default stride
+        uint8_input = bgr_input = False  # uint8 0-255 (BGR) input, see export.py --uint8 --bgr
         cuda = torch.cuda.is_available() and device.type != 'cpu'  # use CUDA
         if not (pt or triton):
             w = attempt_download(w)  # download if not local
@@ -418,6 +458,7 @@ class DetectMultiBackend(nn.Module):
             model = attempt_load(weights if isinstance(weights, list) else w, device=device, inplace=True, fuse=fuse)
             stride = max(int(model.stride.max()), 32)  # model stride
             names = model.module.names if hasattr(model, 'module') else model.names  # get class names
+            uint8_input, bgr_input = getattr(model, 'uint8_input', False), getattr(model, 'bgr_input', False)
             model.half() if fp16 else model.float()
             self.model = model  # explicitly assign for to(), cpu(), cuda(), half()
         elif jit:  # TorchScript
@@ -431,20 +472,23 @@ class DetectMultiBackend(nn.Module):
                                    int(k) if k.isdigit() else k: v
                                    for k, v in d.items()})
                 stride, names = int(d['stride']), d['names']
+                uint8_input, bgr_input = d.get('uint8_input', False), d.get('bgr_input', False)
         elif dnn:  # ONNX OpenCV DNN
             LOGGER.info(f'Loading {w} for ONNX OpenCV DNN inference...')
             check_requirements('opencv-python>=4.5.4')
             net = cv2.dnn.readNetFromONNX(w)
         elif onnx:  # ONNX Runtime
             LOGGER.info(f'Loading {w} for ONNX Runtime inference...')
-            check_requirements(('onnx', 'onnxruntime-gpu' if cuda else 'onnxruntime'))
-            import onnxruntime
-            providers = ['CUDAExecutionProvider', 'CPUExecutionProvider'] if cuda else ['CPUExecutionProvider']
-            session = onnxruntime.InferenceSession(w, providers=providers)
+            if session is None:
+                check_requirements(('onnx', 'onnxruntime-gpu' if cuda else 'onnxruntime'))
+                import onnxruntime
+                providers = ['CUDAExecutionProvider', 'CPUExecutionProvider'] if cuda else ['CPUExecutionProvider']
+                session = onnxruntime.InferenceSession(w, providers=providers)
             output_names = [x.name for x in session.get_outputs()]
             meta = session.get_modelmeta().custom_metadata_map  # metadata
             if 'stride' in meta:
                 stride, names = int(meta['stride']), eval(meta['names'])
+            uint8_input, bgr_input = meta.get('uint8_input') == 'True', meta.get('bgr_input') == 'True'
         elif xml:  # OpenVINO
             LOGGER.info(f'Loading {w} for OpenVINO inference...')
             check_requirements('openvino>=2023.0')  # requires openvino-dev: https://pypi.org/project/openvino-dev/
@@ -580,7 +624,7 @@ class DetectMultiBackend(nn.Module):
     def forward(self, im, augment=False, visualize=False):
         # YOLOv5 MultiBackend inference
         b, ch, h, w = im.shape  # batch, channel, height, width
-        if self.fp16 and im.dtype != torch.float16:
+        if self.fp16 and im.dtype != torch.float16 and not self.uint8_input:
             im = im.half()  # to FP16
         if self.nhwc:
             im = im.permute(0, 2, 3, 1)  # torch BCHW to numpy BHWC shape(1,320,192,3)
@@ -666,7 +710,8 @@ class DetectMultiBackend(nn.Module):
         # Warmup model by running inference once
         warmup_types = self.pt, self.jit, self.onnx, self.engine, self.saved_model, self.pb, self.triton
         if any(warmup_types) and (self.device.type != 'cpu' or self.triton):
-            im = torch.empty(*imgsz, dtype=torch.half if self.fp16 else torch.float, device=self.device)  # input
+            dtype = torch.uint8 if self.uint8_input else torch.half if self.fp16 else torch.float
+            im = torch.zeros(*imgsz, dtype=dtype, device=self.device)  # input
             for _ in range(2 if self.jit else 1):  #
                 self.forward(im)  # warmup
 
@@ -726,6 +771,7 @@ class AutoShape(nn.Module):
             m.grid = list(map(fn, m.grid))
             if isinstance(m.anchor_grid, list):
                 m.anchor_grid = list(map(fn, m.anchor_grid))
+            m.grid_cache = {}  # rebuilt on the new device/dtype
         return self
 
     @smart_inference_mode()
@@ -2,6 +2,7 @@
 """
 Experimental modules
 """
+import io
 import math
 
 import numpy as np
@@ -9,6 +10,7 @@ import torch
 import torch.nn as nn
 
 from utils.downloads import attempt_download
+from utils.torch_utils import fuse_conv_and_bn, slice_bn
 
 
 class Sum(nn.Module):
@@ -56,6 +58,20 @@ class MixConv2d(nn.Module):
     def forward(self, x):
         return self.act(self.bn(torch.cat([m(x) for m in self.m], 1)))
 
+    def forward_fuse(self, x):
+        return self.act(torch.cat([m(x) for m in self.m], 1))
+
+    def fuse(self):
+        # Fold the BN applied to the concatenated outputs into each conv
+        if hasattr(self, 'bn'):
+            i = 0
+            for j, m in enumerate(self.m):
+                self.m[j] = fuse_conv_and_bn(m, slice_bn(self.bn, i, i + m.out_channels))
+                i += m.out_channels
+            delattr(self, 'bn')
+            self.forward = self.forward_fuse
+        return self
+
 
 class Ensemble(nn.ModuleList):
     # Ensemble of models
@@ -70,6 +86,21 @@ class Ensemble(nn.ModuleList):
         return y, None  # inference, train output
 
 
+def load_quantized(ckpt):
+    # QuantizedModel from a quantize.py --method torch checkpoint. Unpickling rebuilds the packed INT8 weights for the
+    # active quantized engine, so the model bytes are loaded under the engine it was calibrated for
+    engine = torch.backends.quantized.engine
+    if not isinstance(ckpt['model'], bytes):  # pickled directly, before the engine was set at load time
+        assert ckpt['quantized'] == engine, f"{ckpt['quantized']} INT8 model loaded with the {engine} quantized " \
+                                            f'engine, re-run quantize.py --method torch'
+        return ckpt['model']
+    torch.backends.quantized.engine = ckpt['quantized']
+    try:
+        return torch.load(io.BytesIO(ckpt['model']), map_location='cpu')
+    finally:
+        torch.backends.quantized.engine = engine
+
+
 def attempt_load(weights, device=None, inplace=True, fuse=True):
     # Loads an ensemble of models weights=[a,b,c] or a single model weights=[a] or weights=a
     from models.yolo import Detect, Model
@@ -77,6 +108,8 @@ def attempt_load(weights, device=None, inplace=True, fuse=True):
     model = Ensemble()
     for w in weights if isinstance(weights, list) else [weights]:
         ckpt = torch.load(attempt_download(w), map_location='cpu')  # load
+        if ckpt.get('quantized'):  # INT8 QuantizedModel, packed for its quantized engine
+            ckpt['model'] = load_quantized(ckpt)
         ckpt = (ckpt.get('ema') or ckpt['model']).to(device).float()  # FP32 model
 
         # Model compatibility updates
@@ -26,8 +26,8 @@ from models.experimental import *  # noqa
 from utils.autoanchor import check_anchor_order
 from utils.general import LOGGER, check_version, check_yaml, make_divisible, print_args
 from utils.plots import feature_visualization
-from utils.torch_utils import (fuse_conv_and_bn, initialize_weights, model_info, profile, scale_img, select_device,
-                               time_sync)
+from utils.torch_utils import (check_fold_input, check_fuse, fuse_conv_and_bn, initialize_weights, model_info, profile,
+                               scale_img, select_device, time_sync)
 
 try:
     import thop  # for FLOPs computation
@@ -49,6 +49,7 @@ class Detect(nn.Module):
         self.na = len(anchors[0]) // 2  # number of anchors
         self.grid = [torch.empty(0) for _ in range(self.nl)]  # init grid
         self.anchor_grid = [torch.empty(0) for _ in range(self.nl)]  # init anchor grid
+        self.grid_cache = {}  # (level, ny, nx) -> (grid, anchor_grid)
         self.register_buffer('anchors', torch.tensor(anchors).float().view(self.nl, -1, 2))  # shape(nl,na,2)
         self.m = nn.ModuleList(nn.Conv2d(x, self.no * self.na, 1) for x in ch)  # output conv
         self.inplace = inplace  # use inplace ops (e.g. slice assignment)
@@ -61,23 +62,32 @@ class Detect(nn.Module):
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
             if not self.training:  # inference
-                if self.dynamic or self.grid[i].shape[2:4] != x[i].shape[2:4]:
-                    self.grid[i], self.anchor_grid[i] = self._make_grid(nx, ny, i)
+                grid, anchor_grid = self._cached_grid(nx, ny, i)  # local, concurrent callers may differ in shape
 
                 if isinstance(self, Segment):  # (boxes + masks)
                     xy, wh, conf, mask = x[i].split((2, 2, self.nc + 1, self.no - self.nc - 5), 4)
-                    xy = (xy.sigmoid() * 2 + self.grid[i]) * self.stride[i]  # xy
-                    wh = (wh.sigmoid() * 2) ** 2 * self.anchor_grid[i]  # wh
+                    xy = (xy.sigmoid() * 2 + grid) * self.stride[i]  # xy
+                    wh = (wh.sigmoid() * 2) ** 2 * anchor_grid  # wh
                     y = torch.cat((xy, wh, conf.sigmoid(), mask), 4)
                 else:  # Detect (boxes only)
                     xy, wh, conf = x[i].sigmoid().split((2, 2, self.nc + 1), 4)
-                    xy = (xy * 2 + self.grid[i]) * self.stride[i]  # xy
-                    wh = (wh * 2) ** 2 * self.anchor_grid[i]  # wh
+                    xy = (xy * 2 + grid) * self.stride[i]  # xy
+                    wh = (wh * 2) ** 2 * anchor_grid  # wh
                     y = torch.cat((xy, wh, conf), 4)
                 z.append(y.view(bs, self.na * nx * ny, self.no))
 
         return x if self.training else (torch.cat(z, 1), ) if self.export else (torch.cat(z, 1), x)
 
+    def _cached_grid(self, nx=20, ny=20, i=0):
+        # Grids per level and input shape, alternating input shapes (i.e. shape buckets) reuse them, not rebuild them
+        if self.dynamic:
+            return self._make_grid(nx, ny, i)
+        cache = self.__dict__.setdefault('grid_cache', {})  # missing in models pickled before the cache
+        k = i, ny, nx
+        if k not in cache:
+            cache[k] = self._make_grid(nx, ny, i)
+        return cache[k]
+
     def _make_grid(self, nx=20, ny=20, i=0, torch_1_10=check_version(torch.__version__, '1.10.0')):
         d = self.anchors[i].device
         t = self.anchors[i].dtype
@@ -112,6 +122,7 @@ class BaseModel(nn.Module):
         return self._forward_once(x, profile, visualize)  # single-scale inference, train
 
     def _forward_once(self, x, profile=False, visualize=False):
+        x = self._input(x)
         y, dt = [], []  # outputs
         for m in self.model:
             if m.f != -1:  # if not from previous layer
@@ -124,6 +135,29 @@ class BaseModel(nn.Module):
                 feature_visualization(x, m.type, m.i, save_dir=visualize)
         return x
 
+    def _input(self, x):
+        # uint8 0-255 input to the weights dtype, the 1/255 scale is folded into the first Conv (see fold_input()).
+        # Keyed on the model attribute, not x.dtype, so torch.fx can trace through _forward_once() (QuantizedModel)
+        if getattr(self, 'uint8_input', False):
+            x = x.to(next(self.parameters()).dtype)
+        return x
+
+    def fold_input(self, bgr=False):
+        # Fold the 0-255 to 0.0-1.0 input scaling (and the BGR to RGB swap if bgr) into the first Conv weights, the
+        # model then takes uint8 input directly. Exact up to rounding, zero padding stays zero and BatchNorm (or its
+        # fused scale) follows the conv
+        if getattr(self, 'uint8_input', False):
+            return self
+        m = self.model[0]
+        assert isinstance(m, (Conv, Focus)), f'fold_input() needs a Conv or Focus input layer, not {type(m).__name__}'
+        c = next(x for x in m.modules() if isinstance(x, nn.Conv2d))
+        w = c.weight.data / 255
+        if bgr:  # reverse each group of 3 input channels, Focus concatenates 4 space-to-depth slices
+            w = w.view(w.shape[0], -1, 3, *w.shape[2:]).flip(2).reshape(w.shape)
+        c.weight.data = w
+        self.uint8_input, self.bgr_input = True, bgr
+        return self
+
     def _profile_one_layer(self, m, x, dt):
         c = m == self.model[-1]  # is final layer, copy input as inplace fix
         o = thop.profile(m, inputs=(x.copy() if c else x, ), verbose=False)[0] / 1E9 * 2 if thop else 0  # FLOPs
@@ -144,6 +178,8 @@ class BaseModel(nn.Module):
                 m.conv = fuse_conv_and_bn(m.conv, m.bn)  # update conv
                 delattr(m, 'bn')  # remove batchnorm
                 m.forward = m.forward_fuse  # update forward
+            elif isinstance(m, (BottleneckCSP, MixConv2d, SCDown)):
+                m.fuse()  # fold BNs that follow a torch.cat() or feed a residual sum
         self.info()
         return self
 
@@ -159,6 +195,7 @@ class BaseModel(nn.Module):
             m.grid = list(map(fn, m.grid))
             if isinstance(m.anchor_grid, list):
                 m.anchor_grid = list(map(fn, m.anchor_grid))
+            m.grid_cache = {}  # rebuilt on the new device/dtype
         return self
 
 
@@ -209,6 +246,7 @@ class DetectionModel(BaseModel):
         return self._forward_once(x, profile, visualize)  # single-scale inference, train
 
     def _forward_augment(self, x):
+        x = self._input(x)  # scale_img() interpolates floats
         img_size = x.shape[-2:]  # height, width
         s = [1, 0.83, 0.67]  # scales
         f = [None, 3, None]  # flips (2-ud, 3-lr)
@@ -264,6 +302,51 @@ class DetectionModel(BaseModel):
 Model = DetectionModel  # retain YOLOv5 'Model' class for backwards compatibility
 
 
+class QuantizedModel(nn.Module):
+    # YOLOv5 INT8 detection model, FX graph mode static quantization of a fused DetectionModel with Detect() in float
+    def __init__(self, model, calib, imgsz=(640, 640), engine=None):  # model, calibration inputs, size, backend
+        super().__init__()
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.fx.custom_config import PrepareCustomConfig
+        from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+        previous = torch.backends.quantized.engine  # process-global, restored after calibration
+        self.engine = engine or previous  # x86/fbgemm or qnnpack, must match the deployment CPU
+        qconfig_mapping = get_default_qconfig_mapping(self.engine).set_object_type(Detect, None)  # float head
+        custom = PrepareCustomConfig().set_non_traceable_module_classes([Detect])  # shape-dependent grid code
+        model = model.cpu().float().eval()
+        try:
+            torch.backends.quantized.engine = self.engine
+            prepared = prepare_fx(_Layers(model), qconfig_mapping, (torch.zeros(1, 3, *imgsz), ), custom)
+            with torch.no_grad():
+                for im in calib:  # observe activation ranges
+                    prepared(im)
+            self.model = convert_fx(prepared)  # torch.fx.GraphModule
+        finally:
+            torch.backends.quantized.engine = previous
+        self.stride, self.names, self.nc, self.yaml = model.stride, model.names, model.nc, model.yaml
+        self.quantized = True
+
+    def forward(self, x, augment=False, profile=False, visualize=False):
+        return self.model(x)  # single-scale inference only, weights are packed for self.engine at load time
+
+    def fuse(self):  # already fused before quantization
+        return self
+
+    def info(self, verbose=False, img_size=640):  # print model information
+        model_info(self, verbose, img_size)
+
+
+class _Layers(nn.Module):
+    # FX trace target: the DetectionModel layer loop without the augment/profile/visualize branches
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model._forward_once(x)
+
+
 class SegmentationModel(DetectionModel):
     # YOLOv5 segmentation model
     def __init__(self, cfg='yolov5s-seg.yaml', ch=3, nc=None, anchors=None):
@@ -364,6 +447,8 @@ if __name__ == '__main__':
     parser.add_argument('--profile', action='store_true', help='profile model speed')
     parser.add_argument('--line-profile', action='store_true', help='profile model speed layer by layer')
     parser.add_argument('--test', action='store_true', help='test all yolo*.yaml')
+    parser.add_argument('--check-fuse', action='store_true', help='check fused model output against unfused model')
+    parser.add_argument('--check-fold', action='store_true', help='check uint8 input model against float input model')
     opt = parser.parse_args()
     opt.cfg = check_yaml(opt.cfg)  # check YAML
     print_args(vars(opt))
@@ -380,6 +465,20 @@ if __name__ == '__main__':
     elif opt.profile:  # profile forward-backward
         results = profile(input=im, ops=[model], n=3)
 
+    elif opt.check_fuse:  # numerical equivalence of the reparameterized model
+        for m in model.modules():
+            if isinstance(m, nn.BatchNorm2d):  # non-trivial BN statistics, fresh BNs fold to near identity
+                m.weight.data.uniform_(0.5, 1.5)
+                m.bias.data.uniform_(-0.5, 0.5)
+                m.running_mean.uniform_(-0.5, 0.5)
+                m.running_var.uniform_(0.5, 1.5)
+        check_fuse(model, im)
+
+    elif opt.check_fold:  # numerical equivalence of the uint8 input model, RGB and BGR
+        im, model = (im * 255).round().to(torch.uint8), model.eval().fuse()
+        for bgr in False, True:
+            check_fold_input(model, im, bgr)
+
     elif opt.test:  # test all models
         for cfg in Path(ROOT / 'models').rglob('yolo*.yaml'):
             try:
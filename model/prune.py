@@ -0,0 +1,406 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Structured channel pruning of a YOLOv5 detector into a physically smaller model
+
+torch_utils.prune() only zeroes weights, this script removes whole filters and rebuilds the Conv2d/BatchNorm2d layers
+with fewer channels. Filters are ranked by the L1 norm of their BatchNorm scale (network slimming). Channels that feed a
+residual sum share one mask, and every reader of a pruned output is sliced at its torch.cat() offsets:
+    C3          cv1/Bottleneck chain (shared mask across residual sums), cv2 and the hidden Bottleneck channels
+    C2fDCB      both cv1 halves, the DCBlock chain (shared mask across residual sums) and hidden DCBlock channels,
+                the unused cv2 of residual DCBlocks is dropped
+    SPPF        cv1 channels, sliced at all four max-pool concat offsets of cv2
+    layers      outputs of Conv, C3, C2fDCB, SPPF and SCDown layers, followed through Concat and nn.Upsample into
+                every reader including the Detect() output convs
+Focus, grouped convolutions and layers read by other block types keep their widths.
+
+Usage:
+    $ python prune.py --weights yolov5_best.pt --ratio 0.3 --holdout ../fields/holdout/images
+    $ python prune.py --weights yolov5_best.pt --ratio 0.5 --holdout ../fields/holdout/images \
+                      --data ../fields/train/images --epochs 10  # fine-tune after pruning
+"""
+
+import argparse
+import json
+import os
+import sys
+from copy import deepcopy
+from datetime import datetime
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[0]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
+
+from models.common import C3, SPPF, Bottleneck, C2fDCB, Concat, Conv, SCDown
+from models.experimental import attempt_load
+from models.yolo import Detect
+from quantize import evaluate
+from utils.dataloaders import create_dataloader
+from utils.general import LOGGER, check_img_size, colorstr, make_divisible, print_args
+from utils.loss import ComputeLoss
+from utils.torch_utils import model_info, select_device, smart_optimizer
+
+PREFIX = colorstr('Prune:')
+HYP = {'box': 0.05, 'cls': 0.5, 'cls_pw': 1.0, 'obj': 1.0, 'obj_pw': 1.0, 'anchor_t': 4.0, 'fl_gamma': 0.0}  # loss
+
+
+def _prune_bn(bn, keep):
+    # Keep channels `keep` of BatchNorm2d bn
+    bn.weight, bn.bias = nn.Parameter(bn.weight.data[keep].clone()), nn.Parameter(bn.bias.data[keep].clone())
+    bn.running_mean, bn.running_var = bn.running_mean[keep].clone(), bn.running_var[keep].clone()
+    bn.num_features = len(keep)
+
+
+def _prune_conv_out(c, keep):
+    # Keep output channels `keep` of nn.Conv2d c
+    c.weight = nn.Parameter(c.weight.data[keep].clone())
+    if c.bias is not None:
+        c.bias = nn.Parameter(c.bias.data[keep].clone())
+    c.out_channels = len(keep)
+
+
+def _prune_conv_in(c, mask):
+    # Keep input channels where boolean `mask` is True of nn.Conv2d c
+    c.weight = nn.Parameter(c.weight.data[:, mask].clone())
+    c.in_channels = int(mask.sum())
+
+
+def _prune_out(m, keep):
+    # Keep output channels `keep` of Conv() or SCDown m
+    if isinstance(m, SCDown):  # y1 + y2, both branches produce every output channel
+        _prune_conv_out(m.conv_pw, keep)
+        _prune_conv_out(m.spatial_conv, keep)
+        if hasattr(m, 'bn2'):
+            _prune_bn(m.bn2, keep)
+        return
+    _prune_conv_out(m.conv, keep)
+    if hasattr(m, 'bn'):
+        _prune_bn(m.bn, keep)
+
+
+def _prune_in(m, mask):
+    # Keep input channels where boolean `mask` is True of Conv(), nn.Conv2d (Detect() outputs) or SCDown m
+    if isinstance(m, SCDown):  # depthwise conv_dw passes its input channels on to conv_pw and spatial_conv
+        keep = mask.nonzero().view(-1)
+        _prune_conv_out(m.conv_dw, keep)
+        m.conv_dw.in_channels = m.conv_dw.groups = len(keep)
+        if hasattr(m, 'bn1'):
+            _prune_bn(m.bn1, keep)
+        _prune_conv_in(m.conv_pw, mask)
+        _prune_conv_in(m.spatial_conv, mask)
+        return
+    _prune_conv_in(m if isinstance(m, nn.Conv2d) else m.conv, mask)
+
+
+def _conv(m):
+    # nn.Conv2d whose input channels a Conv(), nn.Conv2d or SCDown reads, and whose output channels it produces
+    return m.conv_pw if isinstance(m, SCDown) else m if isinstance(m, nn.Conv2d) else m.conv
+
+
+def _groups(m):
+    # Convolution groups of a Conv() or nn.Conv2d, SCDown handles its depthwise conv itself
+    return 1 if isinstance(m, SCDown) else m.groups if isinstance(m, nn.Conv2d) else m.conv.groups
+
+
+def _importance(m):
+    # Per-filter importance of Conv() or SCDown m: |BatchNorm scale|, or the filter L1 norm once BatchNorm is fused
+    if isinstance(m, SCDown):
+        return m.bn2.weight.detach().abs() if hasattr(m, 'bn2') else m.conv_pw.weight.detach().abs().sum((1, 2, 3))
+    return m.bn.weight.detach().abs() if hasattr(m, 'bn') else m.conv.weight.detach().abs().sum((1, 2, 3))
+
+
+def _mask(n, keep):
+    # Boolean mask of length n, True at indices keep
+    mask = torch.zeros(n, dtype=torch.bool)
+    mask[keep] = True
+    return mask
+
+
+def prune_group(producers, consumers, ratio=0.3, divisor=8):
+    """
+    Remove the least important `ratio` of the channels shared by `producers`, returns the number of channels removed
+
+    Arguments:
+        producers: Conv() (or SCDown) modules whose outputs share one channel mask (residual sums)
+        consumers: (Conv(), nn.Conv2d or SCDown, offsets) pairs reading those channels at each input channel offset,
+                   offsets > 0 are torch.cat() inputs
+        ratio: fraction of channels to remove, the kept count is rounded up to a multiple of divisor
+    """
+    n = _conv(producers[0]).out_channels
+    k = min(make_divisible(n * (1 - ratio), divisor), n)
+    if k == n or any(_groups(m) > 1 for m in producers + [c for c, _ in consumers]):
+        return 0  # nothing to remove, or grouped convolutions
+    keep = sum(_importance(m) for m in producers).argsort(descending=True)[:k].sort().values
+    for m in producers:
+        _prune_out(m, keep)
+    for m, offsets in consumers:
+        mask = torch.ones(_conv(m).in_channels, dtype=torch.bool)
+        for o in offsets:
+            mask[o:o + n] = False
+            mask[o + keep] = True
+        _prune_in(m, mask)
+    return n - k
+
+
+def prune_c2fdcb(m, ratio=0.3, divisor=8):
+    """
+    Prune the cv1 halves and DCBlock chain of C2fDCB m, returns the number of channels removed
+
+    cv1(x).chunk(2, 1) needs two equally wide halves, so both keep the same count. The first half is read by cv2 only.
+    With residual DCBlocks the second half and every DCBlock output are summed and share one mask, otherwise each link
+    of the chain (second half, DCBlock.cv2 outputs) has its own. cv2 reads all links at consecutive torch.cat() offsets.
+    """
+    c = m.cv1.conv.out_channels // 2
+    k = min(make_divisible(c * (1 - ratio), divisor), c)
+    convs = [m.cv1, m.cv2, *(x for d in m.m for x in (d.cv1, getattr(d, 'cv2', None)) if x is not None)]
+    if k == c or any(x.conv.groups > 1 for x in convs):
+        return 0
+    top = lambda x: x.argsort(descending=True)[:k].sort().values  # kept channels by importance
+    s = _importance(m.cv1)
+    residual = all(d.shortcut for d in m.m)
+    keep = top(s[:c])  # first half
+    if residual:
+        links = [top(s[c:] + sum(_importance(d.cv1) for d in m.m))] * (len(m.m) + 1)
+    else:
+        links = [top(s[c:]), *(top(_importance(d.cv2)) for d in m.m)]
+    _prune_out(m.cv1, torch.cat((keep, c + links[0])))
+    for d, a, b in zip(m.m, links, links[1:]):  # input link a, output link b
+        _prune_in(d.cv1, _mask(c, a))
+        if d.shortcut:
+            _prune_out(d.cv1, b)
+        else:  # cv2 reads torch.cat([x, cv1(x)])
+            _prune_in(d.cv2, torch.cat((_mask(c, a), torch.ones(d.cv1.conv.out_channels, dtype=torch.bool))))
+            _prune_out(d.cv2, b)
+    _prune_in(m.cv2, torch.cat([_mask(c, keep), *(_mask(c, x) for x in links)]))
+    m.c = k
+    return (c - k) * (2 if residual else len(links) + 1)
+
+
+def _producer(m):
+    # Conv() (or SCDown) producing the output of layer m, None if it can not be pruned
+    if type(m) in (C3, C2fDCB, SPPF):
+        return m.cv3 if type(m) is C3 else m.cv2
+    if type(m) is Conv or isinstance(m, SCDown):
+        return m
+    return None  # Focus, DWConv, Detect(), Concat, nn.Upsample and other layers
+
+
+def _inputs(m, i):
+    # Modules of layer m reading its i-th input from channel 0, None if that input can not be pruned
+    if type(m) is Conv or isinstance(m, SCDown):
+        return [m]
+    if type(m) is C3:
+        return [m.cv1, m.cv2]
+    if type(m) in (C2fDCB, SPPF):
+        return [m.cv1]
+    if type(m) is Detect:
+        return [m.m[i]]
+    return None
+
+
+def _readers(layers, i, widths, offset=0):
+    # (module, offset) pairs reading the output of layer i through Concat and nn.Upsample, None if any can not be pruned
+    out = []
+    for j in range(i + 1, len(layers)):
+        m = layers[j]
+        src = [j - 1 if x == -1 else x for x in ([m.f] if isinstance(m.f, int) else m.f)]
+        for k, x in enumerate(src):
+            if x != i:
+                continue
+            if isinstance(m, (Concat, nn.Upsample)):  # pass-through at a channel offset
+                before = src[:k] if isinstance(m, Concat) else []
+                if any(widths[y] is None for y in before):
+                    return None
+                r = _readers(layers, j, widths, offset + sum(widths[y] for y in before))
+                if r is None:
+                    return None
+                out += r
+            else:
+                r = _inputs(m, k)
+                if r is None:
+                    return None
+                out += [(y, offset) for y in r]
+    return out
+
+
+def _widths(layers):
+    # Output channels of every layer, None where unknown
+    widths = []
+    for m in layers:
+        src = [len(widths) - 1 if x == -1 else x for x in ([m.f] if isinstance(m.f, int) else m.f)]
+        if isinstance(m, Concat):
+            w = None if any(widths[x] is None for x in src) else sum(widths[x] for x in src)
+        elif isinstance(m, nn.Upsample):
+            w = widths[src[0]]
+        else:
+            p = _producer(m)
+            w = None if p is None else _conv(p).out_channels
+        widths.append(w)
+    return widths
+
+
+def prune_layers(model, ratio=0.3, divisor=8):
+    """
+    Prune the output channels of every layer whose readers can all follow, returns the number of channels removed
+
+    A layer output is read by the next layer or by later layers listed in their `from`, directly or through Concat
+    (at the sum of the preceding input widths) and nn.Upsample. Detect() reads each input with one output conv.
+    """
+    layers, n = model.model, 0
+    for i, m in enumerate(layers[:-1]):
+        p = _producer(m)
+        if p is None:
+            continue
+        readers = _readers(layers, i, _widths(layers))  # Concat offsets change as earlier layers are pruned
+        if readers is None:
+            continue
+        consumers = {}  # module -> offsets
+        for r, o in readers:
+            consumers.setdefault(r, []).append(o)
+        n += prune_group([p], list(consumers.items()), ratio, divisor)
+    return n
+
+
+def prune_model(model, ratio=0.3, divisor=8):
+    # Prune block-internal channels and layer outputs of model in place, returns the number of channels removed
+    n = 0
+    for m in model.modules():
+        if type(m) is C3:  # not C3x/C3TR/C3SPP/C3Ghost, their m blocks differ
+            if all(b.add for b in m.m):  # residual chain, cv1 and every Bottleneck output are summed
+                n += prune_group([m.cv1, *(b.cv2 for b in m.m)], [*((b.cv1, [0]) for b in m.m), (m.cv3, [0])], ratio,
+                                 divisor)
+            else:  # plain chain, each link has its own mask
+                chain, readers = [m.cv1, *(b.cv2 for b in m.m)], [*(b.cv1 for b in m.m), m.cv3]
+                n += sum(prune_group([p], [(r, [0])], ratio, divisor) for p, r in zip(chain, readers))
+            n += prune_group([m.cv2], [(m.cv3, [m.cv3.conv.in_channels - m.cv2.conv.out_channels])], ratio, divisor)
+        elif isinstance(m, Bottleneck):  # hidden channels, also inside C3.m
+            n += prune_group([m.cv1], [(m.cv2, [0])], ratio, divisor)
+        elif isinstance(m, C2fDCB):
+            for d in m.m:
+                if d.shortcut and hasattr(d, 'cv2'):  # built but unused with a residual, dropped here
+                    del d.cv2
+            n += prune_c2fdcb(m, ratio, divisor)
+            for d in m.m:
+                if not d.shortcut:  # hidden channels, cv2 reads torch.cat([x, cv1(x)])
+                    n += prune_group([d.cv1], [(d.cv2, [d.cv2.conv.in_channels - d.cv1.conv.out_channels])], ratio,
+                                     divisor)
+        elif isinstance(m, SPPF):
+            c = m.cv1.conv.out_channels
+            n += prune_group([m.cv1], [(m.cv2, [0, c, 2 * c, 3 * c])], ratio, divisor)  # torch.cat((x, y1, y2, y3))
+    return n + prune_layers(model, ratio, divisor)
+
+
+def finetune(model, data, imgsz, epochs=10, batch_size=16, lr=0.001, workers=8, device='cpu'):
+    # Recover accuracy with a short plain training run on a labeled image folder, no augmentation
+    model.hyp = getattr(model, 'hyp', None) or HYP  # ComputeLoss reads model.hyp
+    loader, _ = create_dataloader(data,
+                                  max(imgsz),
+                                  batch_size,
+                                  max(int(model.stride.max()), 32),
+                                  hyp=model.hyp,
+                                  workers=workers,
+                                  prefix=colorstr('finetune: '),
+                                  shuffle=True)
+    for p in model.parameters():
+        p.requires_grad = True  # stripped checkpoints are frozen
+    compute_loss = ComputeLoss(model)
+    optimizer = smart_optimizer(model, 'SGD', lr, momentum=0.937, decay=5e-4)
+    model.train()
+    for epoch in range(epochs):
+        mloss = torch.zeros(3, device=device)  # mean losses
+        for i, (imgs, targets, _, _) in enumerate(loader):
+            imgs = imgs.to(device, non_blocking=True).float() / 255  # uint8 to float32, 0-255 to 0.0-1.0
+            loss, loss_items = compute_loss(model(imgs), targets.to(device))
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            mloss = (mloss * i + loss_items) / (i + 1)
+        LOGGER.info(f"{PREFIX} fine-tune epoch {epoch + 1}/{epochs} box, obj, cls loss {mloss.tolist()}")
+    return model.eval()
+
+
+def run(
+        weights=ROOT / 'yolov5s.pt',  # model.pt path
+        ratio=0.3,  # fraction of block-internal channels to remove
+        divisor=8,  # kept channel counts are multiples of this
+        holdout=ROOT / 'data/images',  # labeled hold-out image folder for latency and count error
+        data='',  # labeled training image folder, fine-tune if set
+        epochs=10,  # fine-tuning epochs
+        batch_size=16,  # fine-tuning batch size
+        lr=0.001,  # fine-tuning learning rate
+        workers=8,  # max dataloader workers
+        imgsz=(640, 640),  # inference size (height, width)
+        conf_thres=0.7,  # confidence threshold
+        iou_thres=0.5,  # NMS IOU threshold
+        max_det=1000,  # maximum detections per image
+        device='cpu',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+):
+    imgsz = check_img_size(list(imgsz) * (3 - len(imgsz)), s=32)  # expand and check
+    device = select_device(device)
+    w = Path(weights)
+    f = w.with_name(f'{w.stem}_pruned.pt')
+
+    model = attempt_load(w, device=device, fuse=False)  # keep BatchNorm for ranking and fine-tuning
+    size = model_info(model, imgsz=imgsz)
+    n = prune_model(model, ratio, divisor)
+    LOGGER.info(f'{PREFIX} removed {n} channels')
+    if data and epochs:
+        model = finetune(model, data, imgsz, epochs, batch_size, lr, workers, device)
+    pruned_size = model_info(model, imgsz=imgsz)
+    model.pruned = ratio
+    ckpt = {
+        'epoch': -1,
+        'best_fitness': None,
+        'model': deepcopy(model).half(),
+        'ema': None,
+        'updates': None,
+        'optimizer': None,
+        'date': datetime.now().isoformat()}
+    torch.save(ckpt, f)
+
+    # Before and after on the hold-out set, CPU latency unless another device is selected
+    before, after = (evaluate(x, holdout, imgsz, conf_thres, iou_thres, max_det, device) for x in (w, f))
+    report = {}
+    LOGGER.info(f"\n{PREFIX} {'':<8}{'params':>12}{'GFLOPs':>10}{'ms/img':>10}{'MAE':>8}{'MAPE %':>10}")
+    for k, (p, g), r in ('before', size, before), ('after', pruned_size, after):
+        report[k] = {'params': p, 'gflops': g, **r}
+        LOGGER.info(f"{PREFIX} {k:<8}{p:>12}{g:>10.1f}{r['latency_ms']:>10.1f}{r['mae']:>8.2f}{r['mape']:>10.2f}")
+    report.update(ratio=ratio, channels_removed=n, finetuned=bool(data and epochs))
+    f.with_name(f'{f.stem}_report.json').write_text(json.dumps(report, indent=2))
+    LOGGER.info(f"{PREFIX} saved {colorstr('bold', f)}")
+    return report
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', type=str, default=ROOT / 'yolov5s.pt', help='model.pt path')
+    parser.add_argument('--ratio', type=float, default=0.3, help='fraction of block-internal channels to remove')
+    parser.add_argument('--divisor', type=int, default=8, help='kept channel counts are multiples of this')
+    parser.add_argument('--holdout', type=str, default=ROOT / 'data/images', help='labeled hold-out image folder')
+    parser.add_argument('--data', type=str, default='', help='labeled training image folder, fine-tune if set')
+    parser.add_argument('--epochs', type=int, default=10, help='fine-tuning epochs')
+    parser.add_argument('--batch-size', type=int, default=16, help='fine-tuning batch size')
+    parser.add_argument('--lr', type=float, default=0.001, help='fine-tuning learning rate')
+    parser.add_argument('--workers', type=int, default=8, help='max dataloader workers')
+    parser.add_argument('--imgsz', '--img', '--img-size', nargs='+', type=int, default=[640], help='inference size h,w')
+    parser.add_argument('--conf-thres', type=float, default=0.7, help='confidence threshold')
+    parser.add_argument('--iou-thres', type=float, default=0.5, help='NMS IoU threshold')
+    parser.add_argument('--max-det', type=int, default=1000, help='maximum detections per image')
+    parser.add_argument('--device', default='cpu', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    opt = parser.parse_args()
+    print_args(vars(opt))
+    return opt
+
+
+def main(opt):
+    run(**vars(opt))
+
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    main(opt)
@@ -0,0 +1,248 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+INT8 post-training quantization of a YOLOv5 detector with a plant-count accuracy guard
+
+Calibrates on a folder of our own field images, quantizes the FP32 model with OpenVINO NNCF, ONNX Runtime or PyTorch
+FX graph mode (torch.ao, no extra dependencies) and compares plant counts (MAE/MAPE against the labels) and latency of
+the FP32 and INT8 models on a labeled hold-out set. The INT8 model is only accepted if its count error stays within
+tolerance of the FP32 model, otherwise it is deleted and the script exits with status 1.
+
+Usage:
+    $ python quantize.py --weights yolov5_best.pt --calib ../fields/calib --holdout ../fields/holdout/images
+    $ python quantize.py --weights yolov5_best.pt --calib ../fields/calib --holdout ../fields/holdout/images \
+                         --method onnxruntime --max-mae-delta 0.5 --max-mape-delta 1.0
+    $ python quantize.py --weights yolov5_best.pt --calib ../fields/calib --holdout ../fields/holdout/images \
+                         --method torch  # yolov5_best_int8.pt, loads with DetectMultiBackend like any *.pt
+
+Hold-out layout:
+    holdout/images/*.jpg   field images
+    holdout/labels/*.txt   YOLO labels, one line per plant, the line count is the true plant count
+"""
+
+import argparse
+import io
+import json
+import os
+import shutil
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import torch
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[0]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
+
+from models.common import DetectMultiBackend
+from utils.dataloaders import LoadImages, img2label_paths
+from utils.general import (LOGGER, Profile, check_img_size, check_requirements, colorstr, non_max_suppression,
+                           print_args, yaml_save)
+from utils.onnx_backend import export_cached
+from utils.torch_utils import select_device, smart_inference_mode
+
+PREFIX = colorstr('Quantize:')
+METHODS = 'openvino', 'onnxruntime', 'torch'
+
+
+def calibration_images(source, imgsz, stride=32, n=300):
+    # Up to n letterboxed (1, 3, h, w) float32 inputs from an image folder
+    dataset = LoadImages(source, img_size=imgsz, stride=stride, auto=False)
+    for i, (_, im, _, _, _) in enumerate(dataset):
+        if i >= n:
+            break
+        yield im[None].astype(np.float32) / 255  # uint8 to float32, 0 - 255 to 0.0 - 1.0
+
+
+def export_static(w, imgsz):
+    # FP32 ONNX export with a static input shape, INT8 calibrates best on fixed shapes
+    f = export_cached(w, imgsz, dynamic=False)
+    assert f, f'ONNX export of {w} failed'
+    return f
+
+
+def quantize_openvino(w, calib, imgsz, n, metadata):
+    # FP32 and INT8 OpenVINO IR of the ONNX export, INT8 calibrated with NNCF, returns (fp32 dir, int8 dir)
+    check_requirements(('openvino-dev>=2023.0', 'nncf>=2.4.0'))
+    import nncf
+    import openvino.runtime as ov
+
+    f_onnx = export_static(w, imgsz)
+
+    f32, f8 = (w.with_name(f'{w.stem}_{s}_openvino_model') for s in ('fp32', 'int8'))  # next to the weights
+    model = ov.Core().read_model(str(f_onnx))
+    data = list(calibration_images(calib, imgsz, n=n))
+    LOGGER.info(f'{PREFIX} calibrating OpenVINO INT8 on {len(data)} images from {calib}...')
+    quantized = nncf.quantize(model,
+                              nncf.Dataset(data),
+                              preset=nncf.QuantizationPreset.MIXED,
+                              subset_size=len(data),
+                              ignored_scope=nncf.IgnoredScope(types=['Multiply', 'Subtract', 'Sigmoid']))  # Detect()
+    for f, m in (f32, model), (f8, quantized):
+        f.mkdir(parents=True, exist_ok=True)
+        ov.serialize(m, str(f / f'{f.name}.xml'))
+        yaml_save(f / f'{f.name}.yaml', metadata)  # stride and names for DetectMultiBackend
+    return f32, f8
+
+
+def quantize_onnxruntime(w, calib, imgsz, n, metadata):
+    # INT8 QDQ ONNX model of the ONNX export calibrated with ONNX Runtime, returns (fp32 file, int8 file)
+    check_requirements(('onnx', 'onnxruntime'))
+    import onnx
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+
+    class Reader(CalibrationDataReader):
+        def __init__(self):
+            self.data = ({'images': x} for x in calibration_images(calib, imgsz, n=n))
+
+        def get_next(self):
+            return next(self.data, None)
+
+    f_onnx = export_static(w, imgsz)
+    f8 = w.with_name(f'{w.stem}_int8.onnx')  # next to the weights
+    LOGGER.info(f'{PREFIX} calibrating ONNX Runtime INT8 on up to {n} images from {calib}...')
+    quantize_static(str(f_onnx),
+                    str(f8),
+                    Reader(),
+                    quant_format=QuantFormat.QDQ,
+                    op_types_to_quantize=['Conv'],  # Detect() box decoding stays FP32
+                    per_channel=True,
+                    activation_type=QuantType.QUInt8,
+                    weight_type=QuantType.QInt8)
+    model = onnx.load(str(f8))
+    del model.metadata_props[:]
+    for k, v in metadata.items():  # stride and names for DetectMultiBackend
+        meta = model.metadata_props.add()
+        meta.key, meta.value = k, str(v)
+    onnx.save(model, str(f8))
+    return Path(f_onnx), f8
+
+
+def quantize_torch(w, calib, imgsz, n, metadata):
+    # INT8 QuantizedModel *.pt of the fused PyTorch model, FX graph mode with Detect() in float, returns (w, int8 file)
+    from models.experimental import attempt_load
+    from models.yolo import QuantizedModel
+
+    model = attempt_load(w, device=torch.device('cpu'), fuse=True)
+    engine = torch.backends.quantized.engine
+    LOGGER.info(f'{PREFIX} calibrating PyTorch {engine} INT8 on up to {n} images from {calib}...')
+    model = QuantizedModel(model, (torch.from_numpy(x) for x in calibration_images(calib, imgsz, n=n)), imgsz)
+    f8 = w.with_name(f'{w.stem}_int8.pt')  # next to the weights
+    buffer = io.BytesIO()
+    torch.save(model, buffer)  # unpickled by attempt_load() under model.engine, see load_quantized()
+    torch.save({'model': buffer.getvalue(), 'date': datetime.now().isoformat(), 'quantized': model.engine}, f8)
+    return w, f8
+
+
+@smart_inference_mode()
+def evaluate(w, holdout, imgsz, conf_thres, iou_thres, max_det, device):
+    # Plant count MAE/MAPE against the hold-out labels and mean latency of model w
+    model = DetectMultiBackend(w, device=device)
+    dataset = LoadImages(holdout, img_size=imgsz, stride=model.stride, auto=False)
+    labels = img2label_paths(dataset.files)
+    truth = [sum(1 for line in open(f) if line.strip()) if os.path.isfile(f) else 0 for f in labels]  # plant counts
+    model(torch.zeros(1, 3, *imgsz, device=model.device))  # warmup
+    counts, dt = [], Profile()
+    for _, im, _, _, _ in dataset:
+        im = torch.from_numpy(im).to(model.device).float()[None] / 255  # uint8 to float32, 0 - 255 to 0.0 - 1.0
+        with dt:
+            pred = model(im)
+        counts.append(len(non_max_suppression(pred, conf_thres, iou_thres, max_det=max_det)[0]))
+    c, t = np.array(counts, dtype=float), np.array(truth, dtype=float)
+    err = np.abs(c - t)
+    return {
+        'model': str(w),
+        'images': len(c),
+        'mae': float(err.mean()),
+        'mape': float((err[t > 0] / t[t > 0]).mean() * 100) if (t > 0).any() else 0.0,  # %
+        'latency_ms': dt.t / max(len(c), 1) * 1E3,
+        'counts': counts}
+
+
+def run(
+        weights=ROOT / 'yolov5s.pt',  # FP32 weights
+        calib=ROOT / 'data/images',  # calibration image folder
+        holdout=ROOT / 'data/images',  # labeled hold-out image folder
+        method='openvino',  # openvino (NNCF), onnxruntime or torch (FX graph mode)
+        imgsz=(640, 640),  # inference size (height, width)
+        n=300,  # maximum calibration images
+        conf_thres=0.7,  # confidence threshold
+        iou_thres=0.5,  # NMS IOU threshold
+        max_det=1000,  # maximum detections per image
+        max_mae_delta=0.5,  # accept INT8 if its count MAE exceeds FP32 by at most this many plants
+        max_mape_delta=1.0,  # accept INT8 if its count MAPE exceeds FP32 by at most this many percentage points
+        keep_rejected=False,  # keep the INT8 model even if it fails the count guard
+        device='cpu',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+):
+    imgsz = check_img_size(list(imgsz) * (3 - len(imgsz)), s=32)  # expand and check
+    device = select_device('cpu' if method == 'torch' else device)  # quantized PyTorch kernels are CPU-only
+
+    fp32 = DetectMultiBackend(weights, device=torch.device('cpu'), fuse=False)
+    metadata = {'stride': int(fp32.stride), 'names': fp32.names}
+    quantize = {'openvino': quantize_openvino, 'onnxruntime': quantize_onnxruntime, 'torch': quantize_torch}[method]
+    f32, f8 = quantize(Path(weights), calib, imgsz, n, metadata)
+
+    # Count guard on the hold-out set
+    r32, r8 = (evaluate(f, holdout, imgsz, conf_thres, iou_thres, max_det, device) for f in (f32, f8))
+    accepted = r8['mae'] <= r32['mae'] + max_mae_delta and r8['mape'] <= r32['mape'] + max_mape_delta
+    LOGGER.info(f"\n{PREFIX} {'':<6}{'MAE':>8}{'MAPE %':>10}{'ms/img':>10}")
+    for k, r in ('FP32', r32), ('INT8', r8):
+        LOGGER.info(f"{PREFIX} {k:<6}{r['mae']:>8.2f}{r['mape']:>10.2f}{r['latency_ms']:>10.1f}")
+    LOGGER.info(f"{PREFIX} INT8 MAE {r8['mae'] - r32['mae']:+.2f}, MAPE {r8['mape'] - r32['mape']:+.2f}%, "
+                f"speedup {r32['latency_ms'] / max(r8['latency_ms'], 1E-9):.2f}x, "
+                f"count guard MAE +{max_mae_delta}, MAPE +{max_mape_delta}%: {'PASS ✅' if accepted else 'FAIL ❌'}")
+
+    report = {
+        'method': method,
+        'imgsz': imgsz,
+        'accepted': accepted,
+        'tolerance': {
+            'max_mae_delta': max_mae_delta,
+            'max_mape_delta': max_mape_delta},
+        'delta': {
+            'mae': r8['mae'] - r32['mae'],
+            'mape': r8['mape'] - r32['mape'],
+            'speedup': r32['latency_ms'] / max(r8['latency_ms'], 1E-9)},
+        'fp32': r32,
+        'int8': r8}
+    f = Path(f8).with_name(f'{Path(f8).stem}_report.json')
+    f.write_text(json.dumps(report, indent=2))
+    if accepted:
+        LOGGER.info(f"{PREFIX} INT8 model accepted: {colorstr('bold', f8)}")
+    elif not keep_rejected:
+        shutil.rmtree(f8) if Path(f8).is_dir() else Path(f8).unlink()
+        LOGGER.warning(f'{PREFIX} WARNING ⚠️ INT8 model rejected and deleted, see {f}')
+    return report
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', type=str, default=ROOT / 'yolov5s.pt', help='FP32 model.pt path')
+    parser.add_argument('--calib', type=str, default=ROOT / 'data/images', help='calibration image folder')
+    parser.add_argument('--holdout', type=str, default=ROOT / 'data/images', help='labeled hold-out image folder')
+    parser.add_argument('--method', default='openvino', choices=METHODS, help='INT8 toolchain')
+    parser.add_argument('--imgsz', '--img', '--img-size', nargs='+', type=int, default=[640], help='inference size h,w')
+    parser.add_argument('--n', type=int, default=300, help='maximum calibration images')
+    parser.add_argument('--conf-thres', type=float, default=0.7, help='confidence threshold')
+    parser.add_argument('--iou-thres', type=float, default=0.5, help='NMS IoU threshold')
+    parser.add_argument('--max-det', type=int, default=1000, help='maximum detections per image')
+    parser.add_argument('--max-mae-delta', type=float, default=0.5, help='allowed INT8 count MAE increase (plants)')
+    parser.add_argument('--max-mape-delta', type=float, default=1.0, help='allowed INT8 count MAPE increase (%%)')
+    parser.add_argument('--keep-rejected', action='store_true', help='keep the INT8 model if the count guard fails')
+    parser.add_argument('--device', default='cpu', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    opt = parser.parse_args()
+    print_args(vars(opt))
+    return opt
+
+
+def main(opt):
+    report = run(**vars(opt))
+    sys.exit(0 if report['accepted'] else 1)
+
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    main(opt)
@@ -0,0 +1,111 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Dynamic micro-batching of concurrent detection requests
+
+Requests from different threads are collected for up to max_wait_ms or until max_batch images are queued, grouped by
+letterboxed shape and NMS settings, and run as one batched forward pass plus one batched non_max_suppression() call.
+Larger max_batch / max_wait_ms trade tail latency for throughput.
+
+Usage:
+    from utils.registry import load_scheduler
+
+    scheduler = load_scheduler('yolov5_best.pt', max_batch=8, max_wait_ms=10)
+    det = scheduler(im, conf_thres=0.25)  # im (3, h, w) preprocessed tensor -> det (n, 6) in letterbox coordinates
+"""
+
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+
+import torch
+
+from utils.general import LOGGER, non_max_suppression
+from utils.torch_utils import smart_inference_mode
+
+
+class BatchScheduler:
+    # Single worker thread that coalesces concurrent single-image requests into batched forward passes
+    def __init__(self, model, max_batch=8, max_wait_ms=10):
+        self.model = model
+        self.batching = model.pt or model.jit or getattr(model, 'dynamic', False)  # backend takes any batch size
+        if max_batch > 1 and not self.batching:
+            LOGGER.warning('WARNING ⚠️ micro-batching needs a dynamic batch size, using batch size 1 for this backend')
+            max_batch = 1
+        self.max_batch = max_batch  # images per forward pass
+        self.max_wait = max_wait_ms / 1E3  # seconds to wait for more requests after the first one arrives
+        self.queue = queue.Queue()
+        self.closed = False
+        self.lock = threading.Lock()  # orders submit() puts before the close() sentinel
+        self.thread = threading.Thread(target=self._loop, name='batch-scheduler', daemon=True)
+        self.thread.start()
+
+    def submit(self, im, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, max_det=1000, dense=False):
+        """Queue one preprocessed (3, h, w) image, returns a Future resolving to its (n, 6) detections"""
+        assert im.ndim == 3, f'expected one (3, h, w) image, got shape {tuple(im.shape)}'
+        key = (tuple(im.shape), im.dtype, conf_thres, iou_thres, tuple(classes) if classes is not None else None,
+               agnostic, max_det, dense)  # requests that can share a forward pass and an NMS call
+        f = Future()
+        with self.lock:
+            if self.closed:  # i.e. evicted from the registry, nothing would ever run this request
+                raise RuntimeError('BatchScheduler is closed')
+            self.queue.put((key, im, f))
+        return f
+
+    def __call__(self, im, *args, **kwargs):
+        # Blocking submit()
+        return self.submit(im, *args, **kwargs).result()
+
+    def close(self):
+        # Finish the queued requests and stop the worker thread, later submit() calls raise
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                self.queue.put(None)
+        self.thread.join()
+
+    def _collect(self):
+        # Block for the first request, then gather more until the batch is full or max_wait has passed
+        item = self.queue.get()
+        if item is None:
+            return None
+        items, deadline = [item], time.monotonic() + self.max_wait
+        while len(items) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self.queue.put(None)  # stop after this batch
+                break
+            items.append(item)
+        return items
+
+    def _loop(self):
+        while True:
+            items = self._collect()
+            if items is None:
+                break
+            groups = defaultdict(list)
+            for key, im, f in items:
+                if f.set_running_or_notify_cancel():
+                    groups[key].append((im, f))
+            for key, group in groups.items():
+                self._run(key, group)
+
+    @smart_inference_mode()
+    def _run(self, key, group):
+        # One forward pass and one NMS call for a group of same-shape requests, results scattered back to the callers
+        _, _, conf_thres, iou_thres, classes, agnostic, max_det, dense = key
+        try:
+            im = torch.stack([x for x, _ in group])
+            pred = self.model(im)
+            pred = non_max_suppression(pred, conf_thres, iou_thres, classes, agnostic, max_det=max_det, dense=dense)
+        except Exception as e:
+            for _, f in group:
+                f.set_exception(e)
+            return
+        for det, (_, f) in zip(pred, group):
+            f.set_result(det)
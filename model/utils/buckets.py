@@ -0,0 +1,69 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Shape buckets: a small set of canonical input shapes for inference
+
+Letterboxing with auto=True gives every image aspect ratio its own input shape, and Detect() grids, oneDNN primitives,
+traced TorchScript graphs (compiled.py) and static exports are all built per input shape. Padding every image into the
+nearest of a few canonical shapes keeps the set of shapes small and known in advance, so all of them are warmed up (and
+exported) at load time and steady-state inference never hits a cold path.
+
+Buckets are written as width x height, i.e. 1024x768 for landscape 4:3 frames, and returned as (h, w) like imgsz.
+
+Usage:
+    from utils.buckets import parse_buckets, select_bucket
+
+    buckets = parse_buckets('640x640,640x480,1024x768')  # [(480, 640), (640, 640), (768, 1024)]
+    im = letterbox(im0, select_bucket(im0.shape, buckets, imgsz=640), stride=32, auto=False)[0]
+"""
+
+import math
+
+from utils.general import check_img_size
+
+
+def parse_buckets(buckets, s=32):
+    """Sorted unique (h, w) bucket shapes, multiples of stride s
+
+    Arguments:
+        buckets: None, 'WxH,WxH' string, or a list of 'WxH' strings, (h, w) pairs or square sizes
+    """
+    if not buckets:
+        return []
+    if isinstance(buckets, str):
+        buckets = buckets.replace(',', ' ').split()
+    shapes = set()
+    for b in buckets:
+        if isinstance(b, str):
+            w, h = (int(x) for x in b.lower().replace('×', 'x').split('x'))
+        else:
+            h, w = (b, b) if isinstance(b, int) else b
+        shapes.add(tuple(check_img_size([h, w], s=s)))
+    return sorted(shapes, key=lambda x: (x[0] * x[1], x))
+
+
+def select_bucket(shape, buckets, imgsz=640):
+    """The bucket an image of shape (h, w) is letterboxed into
+
+    Prefers the bucket that keeps the image closest to the scale imgsz would give it, with the least padding.
+    """
+    h, w = shape[:2]
+    imgsz = (imgsz, imgsz) if isinstance(imgsz, int) else imgsz
+    r0 = min(imgsz[0] / h, imgsz[1] / w)  # scale without buckets
+
+    def cost(b):
+        r = min(b[0] / h, b[1] / w)  # letterbox scale
+        return abs(math.log(r / r0)) + 1 - (r * h) * (r * w) / (b[0] * b[1])  # scale change + padded fraction
+
+    return min(buckets, key=cost)
+
+
+def export_buckets(weights, buckets, **kwargs):
+    """Static-shape ONNX exports of weights, one per bucket, returns {(h, w): file or None if the export failed}
+
+    Exports are cached next to the weights like the dynamic export in onnx_backend.py, so runtimes that need fixed
+    shapes (OpenVINO, TensorRT) reuse one file per bucket instead of re-exporting per image shape.
+    CLI: python export.py --weights yolov5_best.pt --include onnx --buckets 640x640,640x480,1024x768
+    """
+    from utils.onnx_backend import export_cached
+
+    return {b: export_cached(weights, b, dynamic=False, **kwargs) for b in buckets}
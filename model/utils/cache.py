@@ -0,0 +1,145 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Content-addressed detection result cache
+
+Results are keyed by image content hash + weights content hash + inference parameters, so repeated uploads of the same
+frame and re-runs with the same settings return instantly. Images are hashed as encoded bytes or as a memoized file hash
+where possible, so a hit never decodes the image. Entries are evicted least-recently-used once either the
+entry or the byte budget is exceeded, and identical concurrent requests are single-flighted so only one inference runs.
+
+Usage:
+    from utils.cache import RESULT_CACHE
+
+    key = RESULT_CACHE.key(im0, 'yolov5_best.pt', conf_thres=0.7)
+    result, hit = RESULT_CACHE.get_or_compute(key, lambda: detect(im0, 'yolov5_best.pt', conf_thres=0.7))
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+
+import numpy as np
+
+_FILE_HASHES = {}  # (path, size, mtime) -> sha256 hexdigest
+_FILE_HASHES_LOCK = threading.Lock()
+
+
+def file_hash(path, chunk=1 << 20):
+    # SHA256 of a file's contents, memoized on (path, size, mtime) so large weights are hashed once
+    p = Path(path).resolve()
+    st = p.stat()
+    k = str(p), st.st_size, st.st_mtime_ns
+    with _FILE_HASHES_LOCK:
+        if k in _FILE_HASHES:
+            return _FILE_HASHES[k]
+    h = hashlib.sha256()
+    with open(p, 'rb') as f:
+        for b in iter(lambda: f.read(chunk), b''):
+            h.update(b)
+    with _FILE_HASHES_LOCK:
+        _FILE_HASHES[k] = h.hexdigest()
+    return _FILE_HASHES[k]
+
+
+def content_hash(x):
+    # SHA256 of encoded image bytes or of a decoded image array (shape and dtype included)
+    h = hashlib.sha256()
+    if isinstance(x, np.ndarray):
+        h.update(f'{x.shape}{x.dtype}'.encode())
+        h.update(np.ascontiguousarray(x).data)
+    else:
+        h.update(x)
+    return h.hexdigest()
+
+
+def weights_hash(weights):
+    # Content hash of one or more weights files, falls back to the name for weights that are not local files
+    w = weights if isinstance(weights, (list, tuple)) else [weights]
+    return hashlib.sha256(''.join(file_hash(x) if Path(str(x)).is_file() else str(x) for x in w).encode()).hexdigest()
+
+
+def result_nbytes(result):
+    # Approximate memory held by a cached result
+    return getattr(result.boxes, 'nbytes', 0) + len(result.image or b'')
+
+
+class ResultCache:
+    # Thread-safe LRU cache of detection results with single-flight computation
+    def __init__(self, max_items=256, max_bytes=512 << 20):
+        self.max_items = max_items  # maximum number of cached results
+        self.max_bytes = max_bytes  # maximum total size of cached boxes and encoded images
+        self.results = OrderedDict()  # key -> result, least recently used first
+        self.nbytes = 0
+        self.inflight = {}  # key -> Future of the running computation
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(source, weights, **params):
+        # Cache key for an image (path, bytes or np.ndarray), weights and the inference parameters affecting the result
+        params = json.dumps(params, sort_keys=True, default=str)
+        h = file_hash(source) if isinstance(source, (str, Path)) else content_hash(source)
+        return f'{h}:{weights_hash(weights)}:{hashlib.sha256(params.encode()).hexdigest()}'
+
+    def get(self, key):
+        with self.lock:
+            result = self.results.get(key)
+            if result is not None:
+                self.results.move_to_end(key)
+            return result
+
+    def put(self, key, result):
+        n = result_nbytes(result)
+        with self.lock:
+            if n > self.max_bytes:
+                return
+            if key in self.results:
+                self.nbytes -= result_nbytes(self.results.pop(key))
+            self.results[key] = result
+            self.nbytes += n
+            while len(self.results) > self.max_items or self.nbytes > self.max_bytes:
+                self.nbytes -= result_nbytes(self.results.popitem(last=False)[1])  # evict least recently used
+
+    def get_or_compute(self, key, fn):
+        """Return (result, hit), running fn() only once for concurrent requests with the same key"""
+        with self.lock:
+            result = self.results.get(key)
+            if result is not None:
+                self.results.move_to_end(key)
+                self.hits += 1
+                return result, True
+            f = self.inflight.get(key)
+            leader = f is None
+            if leader:
+                f = self.inflight[key] = Future()
+                self.misses += 1
+            else:
+                self.hits += 1
+        if not leader:
+            return f.result(), True  # wait for the running computation, re-raises its exception
+        try:
+            result = fn()
+        except BaseException as e:
+            f.set_exception(e)
+            raise
+        else:
+            f.set_result(result)
+            self.put(key, result)
+            return result, False
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self.results)
+
+
+RESULT_CACHE = ResultCache()  # process-wide instance
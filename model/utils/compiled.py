@@ -0,0 +1,105 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Compiled execution mode for fused PyTorch detection models
+
+The eager DetectionModel runs a Python loop over its layers with NCHW tensors. CompiledModel traces the fused model
+(including the custom C2fDCB/SCDown blocks) once per input shape into a frozen TorchScript graph in channels_last,
+which lets oneDNN pick its blocked CPU kernels. Traced graphs are cached on disk next to the weights, keyed by weights
+content, input shape, dtype and torch version, so later processes skip tracing.
+
+Usage:
+    from utils.registry import load_model
+
+    model = load_model('yolov5_best.pt', compiled=True)  # DetectMultiBackend running a CompiledModel
+"""
+
+import threading
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+
+from utils.cache import file_hash
+from utils.general import LOGGER, colorstr
+
+PREFIX = colorstr('Compiled:')
+
+
+class _Predictions(nn.Module):
+    # Trace target: inference predictions only, Detect() also returns the raw per-level maps
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(x)[0]
+
+
+class CompiledModel(nn.Module):
+    """
+    Drop-in replacement for DetectMultiBackend.model that runs one frozen TorchScript graph per input shape
+
+    Arguments:
+        model: fused DetectionModel in eval mode
+        weights: weights file, names the on-disk cache and keys it by content
+        shapes: (b, ch, h, w) shapes to compile ahead of time, others are compiled on first use
+        max_shapes: shapes beyond this many run eagerly instead of compiling yet another graph
+        cache_dir: directory for compiled graphs, defaults to <weights dir>/.compiled
+    """
+
+    def __init__(self, model, weights, shapes=(), max_shapes=8, cache_dir=None):
+        super().__init__()
+        self.model = model.to(memory_format=torch.channels_last)
+        self.stride, self.names = model.stride, model.names
+        self.uint8_input, self.bgr_input = getattr(model, 'uint8_input', False), getattr(model, 'bgr_input', False)
+        w = Path(weights)
+        self.cache_dir = Path(cache_dir or w.parent / '.compiled')
+        self.prefix = f'{w.stem}_{file_hash(w)[:12]}' if w.is_file() else w.stem
+        if self.uint8_input:  # folded first Conv, see BaseModel.fold_input()
+            self.prefix += '_bgr' if self.bgr_input else '_rgb'
+        self.max_shapes = max_shapes
+        self.graphs = {}  # (shape, dtype) -> torch.jit.ScriptModule
+        self.lock = threading.Lock()
+        p = next(model.parameters())
+        for shape in shapes:
+            self.compile(torch.zeros(shape, dtype=torch.uint8 if self.uint8_input else p.dtype, device=p.device))
+
+    def file(self, x):
+        # Cache file for input x
+        s = 'x'.join(map(str, x.shape))
+        return self.cache_dir / f'{self.prefix}_{s}_{str(x.dtype)[6:]}_torch{torch.__version__.split("+")[0]}.torchscript'
+
+    def compile(self, x):
+        # Load or trace, freeze and save the graph for x's shape and dtype
+        k = tuple(x.shape), x.dtype
+        with self.lock:
+            if k in self.graphs:
+                return self.graphs[k]
+            f = self.file(x)
+            try:
+                graph = torch.jit.load(f, map_location=x.device) if f.is_file() else None
+            except Exception as e:
+                LOGGER.warning(f'{PREFIX} WARNING ⚠️ ignoring unreadable cached graph {f}: {e}')
+                graph = None
+            if graph is None:
+                LOGGER.info(f'{PREFIX} tracing {tuple(x.shape)} {x.dtype} graph...')
+                with torch.no_grad():
+                    graph = torch.jit.freeze(torch.jit.trace(_Predictions(self.model).eval(), x, check_trace=False))
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                torch.jit.save(graph, f)
+                LOGGER.info(f'{PREFIX} saved {f}')
+            graph = torch.jit.optimize_for_inference(graph.eval())  # oneDNN conv/BN/activation fusion, not serialized
+            graph(x)  # warmup, the first calls run the TorchScript profiling executor
+            self.graphs[k] = graph
+            return graph
+
+    def forward(self, x, augment=False, visualize=False):
+        if augment or visualize:
+            return self.model(x, augment=augment, visualize=visualize)
+        x = x.contiguous(memory_format=torch.channels_last)
+        graph = self.graphs.get((tuple(x.shape), x.dtype))
+        if graph is None:
+            if len(self.graphs) >= self.max_shapes:
+                return self.model(x)  # too many shapes, run eagerly
+            graph = self.compile(x)
+        return graph(x)
@@ -33,6 +33,7 @@ from utils.augmentations import (Albumentations, augment_hsv, classify_albumenta
 from utils.general import (DATASETS_DIR, LOGGER, NUM_THREADS, TQDM_BAR_FORMAT, check_dataset, check_requirements,
                            check_yaml, clean_str, cv2, is_colab, is_kaggle, segments2boxes, unzip_file, xyn2xy,
                            xywh2xyxy, xywhn2xyxy, xyxy2xywhn)
+from utils.tiling import tile_windows
 from utils.torch_utils import torch_distributed_zero_first
 
 # Parameters
@@ -425,6 +426,57 @@ class LoadStreams:
         return len(self.sources)  # 1E12 frames = 32 streams at 30 FPS for 30 years
 
 
+class LoadRasterWindows:
+    # Windowed reader for rasters larger than RAM, i.e. orthomosaics, decodes one tile window at a time
+    # Tiled TIFF/BigTIFF read only the blocks under each window, striped TIFF/JPEG/PNG are decoded strip by strip
+    def __init__(self, path, tile=640, overlap=0.2, cache_mb=256, skip_empty=True):
+        check_requirements('rasterio')
+        import rasterio
+        from rasterio.windows import Window
+
+        self.path = str(path)
+        self.Window = Window
+        self.env = rasterio.Env(GDAL_CACHEMAX=cache_mb)  # bound the GDAL block cache (MB)
+        with self.env:
+            self.src = rasterio.open(self.path)
+        self.shape = self.src.height, self.src.width
+        self.transform = self.src.transform  # pixel to map coordinates
+        self.bands = [1, 2, 3] if self.src.count >= 3 else [1]  # RGB(A) or single band
+        self.dtype = self.src.dtypes[0]
+        self.skip_empty = skip_empty  # skip windows that are entirely nodata
+        self.windows, self.cores = tile_windows(self.shape, tile, overlap)  # row-major, sequential reads for strips
+        self.mode = 'image'
+
+    def __iter__(self):
+        self.count = 0
+        return self
+
+    def __next__(self):
+        while self.count < len(self.windows):
+            i = self.count
+            self.count += 1
+            x1, y1, x2, y2 = (int(x) for x in self.windows[i])
+            window = self.Window(x1, y1, x2 - x1, y2 - y1)
+            with self.env:
+                if self.skip_empty and not self.src.read_masks(1, window=window).any():
+                    continue  # nodata border of the orthomosaic
+                im = self.src.read(self.bands, window=window)  # CHW RGB
+            if self.dtype == 'uint16':
+                im = (im >> 8).astype(np.uint8)  # 16 to 8 bit
+            elif self.dtype != 'uint8':
+                im = np.clip(im, 0, 255).astype(np.uint8)
+            im = im.transpose((1, 2, 0))  # CHW to HWC
+            im0 = np.ascontiguousarray(im[..., ::-1] if im.shape[2] == 3 else np.repeat(im, 3, axis=2))  # to BGR
+            return self.windows[i], self.cores[i], im0
+        raise StopIteration
+
+    def close(self):
+        self.src.close()
+
+    def __len__(self):
+        return len(self.windows)  # number of windows
+
+
 def img2label_paths(img_paths):
     # Define label paths as a function of image paths
     sa, sb = f'{os.sep}images{os.sep}', f'{os.sep}labels{os.sep}'  # /images/, /labels/ substrings
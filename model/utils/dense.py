@@ -0,0 +1,128 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Dense-scene suppression for frames with thousands of small, evenly spaced objects (i.e. corn at the 4-6 leaf stage)
+
+torchvision.ops.nms() compares every box with every higher-scoring box, so non_max_suppression() caps its input at
+max_nms candidates and its output at max_det boxes per image. grid_suppression() hashes box centres into a uniform grid
+sized to the boxes, compares each box only with the boxes in its 3x3 cell neighbourhood and resolves the sparse
+suppression graph with exact greedy NMS semantics, in near-linear time and without caps. The rare boxes much larger
+than the grid cell are compared with all boxes of their group.
+
+Usage:
+    from utils.dense import grid_suppression
+
+    i = grid_suppression(boxes, scores, 0.5)  # indices of the kept boxes, sorted by decreasing score
+    i = grid_suppression(boxes, scores, 0.5, metric='center', keys=cls)  # centre distance, per class
+"""
+
+import torch
+
+METRICS = 'iou', 'center'
+
+
+def _reach(boxes, thres, metric):
+    # Half-extents (x, y) beyond which a box can not suppress or be suppressed by another box
+    wh = boxes[:, 2:4] - boxes[:, :2]
+    if metric == 'iou':  # overlapping boxes only
+        return wh / 2
+    s = wh.clamp(min=0).prod(1).sqrt() * thres / 2  # centre distance < thres * min(size_i, size_j)
+    return torch.stack((s, s), 1)
+
+
+def _cell_pairs(c, keys, cell):
+    # All (i, j), i < j pairs of boxes in the same or neighbouring grid cells of the same key
+    n = len(c)
+    g = (c / cell).floor().long()
+    g -= g.min(0).values - 1  # 1-based, neighbour offsets never wrap into the next row
+    nx, ny = int(g[:, 0].max()) + 2, int(g[:, 1].max()) + 2
+    h = (keys * ny + g[:, 1]) * nx + g[:, 0]  # cell hash
+    order = h.argsort()
+    hs = h[order]
+    pairs = []
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            q = h + dy * nx + dx
+            lo, hi = torch.searchsorted(hs, q), torch.searchsorted(hs, q, right=True)
+            cnt = hi - lo
+            i = torch.repeat_interleave(torch.arange(n, device=c.device), cnt)
+            start = torch.repeat_interleave(lo - (cnt.cumsum(0) - cnt), cnt)  # first slot minus first output index
+            j = order[torch.arange(len(i), device=c.device) + start]
+            pairs.append(torch.stack((i, j))[:, i < j])
+    return torch.cat(pairs, 1)
+
+
+def _large_pairs(boxes, keys, large, reach, chunk=1024):
+    # (i, j), i < j pairs of each large box with every box of its key whose reach overlaps its own
+    c = (boxes[:, :2] + boxes[:, 2:4]) / 2
+    pairs = []
+    for i in large.nonzero().view(-1).split(chunk):
+        near = ((c[i, None] - c[None]).abs() < reach[i, None] + reach[None]).all(2) & (keys[i, None] == keys[None])
+        a, j = near.nonzero(as_tuple=True)
+        a = i[a]
+        pairs.append(torch.stack((torch.minimum(a, j), torch.maximum(a, j)))[:, a != j])
+    return torch.cat(pairs, 1) if pairs else boxes.new_zeros((2, 0), dtype=torch.long)
+
+
+def _suppresses(boxes, i, j, thres, metric):
+    # Whether box i suppresses box j for each pair
+    a, b = boxes[i], boxes[j]
+    if metric == 'iou':
+        wh = (torch.minimum(a[:, 2:4], b[:, 2:4]) - torch.maximum(a[:, :2], b[:, :2])).clamp(min=0)
+        inter = wh.prod(1)
+        area = lambda x: (x[:, 2:4] - x[:, :2]).prod(1)
+        return inter / (area(a) + area(b) - inter + 1E-7) > thres
+    d = ((a[:, :2] + a[:, 2:4]) - (b[:, :2] + b[:, 2:4])).norm(dim=1) / 2  # centre distance
+    size = lambda x: (x[:, 2:4] - x[:, :2]).clamp(min=0).prod(1).sqrt()
+    return d < thres * torch.minimum(size(a), size(b))
+
+
+def greedy_keep(n, src, dst):
+    """Exact greedy NMS on a sparse suppression graph, returns a boolean keep mask
+
+    Boxes are indexed by decreasing score and every edge src -> dst (src < dst) means src suppresses dst if kept. Each
+    round keeps the undecided boxes without undecided or kept suppressors and removes the boxes with a kept suppressor,
+    which matches sequential greedy NMS. Rounds are bounded by the longest suppression chain, a few in practice.
+    """
+    state = torch.zeros(n, dtype=torch.int8, device=src.device)  # 0 undecided, 1 kept, -1 removed
+    while len(src):
+        removed = torch.zeros(n, dtype=torch.bool, device=src.device)
+        removed[dst[state[src] == 1]] = True
+        state[removed & (state == 0)] = -1
+        blocked = torch.zeros(n, dtype=torch.bool, device=src.device)
+        blocked[dst[state[src] == 0]] = True
+        state[~blocked & (state == 0)] = 1
+        live = (state[dst] == 0) & (state[src] >= 0)  # edges that can still decide a box
+        src, dst = src[live], dst[live]
+    return state >= 0
+
+
+def grid_suppression(boxes, scores, thres=0.5, metric='iou', keys=None, quantile=0.99):
+    """Greedy NMS restricted to grid neighbourhoods, exact for any box sizes and without caps
+
+    Arguments:
+        boxes: (n, 4) tensor [xyxy]
+        scores: (n) tensor
+        thres: IoU threshold ('iou'), or centre distance as a fraction of the smaller box size ('center')
+        metric: 'iou' or 'center' (True for 'iou', as in non_max_suppression(dense=True))
+        keys: (n) integer tensor, only boxes with equal keys suppress each other (i.e. image * nc + class)
+        quantile: grid cells fit this quantile of the box sizes, larger boxes are compared with their whole key
+    Returns:
+        indices of the kept boxes, sorted by decreasing score
+    """
+    metric = 'iou' if metric is True else metric
+    assert metric in METRICS, f'Invalid dense suppression metric {metric}, valid values are {METRICS}'
+    n = len(boxes)
+    if n == 0:
+        return torch.zeros(0, dtype=torch.long, device=boxes.device)
+    order = scores.argsort(descending=True, stable=True)
+    boxes = boxes[order].float()
+    keys = torch.zeros(n, dtype=torch.long, device=boxes.device) if keys is None else keys[order].long()
+
+    reach = _reach(boxes, thres, metric)
+    cell = (2 * reach.float().quantile(quantile, dim=0)).clamp(min=1E-3)  # (x, y) cell size
+    large = (2 * reach > cell).any(1)
+    pairs = _cell_pairs((boxes[:, :2] + boxes[:, 2:4]) / 2, keys, cell)
+    if large.any():
+        pairs = torch.cat((pairs, _large_pairs(boxes, keys, large, reach)), 1)
+    src, dst = pairs[:, _suppresses(boxes, pairs[0], pairs[1], thres, metric)]
+    return order[greedy_keep(n, src, dst)]
@@ -0,0 +1,21 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+File utils shared with the web app, standard library only so app.py can import them without loading torch
+"""
+
+import os
+import tempfile
+from pathlib import Path
+
+
+def write_atomic(path, data):
+    # Write bytes through a private temporary file and an atomic rename, concurrent writers never interleave and
+    # readers see either the previous file or the complete new one
+    fd, tmp = tempfile.mkstemp(suffix=Path(path).suffix, dir=Path(path).parent)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
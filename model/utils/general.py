@@ -49,6 +49,7 @@ from ultralytics.utils.checks import check_requirements
 
 from utils import TryExcept, emojis
 from utils.downloads import curl_download, gsutil_getsize
+from utils.dense import grid_suppression
 from utils.metrics import box_iou, fitness
 
 FILE = Path(__file__).resolve()
@@ -875,9 +876,17 @@ def non_max_suppression(
         labels=(),
         max_det=300,
         nm=0,  # number of masks
+        batched=True,  # one vectorized NMS call for the whole batch, False for the per-image loop
+        time_limit=None,  # per-image loop only: seconds to quit after, None to never truncate (deterministic)
+        dense=False,  # grid suppression without the max_nms/max_det caps for dense scenes, True/'iou' or 'center'
 ):
     """Non-Maximum Suppression (NMS) on inference results to reject overlapping detections
 
+    The whole batch (i.e. all tiles of an image) is filtered, scored and suppressed in one pass with boxes offset by
+    image and class, so results never depend on host speed. Autolabelling (labels) uses the per-image loop.
+    dense=True suppresses within grid neighbourhoods instead (see utils/dense.py) and keeps every box, for frames with
+    thousands of plants. Either way a warning reports images where the max_nms/max_det caps are (or would be) hit.
+
     Returns:
          list of detections, on (n,6) tensor per image [xyxy, conf, cls]
     """
@@ -887,7 +896,89 @@ def non_max_suppression(
     assert 0 <= iou_thres <= 1, f'Invalid IoU {iou_thres}, valid values are between 0.0 and 1.0'
     if isinstance(prediction, (list, tuple)):  # YOLOv5 model in validation model, output = (inference_out, loss_out)
         prediction = prediction[0]  # select only inference output
+    if labels or not (batched or dense):
+        return _non_max_suppression_loop(prediction, conf_thres, iou_thres, classes, agnostic, multi_label, labels,
+                                         max_det, nm, time_limit)
+
+    device = prediction.device
+    mps = 'mps' in device.type  # Apple MPS
+    if mps:  # MPS not fully supported yet, convert tensors to CPU before NMS
+        prediction = prediction.cpu()
+    bs = prediction.shape[0]  # batch size
+    nc = prediction.shape[2] - nm - 5  # number of classes
+    max_wh = 7680  # (pixels) maximum box width and height
+    max_nms = 30000  # maximum number of boxes per image into torchvision.ops.nms()
+    multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
+    mi = 5 + nc  # mask start index
+
+    # Candidates of all images at once, b is the image index of each row
+    b, a = (prediction[..., 4] > conf_thres).nonzero(as_tuple=True)
+    x = prediction[b, a]  # copy
+    x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+    box = xywh2xyxy(x[:, :4])  # center_x, center_y, width, height) to (x1, y1, x2, y2)
+    mask = x[:, mi:]  # zero columns if no masks
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    if multi_label:
+        i, j = (x[:, 5:mi] > conf_thres).nonzero(as_tuple=True)
+        x, b = torch.cat((box[i], x[i, 5 + j, None], j[:, None].float(), mask[i]), 1), b[i]
+    else:  # best class only
+        conf, j = x[:, 5:mi].max(1, keepdim=True)
+        keep = conf.view(-1) > conf_thres
+        x, b = torch.cat((box, conf, j.float(), mask), 1)[keep], b[keep]
+
+    # Filter by class
+    if classes is not None:
+        keep = (x[:, 5:6] == torch.as_tensor(classes, device=x.device)).any(1)
+        x, b = x[keep], b[keep]
+
+    # Sort by image, then by confidence, and keep the max_nms best boxes per image (all of them if dense)
+    n = torch.bincount(b, minlength=bs)  # candidates per image
+    if not dense:
+        x, b = _group_top_k(x, b, x[:, 4], bs, max_nms)
+
+    key = b if agnostic else b * max(nc, 1) + x[:, 5].long()  # suppression groups
+    if dense:  # grid neighbourhood suppression, no caps
+        i, k = grid_suppression(x[:, :4], x[:, 4], iou_thres, dense, key), math.inf
+    else:  # batched NMS, boxes offset by image and class never overlap across groups
+        offset = key[:, None] * max_wh
+        boxes = x[:, :4].double() + offset if len(key) and int(key.max()) * max_wh > 2 ** 24 else x[:, :4] + offset
+        i, k = torchvision.ops.nms(boxes, x[:, 4].to(boxes.dtype), iou_thres), max_det  # decreasing confidence
+    _check_nms_caps(n, torch.bincount(b[i], minlength=bs), max_nms, max_det, dense)
+    x, b = _group_top_k(x[i], b[i], x[i, 4], bs, k)  # limit detections per image
+
+    output = list(x.split(torch.bincount(b, minlength=bs).tolist()))
+    return [y.to(device) for y in output] if mps else output
+
+
+def _check_nms_caps(candidates, kept, max_nms, max_det, dense=False):
+    # Report images whose candidates (before NMS) or detections (after NMS) exceed the caps, they undercount if capped
+    caps = ('max_nms', max_nms, candidates), ('max_det', max_det, kept)
+    over = [f'{int((n > cap).sum())} images above {k}={cap}' for k, cap, n in caps if n.max() > cap]
+    if not over:
+        return
+    if dense:
+        LOGGER.info(f"Dense NMS: {', '.join(over)} (max {int(candidates.max())} candidates, {int(kept.max())} "
+                    'detections per image), all boxes kept')
+    else:
+        LOGGER.warning(f"WARNING ⚠️ NMS caps hit, {', '.join(over)}, counts are truncated. Use dense NMS for dense "
+                       'scenes')
+
+
+def _group_top_k(x, b, scores, bs, k):
+    # Rows of x grouped by image index b in order, each group sorted by descending score and limited to k rows
+    i = scores.argsort(descending=True)
+    i = i[b[i].argsort(stable=True)]  # stable: keep the score order within each image
+    b = b[i]
+    counts = torch.bincount(b, minlength=bs)
+    rank = torch.arange(len(b), device=b.device) - (counts.cumsum(0) - counts)[b]  # position within its image
+    keep = rank < k
+    return x[i[keep]], b[keep]
+
 
+def _non_max_suppression_loop(prediction, conf_thres, iou_thres, classes, agnostic, multi_label, labels, max_det, nm,
+                              time_limit):
+    # Per-image NMS loop, for autolabelling with apriori labels and as a reference for the batched implementation
     device = prediction.device
     mps = 'mps' in device.type  # Apple MPS
     if mps:  # MPS not fully supported yet, convert tensors to CPU before NMS
@@ -895,12 +986,12 @@ def non_max_suppression(
     bs = prediction.shape[0]  # batch size
     nc = prediction.shape[2] - nm - 5  # number of classes
     xc = prediction[..., 4] > conf_thres  # candidates
+    classes = torch.as_tensor(classes, device=prediction.device) if classes is not None else None
 
     # Settings
     # min_wh = 2  # (pixels) minimum box width and height
     max_wh = 7680  # (pixels) maximum box width and height
     max_nms = 30000  # maximum number of boxes into torchvision.ops.nms()
-    time_limit = 0.5 + 0.05 * bs  # seconds to quit after
     redundant = True  # require redundant detections
     multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
     merge = False  # use merge-NMS
@@ -943,7 +1034,7 @@ def non_max_suppression(
 
         # Filter by class
         if classes is not None:
-            x = x[(x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)]
+            x = x[(x[:, 5:6] == classes).any(1)]
 
         # Apply finite constraint
         # if not torch.isfinite(x).all():
@@ -971,7 +1062,7 @@ def non_max_suppression(
         output[xi] = x[i]
         if mps:
             output[xi] = output[xi].to(device)
-        if (time.time() - t) > time_limit:
+        if time_limit is not None and (time.time() - t) > time_limit:
             LOGGER.warning(f'WARNING ⚠️ NMS time limit {time_limit:.3f}s exceeded')
             break  # time limit exceeded
 
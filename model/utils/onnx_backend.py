@@ -0,0 +1,138 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+ONNX Runtime CPU backend for PyTorch weights: export once, cache next to the weights, run with tuned sessions
+
+The backend is chosen by the YOLOv5_BACKEND environment variable:
+    auto  (default) ONNX Runtime on CPU when onnx and onnxruntime are installed, PyTorch otherwise
+    onnx  always export and use ONNX Runtime for *.pt weights on CPU
+    pt    always use PyTorch
+
+Exported models are cached as <weights dir>/.onnx/<stem>_<hash>_<shape>.onnx where the hash covers the weights content,
+the export settings and the torch version, so retrained weights are re-exported automatically.
+
+Usage:
+    from utils.registry import load_model
+
+    model = load_model('yolov5_best.pt')  # DetectMultiBackend on ONNX Runtime when YOLOv5_BACKEND selects it
+"""
+
+import hashlib
+import importlib.util
+import os
+import threading
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+import psutil
+import torch
+
+from utils.cache import file_hash
+from utils.general import LOGGER, colorstr
+
+PREFIX = colorstr('ONNX Runtime:')
+BACKEND = os.getenv('YOLOv5_BACKEND', 'auto').lower()  # auto, onnx or pt
+ORT_THREADS = int(os.getenv('YOLOv5_ORT_THREADS', 0)) or psutil.cpu_count(logical=False) or 1  # intra-op threads
+
+
+@lru_cache
+def ort_installed():
+    return all(importlib.util.find_spec(x) for x in ('onnx', 'onnxruntime'))
+
+
+def select_backend(weights, device, dnn=False, compiled=False, backend=BACKEND):
+    # Backend for these settings, 'onnx' or 'pt'
+    w = str(weights[0] if isinstance(weights, (list, tuple)) else weights)
+    if backend == 'pt' or dnn or compiled or not w.endswith('.pt') or torch.device(device).type != 'cpu':
+        return 'pt'
+    if backend == 'onnx':
+        return 'onnx'
+    return 'onnx' if ort_installed() else 'pt'  # auto
+
+
+def onnx_file(weights, imgsz=(640, 640), dynamic=True, opset=12, uint8=False, bgr=False):
+    # Cache path of the ONNX export, invalidated by weights content, export settings and torch version
+    w = Path(weights)
+    shape = 'dynamic' if dynamic else 'x'.join(map(str, imgsz))
+    if uint8:
+        shape += '_uint8_bgr' if bgr else '_uint8'
+    settings = f'{file_hash(w)}{imgsz}{dynamic}{opset}{uint8}{bgr}{torch.__version__}'
+    return w.parent / '.onnx' / f'{w.stem}_{hashlib.sha256(settings.encode()).hexdigest()[:12]}_{shape}.onnx'
+
+
+def export_cached(weights, imgsz=(640, 640), dynamic=True, simplify=True, opset=12, uint8=False, bgr=False):
+    """Export weights to ONNX once and return the cached file, or None if the export failed
+
+    uint8 exports take 0-255 (BGR if bgr) input with the normalization folded into the first Conv, as export.py --uint8
+    """
+    f = onnx_file(weights, imgsz, dynamic, opset, uint8, bgr)
+    if f.is_file():
+        return f
+    from export import export_onnx
+    from models.experimental import attempt_load
+    from models.yolo import Detect
+    from utils.torch_utils import check_fold_input
+
+    model = attempt_load(weights, device=torch.device('cpu'), inplace=True, fuse=True).eval()
+    if getattr(model, 'quantized', False):  # quantize.py --method torch, already INT8 and not exportable
+        LOGGER.info(f'{PREFIX} {weights} is a quantized PyTorch model, skipping ONNX export')
+        return None
+    for m in model.modules():
+        if isinstance(m, Detect):
+            m.inplace, m.dynamic, m.export = False, dynamic, True  # as export.py run()
+    im = torch.zeros(1, 3, *imgsz)
+    if uint8:
+        check_fold_input(model, torch.randint(0, 256, im.shape, dtype=torch.uint8), bgr)
+        im, model = im.to(torch.uint8), model.fold_input(bgr)
+    model(im)  # dry run
+    f.parent.mkdir(parents=True, exist_ok=True)
+    tmp = f.with_name(f'{f.stem}_{os.getpid()}_{threading.get_ident()}.onnx')  # concurrent exports never collide
+    simplify &= importlib.util.find_spec('onnxsim') is not None
+    exported, _ = export_onnx(model, im, tmp, opset, dynamic, simplify)
+    if exported is None:
+        return None
+    os.replace(exported, f)
+    return f
+
+
+class ORTSession:
+    """
+    onnxruntime.InferenceSession with tuned threading and I/O binding into preallocated output buffers
+
+    Drop-in for DetectMultiBackend.session. Output buffers are reused per thread and input shape, so results are valid
+    until the same thread runs the next inference with the same shape.
+    """
+
+    def __init__(self, w, intra_op_threads=ORT_THREADS, inter_op_threads=1):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads  # one thread per physical core, hyper-threads do not help
+        options.inter_op_num_threads = inter_op_threads  # YOLOv5 graphs are sequential
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(str(w), options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.local = threading.local()  # per-thread {input shape: output buffers}
+        LOGGER.info(f'{PREFIX} {w} with {intra_op_threads} intra-op threads and I/O binding')
+
+    def __getattr__(self, name):
+        if name == 'session':  # not yet assigned
+            raise AttributeError(name)
+        return getattr(self.session, name)  # get_inputs(), get_outputs(), get_modelmeta(), ...
+
+    def run(self, output_names, feeds):
+        im = np.ascontiguousarray(feeds[self.input_name])
+        buffers = self.local.__dict__.setdefault('buffers', {})
+        outputs = buffers.get(im.shape)
+        binding = self.session.io_binding()
+        binding.bind_cpu_input(self.input_name, im)
+        if outputs is None:  # first call with this shape, let ORT allocate the outputs and keep them as the buffers
+            for name in output_names:
+                binding.bind_output(name, 'cpu')
+            self.session.run_with_iobinding(binding)
+            buffers[im.shape] = binding.copy_outputs_to_cpu()
+            return buffers[im.shape]
+        for name, y in zip(output_names, outputs):
+            binding.bind_output(name, 'cpu', 0, y.dtype, y.shape, y.ctypes.data)
+        self.session.run_with_iobinding(binding)
+        return outputs
@@ -0,0 +1,144 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Fused inference preprocessing into reusable input buffers
+
+letterbox() followed by transpose, np.ascontiguousarray(), torch.from_numpy(), .float() and /= 255 allocates five
+full-frame arrays per image. Preprocessor resizes straight into a padded uint8 HWC buffer (pinned on CUDA) and writes
+the channel-swapped CHW float (or uint8) input tensor in one pass per channel, reusing both buffers per thread and input
+shape. It returns the same ratio/pad metadata as letterbox() for scale_boxes().
+
+Usage:
+    from utils.preprocess import Preprocessor
+
+    pre = Preprocessor(imgsz=(640, 640), stride=32, device=model.device, half=model.fp16)
+    im, ratio_pad = pre.letterbox([im0])  # (1, 3, h, w) input tensor, [(ratio, pad)] per image
+    det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], im0.shape, ratio_pad[0])
+
+Returned tensors are buffers, valid until the same thread preprocesses the next batch of the same shape.
+"""
+
+import threading
+from collections import OrderedDict
+
+import cv2
+import torch
+
+from utils.buckets import select_bucket
+
+PAD = 114  # letterbox() border color
+
+
+class _Buffers:
+    # Staging and input tensors for one (n, h, w) batch shape
+    def __init__(self, n, h, w, device, dtype):
+        cuda = device.type == 'cuda'
+        self.hwc = torch.full((n, h, w, 3), PAD, dtype=torch.uint8, pin_memory=cuda)  # BGR staging
+        self.np = self.hwc.numpy()
+        self.src = torch.empty_like(self.hwc, device=device) if cuda else self.hwc
+        self.out = torch.empty((n, 3, h, w), dtype=dtype, device=device)  # RGB CHW input
+        self.event = torch.cuda.Event() if cuda else None  # last copy out of the pinned staging buffer
+        self.pads = [None] * n  # (top, left, nh, nw) of each image, borders only need refilling when it changes
+
+
+class Preprocessor:
+    """
+    letterbox(), BGR to RGB, HWC to CHW and 0-255 to 0.0-1.0 fused into reusable per-shape buffers
+
+    Arguments:
+        imgsz: inference size (h, w)
+        stride: model stride
+        auto: minimum rectangle padding, as letterbox(auto=True)
+        buckets: (h, w) shapes from utils/buckets.py, images are padded into the nearest one (auto is ignored)
+        device: torch.device of the model input
+        half: FP16 input
+        uint8: uint8 input in 0-255, for models that normalize internally (see BaseModel.fold_input())
+        bgr: keep BGR channel order, uint8 BGR input is a zero-copy view of the staging buffer
+        max_shapes: buffers kept per thread, least recently used shapes are released beyond this
+    """
+    local = threading.local()  # per-thread OrderedDict {(n, h, w, device, dtype): _Buffers}
+
+    def __init__(self, imgsz=640, stride=32, auto=False, buckets=None, device='cpu', half=False, uint8=False,
+                 bgr=False, max_shapes=8):
+        self.imgsz = (imgsz, imgsz) if isinstance(imgsz, int) else tuple(imgsz)
+        self.stride = int(stride)
+        self.auto = auto and not buckets
+        self.buckets = buckets
+        self.device = torch.device(device)
+        self.dtype = torch.uint8 if uint8 else torch.half if half else torch.float
+        self.bgr = bgr
+        self.max_shapes = max_shapes
+
+    def shape(self, shape):
+        # Input (h, w) for an image of shape (h, w)
+        if self.buckets:
+            return select_bucket(shape, self.buckets, self.imgsz)
+        if not self.auto:
+            return self.imgsz
+        h, w = shape[:2]
+        r = min(self.imgsz[0] / h, self.imgsz[1] / w)
+        nh, nw = int(round(h * r)), int(round(w * r))
+        return nh + (self.imgsz[0] - nh) % self.stride, nw + (self.imgsz[1] - nw) % self.stride
+
+    def _buffers(self, n, h, w):
+        cache = self.local.__dict__.setdefault('buffers', OrderedDict())
+        k = n, h, w, self.device, self.dtype
+        b = cache.get(k)
+        if b is None:
+            b = cache[k] = _Buffers(n, h, w, self.device, self.dtype)
+            while len(cache) > self.max_shapes:
+                cache.popitem(last=False)
+        cache.move_to_end(k)
+        return b
+
+    def letterbox(self, ims, shape=None):
+        """
+        Letterbox BGR HWC images into one (n, 3, h, w) input tensor
+
+        Arguments:
+            ims: list of BGR np.ndarray images
+            shape: input (h, w), defaults to the shape of the first image
+        Returns:
+            (n, 3, h, w) tensor on device, [(ratio, pad)] per image as returned by letterbox()
+        """
+        h, w = shape or self.shape(ims[0].shape)
+        b = self._buffers(len(ims), h, w)
+        if b.event is not None:
+            b.event.synchronize()  # the previous batch has left the pinned buffer
+        ratio_pad = []
+        for i, im in enumerate(ims):
+            ratio_pad.append(self._fill(b, i, im, h, w))
+        if b.event is not None:
+            b.src.copy_(b.hwc, non_blocking=True)
+            b.event.record()
+        if self.dtype == torch.uint8 and self.bgr:
+            return b.src.permute(0, 3, 1, 2), ratio_pad  # BCHW view in channels_last memory format
+        for c in range(3):  # BGR HWC uint8 to RGB CHW, one strided pass per channel
+            x = b.src[..., c if self.bgr else 2 - c]
+            if self.dtype == torch.uint8:
+                b.out[:, c].copy_(x)
+            else:
+                torch.div(x, 255, out=b.out[:, c])  # 0 - 255 to 0.0 - 1.0
+        return b.out, ratio_pad
+
+    def __call__(self, im):
+        # (1, 3, h, w) input tensor for one image, i.e. as LoadImages(transforms=...)
+        return self.letterbox([im])[0]
+
+    def _fill(self, b, i, im, h, w):
+        # Resize image i into its padded region of the staging buffer, returns (ratio, pad) as letterbox()
+        r = min(h / im.shape[0], w / im.shape[1])
+        nh, nw = int(round(im.shape[0] * r)), int(round(im.shape[1] * r))
+        dw, dh = (w - nw) / 2, (h - nh) / 2
+        top, left = int(round(dh - 0.1)), int(round(dw - 0.1))
+        x = b.np[i]
+        if b.pads[i] != (top, left, nh, nw):  # refill the borders of a differently placed image
+            x[:top], x[top + nh:], x[top:top + nh, :left], x[top:top + nh, left + nw:] = PAD, PAD, PAD, PAD
+            b.pads[i] = top, left, nh, nw
+        region = x[top:top + nh, left:left + nw]
+        if im.shape[:2] == (nh, nw):
+            region[:] = im
+        else:
+            y = cv2.resize(im, (nw, nh), dst=region, interpolation=cv2.INTER_LINEAR)
+            if y is not region:  # OpenCV could not write into the strided view
+                region[:] = y
+        return (r, r), (dw, dh)
@@ -0,0 +1,200 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Per-layer runtime profiler returning a structured table from a single pass over real inputs
+
+BaseModel._profile_one_layer() logs each layer after re-running it 10 times with thop. LayerProfiler times every layer
+with forward hooks while the model runs normally, counts Conv2d/Linear FLOPs analytically from the observed shapes and
+returns one row per layer: index, from, type, parameters, input/output shapes, GFLOPs, mean/p95 ms, output bytes and
+CUDA allocation deltas. Works on fused models; frozen TorchScript graphs (CompiledModel) have no module boundaries, so
+their eager channels_last model is profiled instead. Models without YOLOv5 layer indices (i.e. QuantizedModel graphs)
+are profiled per leaf module.
+
+Usage:
+    from utils.profiler import profile_layers
+
+    prof = profile_layers(model, ims)  # model: DetectionModel, DetectMultiBackend or CompiledModel, ims: BCHW tensors
+    prof.print()  # table and per-type totals
+    prof.save('layers.csv')  # or layers.json
+"""
+
+import csv
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from utils.general import LOGGER, colorstr
+
+PREFIX = colorstr('Profiler:')
+COLUMNS = ('index', 'from', 'type', 'params', 'input', 'output', 'gflops', 'calls', 'mean_ms', 'p95_ms', 'pct',
+           'output_bytes', 'cuda_alloc_bytes')
+
+
+def _sync():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return time.perf_counter()
+
+
+def _shapes(x):
+    # Shape of a tensor or nested shapes of a list/tuple of tensors
+    if isinstance(x, torch.Tensor):
+        return list(x.shape)
+    return [_shapes(y) for y in x] if isinstance(x, (list, tuple)) else None
+
+
+def _nbytes(x):
+    if isinstance(x, torch.Tensor):
+        return x.numel() * x.element_size()
+    return sum(_nbytes(y) for y in x) if isinstance(x, (list, tuple)) else 0
+
+
+def _flops(m, x, y):
+    # Multiply-accumulate FLOPs (x2) of one Conv2d/Linear call from its weight and output shapes
+    if isinstance(m, nn.Conv2d):
+        return 2 * y.numel() * m.weight[0].numel()  # (c_in / groups) * kh * kw MACs per output element
+    if isinstance(m, nn.Linear):
+        return 2 * y.numel() * m.in_features
+    return 0
+
+
+class LayerProfiler:
+    """
+    Forward hooks timing each layer of a model, use as a context manager around normal inference calls
+
+    Arguments:
+        model: DetectionModel or any nn.Module, YOLOv5 layers (with .i/.f/.type from parse_model) are profiled if
+               present, leaf modules otherwise
+    """
+
+    def __init__(self, model):
+        self.layers = [m for m in model.modules() if hasattr(m, 'i') and hasattr(m, 'f')]
+        self.leaves = not self.layers
+        self.names = {}  # leaf module names
+        if self.leaves:  # no YOLOv5 layers, i.e. torch.fx graphs
+            self.names = {m: name for name, m in model.named_modules() if not list(m.children())}
+            self.layers = list(self.names)
+        self.stats = {m: {'times': [], 'flops': 0, 'alloc': 0} for m in self.layers}
+        self.handles, self.current, self.t0, self.mem0 = [], None, 0.0, 0
+
+    def _pre(self, m, x):
+        self.current = m
+        self.mem0 = torch.cuda.memory_allocated() if torch.cuda.is_available() else 0
+        self.t0 = _sync()
+
+    def _post(self, m, x, y):
+        dt = _sync() - self.t0
+        s = self.stats[m]
+        s['times'].append(dt * 1E3)
+        if torch.cuda.is_available():
+            s['alloc'] = max(s['alloc'], torch.cuda.memory_allocated() - self.mem0)
+        s['input'], s['output'], s['output_bytes'] = _shapes(x[0] if len(x) == 1 else x), _shapes(y), _nbytes(y)
+        if self.leaves:
+            s['flops'] += _flops(m, x, y)
+        self.current = None
+
+    def _count(self, m, x, y):
+        # Leaf Conv2d/Linear inside the layer being timed
+        if self.current is not None:
+            self.stats[self.current]['flops'] += _flops(m, x, y)
+
+    def __enter__(self):
+        for m in self.layers:
+            self.handles += [m.register_forward_pre_hook(self._pre), m.register_forward_hook(self._post)]
+        if not self.leaves:
+            for m in {c for layer in self.layers for c in layer.modules() if isinstance(c, (nn.Conv2d, nn.Linear))}:
+                self.handles.append(m.register_forward_hook(self._count))
+        return self
+
+    def __exit__(self, *args):
+        for h in self.handles:
+            h.remove()
+        self.handles = []
+
+    def table(self):
+        """Rows of COLUMNS, one per profiled layer in execution order"""
+        rows = []
+        total = sum(sum(s['times']) for s in self.stats.values()) or 1
+        for m, s in self.stats.items():
+            if not s['times']:
+                continue  # not called
+            t = np.array(s['times'])
+            rows.append({
+                'index': self.names[m] if self.leaves else m.i,
+                'from': None if self.leaves else m.f,
+                'type': type(m).__name__ if self.leaves else m.type.split('.')[-1],
+                'params': sum(p.numel() for p in m.parameters()),
+                'input': s['input'],
+                'output': s['output'],
+                'gflops': s['flops'] / len(t) / 1E9,  # per call
+                'calls': len(t),
+                'mean_ms': float(t.mean()),
+                'p95_ms': float(np.percentile(t, 95)),
+                'pct': float(t.sum() / total * 100),
+                'output_bytes': s['output_bytes'],
+                'cuda_alloc_bytes': s['alloc']})
+        return rows
+
+    def by_type(self):
+        """{type: {'mean_ms', 'pct', 'gflops'}} totals per layer type, i.e. C2fDCB vs SCDown vs Conv"""
+        out = {}
+        for r in self.table():
+            x = out.setdefault(r['type'], {'layers': 0, 'mean_ms': 0.0, 'pct': 0.0, 'gflops': 0.0})
+            x['layers'] += 1
+            for k in 'mean_ms', 'pct', 'gflops':
+                x[k] += r[k]
+        return dict(sorted(out.items(), key=lambda x: -x[1]['pct']))
+
+    def print(self):
+        LOGGER.info(f"{PREFIX} {'index':>6} {'type':>14} {'params':>10} {'GFLOPs':>8} {'mean ms':>9} {'p95 ms':>9} "
+                    f"{'%':>6}  output")
+        for r in self.table():
+            LOGGER.info(f"{PREFIX} {str(r['index']):>6} {r['type']:>14} {r['params']:>10} {r['gflops']:>8.3f} "
+                        f"{r['mean_ms']:>9.2f} {r['p95_ms']:>9.2f} {r['pct']:>6.1f}  {r['output']}")
+        for k, v in self.by_type().items():
+            LOGGER.info(f"{PREFIX} {k:>14} x{v['layers']:<3} {v['gflops']:>8.3f} GFLOPs {v['mean_ms']:>9.2f} ms "
+                        f"{v['pct']:>6.1f}%")
+
+    def save(self, file='layers.csv'):
+        """Save the table as CSV or JSON by file suffix"""
+        file, rows = Path(file), self.table()
+        if file.suffix == '.json':
+            file.write_text(json.dumps({'layers': rows, 'types': self.by_type()}, indent=2))
+        else:
+            with open(file, 'w', newline='') as f:
+                writer = csv.DictWriter(f, COLUMNS)
+                writer.writeheader()
+                writer.writerows({k: json.dumps(v) if isinstance(v, list) else v for k, v in r.items()} for r in rows)
+        LOGGER.info(f"{PREFIX} saved {colorstr('bold', file)}")
+        return file
+
+
+@torch.no_grad()
+def profile_layers(model, ims, warmup=1):
+    """
+    Profile every layer of model over the inputs ims in a single pass, returns the LayerProfiler
+
+    Arguments:
+        model: DetectionModel, DetectMultiBackend (PyTorch weights) or CompiledModel
+        ims: iterable of BCHW input tensors, i.e. preprocessed field images
+        warmup: untimed leading calls with the first input, the first calls allocate buffers and pick kernels
+    """
+    from utils.compiled import CompiledModel
+
+    model = getattr(model, 'model', model) if hasattr(model, 'pt') else model  # unwrap DetectMultiBackend
+    channels_last = isinstance(model, CompiledModel)
+    if channels_last:
+        LOGGER.info(f'{PREFIX} frozen TorchScript graphs have no layers, profiling the eager channels_last model')
+        model = model.model
+    ims = iter(ims)
+    im = next(ims)
+    fmt = torch.channels_last if channels_last else torch.contiguous_format
+    for _ in range(warmup):
+        model(im.contiguous(memory_format=fmt))
+    with LayerProfiler(model) as prof:
+        for x in (im, *ims):
+            model(x.contiguous(memory_format=fmt))
+    return prof
@@ -0,0 +1,203 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Process-wide model registry: load, fuse and warm up each model once and share it between requests
+
+Usage:
+    from utils.registry import evict, load_model, preload
+
+    preload('yolov5_best.pt')  # at application startup
+    preload('yolov5_best.pt', buckets='640x640,640x480,1024x768')  # also warm up every shape bucket, see buckets.py
+    model = load_model('yolov5_best.pt')  # cached DetectMultiBackend instance
+    scheduler = load_scheduler('yolov5_best.pt', max_batch=8)  # shared micro-batching scheduler for that model
+    model = load_model('yolov5_best.pt', compiled=True)  # traced TorchScript graphs in channels_last, see compiled.py
+    # *.pt weights on CPU run on a cached ONNX Runtime export unless YOLOv5_BACKEND=pt, see onnx_backend.py
+    # YOLOv5_UINT8_INPUT=rgb (or bgr) folds input normalization into the first Conv, models then take uint8 input
+    evict('yolov5_best.pt')  # release it again
+"""
+
+import os
+import threading
+from pathlib import Path
+
+import torch
+
+from models.common import DetectMultiBackend
+from utils.batching import BatchScheduler
+from utils.buckets import parse_buckets
+from utils.compiled import CompiledModel
+from utils.general import LOGGER, check_img_size
+from utils.onnx_backend import ORTSession, export_cached, select_backend
+from utils.torch_utils import check_fold_input, select_device, smart_inference_mode
+
+UINT8_INPUT = os.getenv('YOLOv5_UINT8_INPUT', '').lower()  # '' (float input), rgb or bgr uint8 input
+
+
+def input_dtype(model):
+    # Input dtype of a loaded model, uint8 for models with folded input normalization
+    return torch.uint8 if model.uint8_input else torch.half if model.fp16 else torch.float
+
+
+class ModelRegistry:
+    # Thread-safe cache of DetectMultiBackend models keyed by (weights, device, fp16, backend)
+    def __init__(self):
+        self.models = {}  # key -> DetectMultiBackend
+        self.devices = {}  # requested device string -> torch.device
+        self.locks = {}  # key -> per-key load lock, so different models can load concurrently
+        self.schedulers = {}  # key -> BatchScheduler
+        self.lock = threading.Lock()  # guards the dicts above
+
+    def device(self, device=''):
+        # Resolve a device string once, select_device() is slow and logs on every call
+        if isinstance(device, torch.device):
+            return device
+        device = str(device)
+        with self.lock:
+            if device not in self.devices:
+                self.devices[device] = select_device(device)
+            return self.devices[device]
+
+    def key(self, weights, device='', half=False, dnn=False, compiled=False):
+        # Registry key (weights, device, fp16, backend)
+        w = weights if isinstance(weights, (list, tuple)) else [weights]
+        w = tuple(str(Path(x).resolve()) if Path(str(x)).exists() else str(x) for x in w)
+        device = self.device(device)
+        backend = 'dnn' if dnn else 'compiled' if compiled else select_backend(weights, device)
+        return w, str(device), bool(half), backend
+
+    def get(self, weights, device='', half=False, dnn=False, data=None, imgsz=(640, 640), compiled=False):
+        # Return the cached model for these settings, loading and warming it up on first use
+        k = self.key(weights, device, half, dnn, compiled)
+        model = self.models.get(k)
+        if model is not None:
+            return model
+        with self.lock:
+            lock = self.locks.setdefault(k, threading.Lock())
+        with lock:  # only one thread loads a given model, the others wait and reuse it
+            model = self.models.get(k)
+            if model is None:
+                model = self._load(weights, self.device(device), half, dnn, data, imgsz, compiled)
+                self.models[k] = model
+        return model
+
+    def scheduler(self, weights, device='', half=False, dnn=False, data=None, imgsz=(640, 640), max_batch=8,
+                  max_wait_ms=10, compiled=False):
+        # Return the shared BatchScheduler for these settings, max_batch and max_wait_ms can be retuned on every call
+        model = self.get(weights, device, half, dnn, data, imgsz, compiled)
+        k = self.key(weights, device, half, dnn, compiled)
+        with self.lock:
+            scheduler = self.schedulers.get(k)
+            if scheduler is None:
+                scheduler = self.schedulers[k] = BatchScheduler(model, max_batch, max_wait_ms)
+            elif scheduler.batching:
+                scheduler.max_batch, scheduler.max_wait = max_batch, max_wait_ms / 1E3
+        return scheduler
+
+    @smart_inference_mode()
+    def warmup(self, model, shapes):
+        # Run each (h, w) input shape not seen yet once, later requests at these shapes never hit a cold path
+        with self.lock:
+            warm = model.__dict__.setdefault('warm_shapes', set())
+            shapes = [tuple(s) for s in shapes if tuple(s) not in warm]
+            warm.update(shapes)
+        for h, w in shapes:  # Detect() grids, oneDNN primitives, compiled graphs and ONNX Runtime allocations
+            model(torch.zeros(1, 3, h, w, dtype=input_dtype(model), device=model.device))
+        if shapes:
+            LOGGER.info(f"Warmed up input shapes {', '.join(f'{w}x{h}' for h, w in shapes)}")
+
+    def evict(self, weights=None, device='', half=False, dnn=False, compiled=False):
+        # Drop one cached model, or all of them if weights is None
+        k = None if weights is None else self.key(weights, device, half, dnn, compiled)  # outside the lock, key() takes it
+        with self.lock:
+            if k is None:
+                self.models.clear()
+                schedulers = list(self.schedulers.values())
+                self.schedulers.clear()
+            else:
+                self.models.pop(k, None)
+                schedulers = [s for s in [self.schedulers.pop(k, None)] if s]
+        for s in schedulers:
+            s.close()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def __contains__(self, key):
+        return key in self.models
+
+    def __len__(self):
+        return len(self.models)
+
+    @staticmethod
+    @smart_inference_mode()
+    def _load(weights, device, half, dnn, data, imgsz, compiled=False):
+        imgsz = [imgsz] * 2 if isinstance(imgsz, int) else list(imgsz) * (3 - len(imgsz))  # expand
+        assert UINT8_INPUT in ('', 'rgb', 'bgr'), f'Invalid YOLOv5_UINT8_INPUT={UINT8_INPUT}, valid values are rgb, bgr'
+        uint8, bgr = bool(UINT8_INPUT), UINT8_INPUT == 'bgr'
+        model = None
+        if select_backend(weights, device, dnn, compiled) == 'onnx':  # export once, reuse the cached *.onnx
+            w = weights[0] if isinstance(weights, (list, tuple)) else weights
+            f = export_cached(w, check_img_size(imgsz, s=32), uint8=uint8, bgr=bgr)
+            if f:
+                model = DetectMultiBackend(f, device=device, data=data, session=ORTSession(f))  # tuned, I/O binding
+                model.dynamic = True  # dynamic batch, height and width
+            else:
+                LOGGER.warning(f'WARNING ⚠️ ONNX export of {w} failed, falling back to PyTorch')
+        if model is None:
+            model = DetectMultiBackend(weights, device=device, dnn=dnn, data=data, fp16=half)  # load and fuse
+        imgsz = check_img_size(imgsz, s=model.stride)
+        if uint8 and model.pt and not model.uint8_input:  # fold before tracing, checked on a random image first
+            if hasattr(model.model, 'fold_input'):
+                im = torch.randint(0, 256, (1, 3, *imgsz), dtype=torch.uint8, device=model.device)
+                check_fold_input(model.model, im, bgr)
+                model.model.fold_input(bgr)
+                model.uint8_input, model.bgr_input = True, bgr
+            else:
+                LOGGER.warning(f'WARNING ⚠️ {weights} can not fold input normalization, running with float input')
+        if compiled:
+            if model.pt:
+                w = weights[0] if isinstance(weights, (list, tuple)) else weights
+                model.model = CompiledModel(model.model, w, shapes=[(1, 3, *imgsz)])
+            else:
+                LOGGER.warning(f'WARNING ⚠️ compiled mode needs PyTorch *.pt weights, running {weights} as is')
+        im = torch.zeros(1, 3, *imgsz, dtype=input_dtype(model), device=model.device)
+        model(im)  # warmup, DetectMultiBackend.warmup() is a no-op on CPU
+        model.warm_shapes = {tuple(imgsz)}
+        LOGGER.info(f'Registered {weights} on {device} for shared inference')
+        return model
+
+
+REGISTRY = ModelRegistry()  # process-wide instance
+
+
+def load_model(weights, device='', half=False, dnn=False, data=None, imgsz=(640, 640), compiled=False):
+    # Cached DetectMultiBackend for weights, loaded on first use
+    return REGISTRY.get(weights, device, half, dnn, data, imgsz, compiled)
+
+
+def preload(weights, device='', half=False, dnn=False, data=None, imgsz=(640, 640), compiled=False, buckets=None):
+    # Load and warm up a model ahead of the first request, i.e. at application startup, including all shape buckets
+    model = REGISTRY.get(weights, device, half, dnn, data, imgsz, compiled)
+    REGISTRY.warmup(model, parse_buckets(buckets, s=model.stride))
+    return model
+
+
+def warmup(model, shapes):
+    # Warm up a registered model at each (h, w) shape once, i.e. the shape buckets of a request
+    REGISTRY.warmup(model, shapes)
+
+
+def load_scheduler(weights,
+                   device='',
+                   half=False,
+                   dnn=False,
+                   data=None,
+                   imgsz=(640, 640),
+                   max_batch=8,
+                   max_wait_ms=10,
+                   compiled=False):
+    # Shared micro-batching scheduler in front of the cached model, see utils/batching.py
+    return REGISTRY.scheduler(weights, device, half, dnn, data, imgsz, max_batch, max_wait_ms, compiled)
+
+
+def evict(weights=None, device='', half=False, dnn=False, compiled=False):
+    # Remove a model (or all models) from the registry
+    REGISTRY.evict(weights, device, half, dnn, compiled)
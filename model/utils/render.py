@@ -0,0 +1,99 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Bulk rendering of dense detections: one OpenCV/NumPy pass per class instead of one Annotator.box_label() per box
+
+Modes:
+    boxes      box outlines, one cv2.polylines() call per class
+    centroids  filled dots at the box centres, one dilation per class
+    heat       Gaussian density overlay of the box centres
+"""
+
+import cv2
+import numpy as np
+import torch
+from ultralytics.utils.plotting import colors
+
+MODES = 'boxes', 'centroids', 'heat'
+
+
+def _labels_legible(det, font_scale, max_labels):
+    # Labels only pay off when zoomed in: few boxes and boxes at least twice as tall as the text
+    if not len(det) or len(det) > max_labels:
+        return False
+    text_h = cv2.getTextSize('0', 0, fontScale=font_scale, thickness=1)[0][1]
+    return np.median(det[:, 3] - det[:, 1]) >= 2 * text_h
+
+
+def _draw_labels(im, det, names, font_scale, thickness, hide_conf=False):
+    # Filled label background and white text above each box, as Annotator.box_label() draws them
+    for x1, y1, _, _, conf, cls in det[::-1].tolist():
+        c = int(cls)
+        label = names[c] if hide_conf else f'{names[c]} {conf:.2f}'
+        w, h = cv2.getTextSize(label, 0, fontScale=font_scale, thickness=thickness)[0]
+        p1 = int(x1), int(y1)
+        outside = p1[1] - h >= 3
+        p2 = p1[0] + w, p1[1] - h - 3 if outside else p1[1] + h + 3
+        cv2.rectangle(im, p1, p2, colors(c, True), -1, cv2.LINE_AA)  # filled
+        cv2.putText(im, label, (p1[0], p1[1] - 2 if outside else p1[1] + h + 2), 0, font_scale, (255, 255, 255),
+                    thickness=thickness, lineType=cv2.LINE_AA)
+
+
+def render_detections(im,
+                      det,
+                      names,
+                      mode='boxes',
+                      line_width=3,
+                      font_size=16,
+                      labels='auto',
+                      hide_conf=False,
+                      max_labels=200,
+                      heat_alpha=0.5):
+    """
+    Draw all detections onto a BGR image in place and return it
+
+    Arguments:
+        im: BGR HWC np.ndarray, modified in place
+        det: (n, 6) tensor or array [xyxy, conf, cls] in image pixels
+        names: class names
+        mode: 'boxes', 'centroids' or 'heat'
+        line_width: box outline width, centroid dot radius is derived from it
+        font_size: label text height in pixels
+        labels: True, False or 'auto' to draw labels only when zoomed in (see _labels_legible())
+        max_labels: 'auto' skips labels above this many detections
+        heat_alpha: heat overlay opacity
+    """
+    assert mode in MODES, f'invalid render mode {mode}, valid modes are {MODES}'
+    det = det.cpu().numpy() if isinstance(det, torch.Tensor) else np.asarray(det)
+    if not len(det):
+        return im
+    h, w = im.shape[:2]
+    cls = det[:, 5].astype(int)
+    xy = ((det[:, :2] + det[:, 2:4]) / 2).round().astype(np.int32)  # box centres
+    xy[:, 0], xy[:, 1] = xy[:, 0].clip(0, w - 1), xy[:, 1].clip(0, h - 1)
+
+    if mode == 'boxes':
+        x1, y1, x2, y2 = det[:, :4].round().astype(np.int32).T
+        pts = np.stack((np.stack((x1, y1), 1), np.stack((x2, y1), 1), np.stack((x2, y2), 1), np.stack((x1, y2), 1)), 1)
+        for c in np.unique(cls):
+            cv2.polylines(im, list(pts[cls == c]), True, colors(int(c), True), line_width, cv2.LINE_AA)
+    elif mode == 'centroids':
+        r = max(line_width, 2)
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * r + 1, 2 * r + 1))
+        for c in np.unique(cls):
+            mask = np.zeros((h, w), np.uint8)
+            mask[xy[cls == c, 1], xy[cls == c, 0]] = 255
+            im[cv2.dilate(mask, kernel) > 0] = colors(int(c), True)
+    else:  # heat
+        s = max(min(h, w) // 256, 1)  # density grid stride
+        density = np.zeros((h // s + 1, w // s + 1), np.float32)
+        np.add.at(density, (xy[:, 1] // s, xy[:, 0] // s), 1)
+        sigma = max(np.median(det[:, 2:4] - det[:, :2]) / s, 1)  # about one box size
+        density = cv2.GaussianBlur(density, (0, 0), sigma)
+        density = cv2.resize(density / density.max(), (w, h), interpolation=cv2.INTER_LINEAR)
+        heat = cv2.applyColorMap((density * 255).astype(np.uint8), cv2.COLORMAP_JET)
+        cv2.addWeighted(heat, heat_alpha, im, 1 - heat_alpha, 0, dst=im)
+
+    font_scale = font_size / 22  # cv2.FONT_HERSHEY_SIMPLEX is about 22 pixels tall at scale 1
+    if labels is True or (labels == 'auto' and mode == 'boxes' and _labels_legible(det, font_scale, max_labels)):
+        _draw_labels(im, det, names, font_scale, max(line_width // 3, 1), hide_conf)
+    return im
@@ -0,0 +1,77 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Sliced (tiled) inference utils for full-resolution UAV images
+"""
+
+import numpy as np
+import torch
+import torchvision
+
+from utils.dense import grid_suppression
+
+
+def _axis_tiles(n, tile, step):
+    # Tile starts/ends along one axis plus the cut points that split it into disjoint per-tile cores
+    starts = [0] if n <= tile else list(range(0, n - tile, step)) + [n - tile]  # last tile flush with the edge
+    ends = [min(s + tile, n) for s in starts]
+    cuts = [0] + [(e + s) / 2 for e, s in zip(ends[:-1], starts[1:])] + [n]  # middle of each overlap
+    return starts, ends, cuts
+
+
+def tile_windows(shape, tile=640, overlap=0.2):
+    """Windows covering an image of shape (h, w) with tiles of size tile and fractional overlap
+
+    Returns:
+        windows (n, 4) int [x1, y1, x2, y2] crop coordinates
+        cores (n, 4) float [x1, y1, x2, y2] disjoint ownership regions, every pixel belongs to exactly one core
+    """
+    assert 0 <= overlap < 1, f'Invalid tile overlap {overlap}, valid values are between 0.0 and 1.0'
+    h, w = shape[:2]
+    step = max(int(tile * (1 - overlap)), 1)
+    xs, xe, xc = _axis_tiles(w, tile, step)
+    ys, ye, yc = _axis_tiles(h, tile, step)
+    windows, cores = [], []
+    for j in range(len(ys)):
+        for i in range(len(xs)):
+            windows.append((xs[i], ys[j], xe[i], ye[j]))
+            cores.append((xc[i], yc[j], xc[i + 1], yc[j + 1]))
+    return np.array(windows, dtype=int), np.array(cores, dtype=float)
+
+
+def own_boxes(det, window, core):
+    """Move one tile's (n, 6) detections to image coordinates and keep only the boxes owned by this tile
+
+    A box is owned by the tile whose core contains the box centre, which removes the duplicates and the truncated
+    partial boxes along the tile seams without looking at any other tile.
+    """
+    x1, y1 = float(window[0]), float(window[1])
+    cx1, cy1, cx2, cy2 = (float(x) for x in core)
+    det = det.clone()
+    det[:, [0, 2]] += x1  # to global x
+    det[:, [1, 3]] += y1  # to global y
+    cx, cy = (det[:, 0] + det[:, 2]) / 2, (det[:, 1] + det[:, 3]) / 2  # box centres
+    return det[(cx >= cx1) & (cx < cx2) & (cy >= cy1) & (cy < cy2)]
+
+
+def merge_tiles(dets, windows, cores, iou_thres=0.5, agnostic=False, max_wh=7680, dense=False):
+    """Merge per-tile detections into one set in global image coordinates
+
+    Every tile keeps the boxes it owns (see own_boxes()), then a final NMS over the merged boxes catches what is left
+    at the seams. dense=True (or 'iou', 'center') runs that NMS as grid_suppression(), linear in the number of boxes.
+
+    Arguments:
+        dets: list of (n, 6) tensors [xyxy, conf, cls] in tile crop coordinates
+        windows: (n, 4) tile windows from tile_windows()
+        cores: (n, 4) tile cores from tile_windows()
+    Returns:
+        (n, 6) tensor [xyxy, conf, cls] in image coordinates
+    """
+    out = [own_boxes(det, window, core) for det, window, core in zip(dets, windows, cores) if len(det)]
+    if not out:
+        return dets[0].new_zeros((0, 6)) if len(dets) else torch.zeros((0, 6))
+    det = torch.cat(out, 0)
+    if dense:
+        return det[grid_suppression(det[:, :4], det[:, 4], iou_thres, dense, None if agnostic else det[:, 5])]
+    c = det[:, 5:6] * (0 if agnostic else max_wh)  # classes
+    i = torchvision.ops.nms(det[:, :4] + c, det[:, 4], iou_thres)  # seam NMS
+    return det[i]
@@ -269,6 +269,42 @@ def fuse_conv_and_bn(conv, bn):
     return fusedconv
 
 
+def slice_bn(bn, start, end):
+    # BatchNorm2d() restricted to channels start:end, to fold a BN that follows torch.cat() into each concatenated conv
+    s = nn.BatchNorm2d(end - start, eps=bn.eps).requires_grad_(False).to(bn.weight.device, bn.weight.dtype)
+    s.weight.copy_(bn.weight[start:end])
+    s.bias.copy_(bn.bias[start:end])
+    s.running_mean.copy_(bn.running_mean[start:end])
+    s.running_var.copy_(bn.running_var[start:end])
+    return s
+
+
+@smart_inference_mode()
+def check_fuse(model, im, rtol=1E-3, atol=1E-2):
+    # Check that a fused (reparameterized) copy of model matches the unfused model on im, returns max abs difference
+    m0, m1 = deepcopy(model).eval(), deepcopy(model).eval().fuse()
+    y0, y1 = (y[0] if isinstance(y, (list, tuple)) else y for y in (m0(im), m1(im)))
+    d = (y0 - y1).abs().max().item()
+    ok = torch.allclose(y0, y1, rtol=rtol, atol=atol)
+    LOGGER.info(f"Fused model {'matches' if ok else 'DOES NOT match'} unfused model, max abs difference {d:.3g}")
+    assert ok, f'fused model output differs from unfused model by up to {d:.3g}'
+    return d
+
+
+@smart_inference_mode()
+def check_fold_input(model, im, bgr=False, rtol=1E-3, atol=1E-2):
+    # Check that a fold_input() copy of model on uint8 im matches model on im / 255, returns max abs difference
+    m0, m1 = deepcopy(model).eval(), deepcopy(model).eval().fold_input(bgr)
+    x = im.to(next(m0.parameters()).dtype) / 255  # 0 - 255 to 0.0 - 1.0
+    y0, y1 = (y[0] if isinstance(y, (list, tuple)) else y for y in (m0(x), m1(im.flip(1) if bgr else im)))
+    d = (y0 - y1).abs().max().item()
+    ok = torch.allclose(y0, y1, rtol=rtol, atol=atol)
+    LOGGER.info(f"uint8 input model {'matches' if ok else 'DOES NOT match'} float input model, "
+                f'max abs difference {d:.3g}')
+    assert ok, f'uint8 input model output differs from float input model by up to {d:.3g}'
+    return d
+
+
 def model_info(model, verbose=False, imgsz=640):
     # Model information. img_size may be int or list, i.e. img_size=640 or img_size=[640, 320]
     n_p = sum(x.numel() for x in model.parameters())  # number parameters
@@ -286,12 +322,14 @@ def model_info(model, verbose=False, imgsz=640):
         im = torch.empty((1, p.shape[1], stride, stride), device=p.device)  # input image in BCHW format
         flops = thop.profile(deepcopy(model), inputs=(im, ), verbose=False)[0] / 1E9 * 2  # stride GFLOPs
         imgsz = imgsz if isinstance(imgsz, list) else [imgsz, imgsz]  # expand if int/float
-        fs = f', {flops * imgsz[0] / stride * imgsz[1] / stride:.1f} GFLOPs'  # 640x640 GFLOPs
+        gflops = flops * imgsz[0] / stride * imgsz[1] / stride  # 640x640 GFLOPs
+        fs = f', {gflops:.1f} GFLOPs'
     except Exception:
-        fs = ''
+        gflops, fs = 0.0, ''
 
     name = Path(model.yaml_file).stem.replace('yolov5', 'YOLOv5') if hasattr(model, 'yaml_file') else 'Model'
     LOGGER.info(f'{name} summary: {len(list(model.modules()))} layers, {n_p} parameters, {n_g} gradients{fs}')
+    return n_p, gflops
 
 
 def scale_img(img, ratio=1.0, same_shape=False, gs=32):  # img(16,3,256,416)
@@ -0,0 +1,127 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Vectorized detection export: one formatted block and one write per image instead of one file open per box
+
+Formats:
+    csv      save_dir/predictions.csv         Image Name,Prediction,Confidence per box, buffered
+    txt      save_dir/labels/<stem>.txt       YOLO labels, class x y w h [conf] normalized
+    json     save_dir/predictions.jsonl       one JSON object per image, buffered
+    npy      save_dir/labels/<stem>.npy       (n, 6) float32 [xyxy, conf, cls] in image pixels
+    parquet  save_dir/predictions.parquet     one row per box, one row group per flush (requires pyarrow)
+
+Usage:
+    with DetectionWriter(save_dir, names, formats=('csv', 'txt')) as writer:
+        for ...:
+            writer.write(p.name, det, im0.shape)
+"""
+
+import csv
+import io
+import json
+from itertools import repeat
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from utils.general import check_requirements, xyxy2xywhn
+
+FORMATS = 'csv', 'txt', 'json', 'npy', 'parquet'
+
+
+class DetectionWriter:
+    # Writes per-image detections in one or more formats, buffered formats are flushed every flush_every images
+    def __init__(self, save_dir, names, formats=('csv',), save_conf=False, flush_every=32):
+        assert not set(formats) - set(FORMATS), f'invalid formats {formats}, valid formats are {FORMATS}'
+        self.save_dir = Path(save_dir)
+        self.names = np.array([names[k] for k in sorted(names)] if isinstance(names, dict) else list(names))
+        self.formats = set(formats)
+        self.save_conf = save_conf  # append confidences to txt labels
+        self.flush_every = flush_every
+        self.pending = 0  # images buffered since the last flush
+        self.csv, self.json, self.rows = io.StringIO(), io.StringIO(), []  # buffers
+        self.parquet = None  # pyarrow.parquet.ParquetWriter, opened on first flush
+        if self.formats & {'txt', 'npy'}:
+            (self.save_dir / 'labels').mkdir(parents=True, exist_ok=True)
+        if 'csv' in self.formats:
+            self.csv_path = self.save_dir / 'predictions.csv'
+            if not self.csv_path.is_file() or not self.csv_path.stat().st_size:
+                csv.writer(self.csv).writerow(('Image Name', 'Prediction', 'Confidence'))  # header once per file
+        if 'parquet' in self.formats:
+            check_requirements('pyarrow')
+
+    def write(self, name, det, shape, stem=None):
+        """
+        Add one image's detections
+
+        Arguments:
+            name: image file name
+            det: (n, 6) tensor or array [xyxy, conf, cls] in original image pixels
+            shape: original image shape (h, w, ...)
+            stem: label file stem, defaults to Path(name).stem
+        """
+        det = det.cpu().numpy() if isinstance(det, torch.Tensor) else np.asarray(det)
+        det = det[::-1]  # same order as the annotations
+        cls, conf = det[:, 5].astype(int), det[:, 4]
+        stem = str(self.save_dir / 'labels' / (stem or Path(name).stem))
+
+        if 'csv' in self.formats:
+            csv.writer(self.csv).writerows(zip(repeat(name), self.names[cls], np.char.mod('%.2f', conf)))
+        if 'txt' in self.formats and len(det):
+            xywh = xyxy2xywhn(det[:, :4], w=shape[1], h=shape[0])  # normalized xywh
+            block = np.column_stack((cls, xywh, conf) if self.save_conf else (cls, xywh))  # label format
+            with open(f'{stem}.txt', 'a') as f:
+                np.savetxt(f, block, fmt='%g')
+        if 'json' in self.formats:
+            self.json.write(json.dumps({
+                'image': name,
+                'shape': list(shape[:2]),
+                'count': len(det),
+                'boxes': det[:, :4].round(1).tolist(),
+                'confidence': conf.round(4).tolist(),
+                'class': cls.tolist()}) + '\n')
+        if 'npy' in self.formats:
+            np.save(f'{stem}.npy', det.astype(np.float32))
+        if 'parquet' in self.formats and len(det):
+            self.rows.append((name, det))
+
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        # Write all buffered blocks, one write per file
+        if 'csv' in self.formats and self.csv.tell():
+            with open(self.csv_path, 'a', newline='') as f:
+                f.write(self.csv.getvalue())
+            self.csv = io.StringIO()
+        if 'json' in self.formats and self.json.tell():
+            with open(self.save_dir / 'predictions.jsonl', 'a') as f:
+                f.write(self.json.getvalue())
+            self.json = io.StringIO()
+        if self.rows:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            det = np.concatenate([x for _, x in self.rows])
+            table = pa.table({
+                'image': np.concatenate([np.full(len(x), n, dtype=object) for n, x in self.rows]),
+                'x1': det[:, 0], 'y1': det[:, 1], 'x2': det[:, 2], 'y2': det[:, 3],
+                'confidence': det[:, 4],
+                'class': det[:, 5].astype(np.int32)})
+            if self.parquet is None:
+                self.parquet = pq.ParquetWriter(self.save_dir / 'predictions.parquet', table.schema)
+            self.parquet.write_table(table)  # one row group per flush
+            self.rows = []
+        self.pending = 0
+
+    def close(self):
+        self.flush()
+        if self.parquet is not None:
+            self.parquet.close()
+            self.parquet = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
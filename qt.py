@@ -10,7 +10,7 @@ from PyQt5.QtWidgets import (QApplication, QMainWindow, QFileDialog, QLabel,
 from PyQt5.QtGui import QPixmap, QFont, QIcon, QMovie, QPen, QBrush, QPainter
 from PyQt5.QtCore import Qt, QThread, pyqtSignal, QSize, QRectF
 from PIL import Image
-from model.detect import detect_image
+from model.detect import detect_image, preload, render_image
 
 from PIL import ImageFile
 ImageFile.LOAD_TRUNCATED_IMAGES = True
@@ -564,15 +564,46 @@ class DetectionWorker(QThread):
         self.model_weights = model_weights
         
     def run(self):
+        # 只计数，先返回结果，标注图片由RenderWorker随后生成
         count, error_message = detect_image(
             self.upload_folder,
             self.result_folder,
             self.filename,
-            self.model_weights
+            self.model_weights,
+            annotate=False
         )
         result_filename = 'processed_' + self.filename
         self.finished.emit(count, result_filename, error_message or "")
 
+class RenderWorker(QThread):
+    """后台绘制标注图片，计数结果先显示"""
+    finished = pyqtSignal(str, str)  # result_filename, error_message
+
+    def __init__(self, upload_folder, result_folder, filename):
+        super().__init__()
+        self.upload_folder = upload_folder
+        self.result_folder = result_folder
+        self.filename = filename
+
+    def run(self):
+        _, error_message = render_image(self.upload_folder, self.result_folder, self.filename)
+        self.finished.emit('processed_' + self.filename, error_message or "")
+
+class ModelPreloadWorker(QThread):
+    """后台预加载模型，避免第一次识别时才加载权重"""
+    finished = pyqtSignal(str)  # error_message
+
+    def __init__(self, model_weights):
+        super().__init__()
+        self.model_weights = model_weights
+
+    def run(self):
+        try:
+            preload(self.model_weights)
+            self.finished.emit("")
+        except Exception as e:
+            self.finished.emit(str(e))
+
 class ScalableImageLabel(QLabel):
     """可缩放的图片标签，会随着窗口大小自动调整图片尺寸"""
     def __init__(self, parent=None):
@@ -612,6 +643,7 @@ class CornCountingApp(QMainWindow):
         self.UPLOAD_FOLDER = safe_path(os.path.join(self.base_dir, 'static', 'files'))
         self.RESULT_FOLDER = safe_path(os.path.join(self.base_dir, 'static', 'images'))
         self.MODEL_WEIGHTS = resource_path(os.path.join('model', 'yolov5_best.pt'))
+        self.TILED_INFERENCE = True  # 大图按原始分辨率分块识别，而不是缩放到2048像素
         
         # 确保目录存在
         os.makedirs(self.UPLOAD_FOLDER, exist_ok=True)
@@ -628,6 +660,21 @@ class CornCountingApp(QMainWindow):
         self.loading_movie = None
         
         self.init_ui()
+        self.preload_model()
+    
+    def preload_model(self):
+        """在后台线程中预加载并预热模型"""
+        self.statusBar().showMessage('正在加载模型...')
+        self.preload_worker = ModelPreloadWorker(self.MODEL_WEIGHTS)
+        self.preload_worker.finished.connect(self.on_preload_finished)
+        self.preload_worker.start()
+    
+    def on_preload_finished(self, error_message):
+        """模型预加载完成回调"""
+        if error_message:
+            self.statusBar().showMessage(f'模型加载失败: {error_message}')
+        else:
+            self.statusBar().showMessage('就绪')
     
     def init_ui(self):
         # 设置窗口
@@ -883,6 +930,25 @@ class CornCountingApp(QMainWindow):
             self.count_label.setText('处理失败，请重试')
             return
         
+        # 更新计数结果
+        self.plant_count = count
+        self.count_label.setText(f'识别到 {count} 个玉米植株')
+        
+        # 更新状态栏
+        self.statusBar().showMessage(f'处理完成，共识别 {count} 个玉米植株，正在生成标注图片...')
+        
+        # 标注图片在后台生成，完成后显示
+        self.processed_image.setText("正在生成标注图片...")
+        self.render_worker = RenderWorker(self.UPLOAD_FOLDER, self.RESULT_FOLDER, result_filename[len('processed_'):])
+        self.render_worker.finished.connect(self.on_render_finished)
+        self.render_worker.start()
+    
+    def on_render_finished(self, result_filename, error_message):
+        """标注图片生成完成回调"""
+        if error_message:
+            self.processed_image.setText(error_message)
+            return
+        
         # 显示处理后的图像
         result_path = os.path.join(self.RESULT_FOLDER, result_filename)
         if os.path.exists(result_path):
@@ -897,12 +963,8 @@ class CornCountingApp(QMainWindow):
         else:
             self.processed_image.setText("处理结果文件不存在")
         
-        # 更新计数结果
-        self.plant_count = count
-        self.count_label.setText(f'识别到 {count} 个玉米植株')
-        
         # 更新状态栏
-        self.statusBar().showMessage(f'处理完成，共识别 {count} 个玉米植株')
+        self.statusBar().showMessage(f'处理完成，共识别 {self.plant_count} 个玉米植株')
     
     def save_result(self):
         """保存处理后的图像"""
@@ -936,10 +998,11 @@ class CornCountingApp(QMainWindow):
             # 检查图像尺寸是否超过最大尺寸
             if width > max_size or height > max_size:
                 # 弹出提示窗口，询问用户是否要进行裁剪
+                no_action = "保持原始分辨率（分块识别）" if self.TILED_INFERENCE else "自动缩放图片"
                 reply = QMessageBox.question(
                     self, 
                     "图片过大", 
-                    f"图片尺寸为 {width}x{height}，请对图片进行处理。\n\n请选择处理方式：\n- 点击'yes'进行图片裁剪\n- 点击'no'自动缩放图片", 
+                    f"图片尺寸为 {width}x{height}，请对图片进行处理。\n\n请选择处理方式：\n- 点击'yes'进行图片裁剪\n- 点击'no'{no_action}", 
                     QMessageBox.Yes | QMessageBox.No,
                     QMessageBox.Yes
                 )
@@ -954,14 +1017,14 @@ class CornCountingApp(QMainWindow):
                             x, y, w, h = crop_rect
                             img = img.crop((x, y, x + w, y + h))
                             resized = True
-                    else:
+                    elif not self.TILED_INFERENCE:
                         # 用户取消裁剪，进行自动缩放
                         ratio = min(max_size / width, max_size / height)
                         new_width = int(width * ratio)
                         new_height = int(height * ratio)
                         img = img.resize((new_width, new_height), Image.LANCZOS)
                         resized = True
-                else:
+                elif not self.TILED_INFERENCE:
                     # 用户选择自动缩放
                     ratio = min(max_size / width, max_size / height)
                     new_width = int(width * ratio)
@@ -0,0 +1,239 @@
+"""
+服务监控：Prometheus文本格式的直方图、计数器和仪表（由 /metrics 提供），以及可选的JSON访问日志（每个请求一行）
+
+不依赖prometheus_client，所有指标保存在进程内存中，多个线程可同时记录
+"""
+import json
+import math
+import threading
+import time
+
+# 各阶段耗时的直方图分桶（秒）
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _labels(names, values):
+    # {a="1",b="2"}，按Prometheus文本格式转义
+    if not names:
+        return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in zip(names, values)) + '}'
+
+
+def _number(v):
+    return '+Inf' if v == math.inf else repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Metric:
+    """指标基类：name名称，help说明，labelnames标签名"""
+    type = 'untyped'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}  # 标签值元组 -> 值
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        assert set(labels) == set(self.labelnames), f'{self.name} 需要标签 {self.labelnames}，收到 {tuple(labels)}'
+        return tuple(labels[k] for k in self.labelnames)
+
+    def samples(self):
+        """[(后缀, 标签名, 标签值, 值)]"""
+        with self.lock:
+            return [('', self.labelnames, k, v) for k, v in self.values.items()]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for suffix, names, values, v in self.samples():
+            lines.append(f'{self.name}{suffix}{_labels(names, values)} {_number(v)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """只增不减的计数器"""
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        k = self._key(labels)
+        with self.lock:
+            self.values[k] = self.values.get(k, 0) + amount
+
+
+class Gauge(Metric):
+    """可增可减的当前值；传入func时在每次抓取时调用func()取值（无标签）"""
+    type = 'gauge'
+
+    def __init__(self, name, help, labelnames=(), func=None):
+        super().__init__(name, help, labelnames)
+        self.func = func
+
+    def set(self, value, **labels):
+        k = self._key(labels)
+        with self.lock:
+            self.values[k] = value
+
+    def samples(self):
+        if self.func is not None:
+            return [('', (), (), self.func())]
+        return super().samples()
+
+
+class Histogram(Metric):
+    """分桶直方图，记录观测值的分布、总和与次数"""
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=SECONDS_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf, )
+
+    def observe(self, value, **labels):
+        k = self._key(labels)
+        with self.lock:
+            counts, total = self.values.get(k, ([0] * len(self.buckets), 0.0))
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    counts[i] += 1
+            self.values[k] = counts, total + value
+
+    def samples(self):
+        out = []
+        with self.lock:
+            for k, (counts, total) in self.values.items():
+                for b, n in zip(self.buckets, counts):
+                    out.append(('_bucket', self.labelnames + ('le', ), k + (_number(b), ), n))
+                out += [('_sum', self.labelnames, k, total), ('_count', self.labelnames, k, counts[-1])]
+        return out
+
+
+class Registry:
+    """指标集合，render()输出Prometheus文本格式"""
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(m.render() for m in self.metrics) + '\n'
+
+
+REGISTRY = Registry()
+REQUESTS = REGISTRY.add(Counter('corn_http_requests_total', 'HTTP请求数', ('method', 'endpoint', 'status')))
+REQUEST_SECONDS = REGISTRY.add(Histogram('corn_http_request_duration_seconds', 'HTTP请求耗时', ('endpoint', )))
+STAGE_SECONDS = REGISTRY.add(Histogram('corn_stage_duration_seconds', '处理各阶段耗时', ('stage', )))
+IMAGE_MEGAPIXELS = REGISTRY.add(
+    Histogram('corn_image_megapixels', '识别图片的像素数（百万）', buckets=(0.5, 1, 2, 4, 8, 12, 16, 24, 32, 48, 64, 100)))
+PLANT_COUNT = REGISTRY.add(
+    Histogram('corn_plant_count', '每张图片识别出的植株数', buckets=(0, 10, 25, 50, 100, 200, 400, 800, 1600, 3200)))
+DETECTIONS = REGISTRY.add(Counter('corn_detections_total', '识别任务数', ('status', )))
+ERRORS = REGISTRY.add(Counter('corn_errors_total', '错误数', ('kind', )))
+CACHE = REGISTRY.add(Counter('corn_result_cache_total', '识别结果缓存命中/未命中次数', ('result', )))
+OOM_FALLBACKS = REGISTRY.add(Counter('corn_oom_fallbacks_total', 'detect_image内存不足后清理显存并返回错误的次数'))
+
+# detect()的阶段名 -> 监控中的阶段名
+DETECT_STAGES = {
+    'decode': 'decode',
+    'preprocess': 'preprocess',
+    'inference': 'forward',
+    'nms': 'nms',
+    'render': 'render',
+    'encode': 'encode',
+    'cache': 'cache'}
+
+
+def observe(stage, seconds):
+    """记录一个阶段的耗时（秒）"""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+
+
+class timer:
+    """记录with代码块耗时的上下文管理器：with timer('upload'): ..."""
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        observe(self.stage, time.perf_counter() - self.start)
+
+
+def observe_detection(stats):
+    """记录detect_image(stats=...)写入的一次识别统计"""
+    error = stats.get('error')
+    DETECTIONS.inc(status='error' if error else 'ok')
+    if error:
+        ERRORS.inc(kind=error)
+        if error == 'oom':
+            OOM_FALLBACKS.inc()
+        return
+    for k, ms in stats.get('timings', {}).items():
+        observe(DETECT_STAGES.get(k, k), ms / 1E3)
+    h, w = stats['shape'][:2]
+    IMAGE_MEGAPIXELS.observe(h * w / 1E6)
+    PLANT_COUNT.observe(stats['count'])
+    CACHE.inc(result='hit' if stats.get('cache') else 'miss')
+
+
+class AccessLog:
+    """JSON访问日志，每个请求写一行"""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self.lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line)
+
+
+def init_app(app, job_queue=None, access_log=None):
+    """
+    为Flask应用注册请求计时、/metrics接口和可选的JSON访问日志
+
+    Args:
+        app: Flask应用
+        job_queue: 传入JobQueue时导出等待中和运行中的任务数
+        access_log: JSON访问日志文件路径，为None时不记录
+    """
+    from flask import Response, g, request
+
+    log = AccessLog(access_log) if access_log else None
+    if job_queue is not None:
+        REGISTRY.add(Gauge('corn_queue_pending_jobs', '等待中的检测任务数', func=lambda: job_queue.pending))
+        REGISTRY.add(Gauge('corn_queue_running_jobs', '运行中的检测任务数', func=lambda: job_queue.running))
+
+    @app.before_request
+    def _start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        seconds = time.perf_counter() - g.get('request_start', time.perf_counter())
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'  # 路由模板，避免任务ID等高基数标签
+        REQUESTS.inc(method=request.method, endpoint=endpoint, status=response.status_code)
+        REQUEST_SECONDS.observe(seconds, endpoint=endpoint)
+        if response.status_code >= 500:
+            ERRORS.inc(kind='http_5xx')
+        if log:
+            log.write({
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'remote_addr': request.remote_addr,
+                'method': request.method,
+                'path': request.path,
+                'endpoint': endpoint,
+                'status': response.status_code,
+                'duration_ms': round(seconds * 1E3, 2),
+                'bytes': response.calculate_content_length(),
+                'user_agent': request.user_agent.string})
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+    return app